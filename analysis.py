@@ -1,7 +1,224 @@
 import leverage_efficiency.base
 import leverage_efficiency.sme_functions as sm
+import leverage_efficiency.manifest as manifest
+import leverage_efficiency.instrument as instrument
+import leverage_efficiency.store as store
 import yaml
 import sys
+import os
+import time
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Environment variables limiting the threads of the BLAS/OpenMP libraries that
+# numpy and scipy may use. Each worker is pinned to a single thread so that
+# the workers do not oversubscribe the cores between them.
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+def run_task(data_folder, analysis_folder, stage, pair, options):
+    # Run a single pair x model x stage task. This is what the worker
+    # processes execute when the analysis is run in parallel.
+    if stage == 'calculate grids':
+        sm.grid(data_folder, analysis_folder, pair, **options)
+    elif stage == 'fit parameters':
+        return sm.fit_parameters(data_folder, analysis_folder, pair, **options)
+    elif stage == 'expanding window calculations':
+        import leverage_efficiency.exp_window
+        leverage_efficiency.exp_window.expanding_window_fits(data_folder, analysis_folder, pair, 10, **options)
+    elif stage == 'l_opt variance calculations':
+        import leverage_efficiency.lopt_var
+        leverage_efficiency.lopt_var.lopt_variance_vs_window_size(data_folder, analysis_folder, pair, 10, **options)
+    elif stage == 'fixed window calculations':
+        import leverage_efficiency.fixed_window
+        leverage_efficiency.fixed_window.lopt_fixed_window_size(data_folder, analysis_folder, pair, **options)
+
+def list_tasks(pairs, stages, outfile_pair=None, append=False, pickle_export=False, grid_options=None,
+               solver_statistics=False):
+    # Split the enabled stages into independent tasks: one per pair and model
+    # where a stage loops over models, otherwise one per pair
+    grid_options = grid_options or {}
+    if outfile_pair is None:
+        outfile_pair = pairs[-1]
+    saving = {'pickle_export':pickle_export}
+    solver = {'solver_statistics':True} if solver_statistics else {}
+    tasks = []
+    for pair in pairs:
+        models = leverage_efficiency.base.set_pair_properties('modify-defaults/', pair)['models']
+        if stages['calculate grids']:
+            tasks += [('calculate grids', pair, {'models':[model], 'append':append, **saving, **grid_options})
+                      for model in [1, 2, 3]]
+        if stages['fit parameters']:
+            tasks.append(('fit parameters', pair, {**solver}))
+        if stages['expanding window calculations']:
+            tasks += [('expanding window calculations', pair, {'models':[model], 'append':append, **saving, **solver})
+                      for model in models]
+        if stages['l_opt variance calculations']:
+            # outfile.txt is only written for the last pair, as in a serial run
+            tasks.append(('l_opt variance calculations', pair, {'write_outfile':pair == outfile_pair, **saving,
+                                                                 **solver}))
+        if stages['fixed window calculations']:
+            tasks += [('fixed window calculations', pair, {'models':[model], 'append':append, **saving, **solver})
+                      for model in models]
+    return tasks
+
+# The stages in the order they are run, with the message printed when each
+# starts in a serial run
+STAGE_MESSAGES = {
+    'calculate grids':'\nCalculating final equity for grid of leverage values.',
+    'fit parameters':'\nFitting parameters of leverage parabolae: fit_parameters.py',
+    'expanding window calculations':'\n Calculation of optimal leverage for expanding windows : exp_window.py.',
+    'l_opt variance calculations':'\nCalculation of variance in optimal leverage as a function of window length: lopt_var.py.',
+    'fixed window calculations':'\nCalculation of optimal leverage for some fixed-length windows: fixed_window.py',
+    }
+
+def label(task):
+    stage, pair, options = task
+    return stage+' : '+pair+''.join(' '+key+'='+str(value) for key, value in options.items())
+
+def print_traceback(task, error):
+    print("  Task failed:", label(task))
+    print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+def finish_tasks(analysis_folder, pairs, stages, tasks, failures, fit_results):
+    # The fitted parameters are written to numbers.txt in the order of the
+    # pairs, and the tasks that failed are listed
+    if stages['fit parameters']:
+        import leverage_efficiency.fit_parameters
+        tex = open(analysis_folder+'numbers.txt', 'w')
+        for pair in pairs:
+            if pair in fit_results:
+                leverage_efficiency.fit_parameters.save_results(analysis_folder, pair, fit_results[pair], tex)
+        tex.close()
+
+    if failures:
+        print("\n", len(failures), "of", len(tasks), "analysis tasks failed:")
+        for task in tasks:
+            if task in failures:
+                print("   ", label(task))
+
+def run_serial(data_folder, analysis_folder, pairs, stages, outfile_pair=None, append=False,
+               pickle_export=False, grid_options=None, solver_statistics=False):
+    # Run the same tasks as run_parallel() one after the other in this
+    # process, a stage at a time for all the pairs. A task that fails is
+    # reported and does not stop the others, and the parameter fit of a pair
+    # whose model 1 grid failed is skipped.
+    grid_options = grid_options or {}
+    tasks = list_tasks(pairs, stages, outfile_pair, append, pickle_export, grid_options, solver_statistics)
+    order = list(STAGE_MESSAGES)
+    fit_results = {}
+    failures = []
+    stage = None
+    for task in sorted(tasks, key=lambda task: order.index(task[0])):
+        if task[0] != stage:
+            stage = task[0]
+            print(STAGE_MESSAGES[stage])
+        if task[0] == 'fit parameters' and stages['calculate grids']:
+            needed = [failed for failed in failures if failed[0] == 'calculate grids' and failed[1] == task[1]
+                      and failed[2]['models'] == [1]]
+            if needed:
+                failures.append(task)
+                print("  Task skipped:", label(task), "(needs", label(needed[0])+")")
+                continue
+        try:
+            result = run_task(data_folder, analysis_folder, *task)
+        except Exception as error:
+            failures.append(task)
+            print_traceback(task, error)
+        else:
+            if task[0] == 'fit parameters':
+                fit_results[task[1]] = result
+
+    finish_tasks(analysis_folder, pairs, stages, tasks, failures, fit_results)
+    return failures
+
+def run_parallel(data_folder, analysis_folder, pairs, stages, workers, outfile_pair=None, append=False,
+                 pickle_export=False, grid_options=None, solver_statistics=False):
+    # Run the analysis stages as a set of tasks on a pool of worker processes.
+    # The files written are the same as in a serial run. A task that fails is
+    # reported and does not stop the others.
+    grid_options = grid_options or {}
+    tasks = list_tasks(pairs, stages, outfile_pair, append, pickle_export, grid_options, solver_statistics)
+    print("\nRunning", len(tasks), "analysis tasks on", workers, "worker processes.")
+
+    def submit(executor, task):
+        # With the instrumentation on, each task is measured on its worker
+        if instrument.enabled:
+            return executor.submit(instrument.call, run_task, data_folder, analysis_folder, *task)
+        return executor.submit(run_task, data_folder, analysis_folder, *task)
+
+    # Fitting the parameters of a pair reads the model 1 summary written by
+    # the grid calculation, so it waits for that task
+    waiting = {}
+    if stages['calculate grids']:
+        waiting = {task[1]:task for task in tasks if task[0] == 'fit parameters'}
+    runnable = [task for task in tasks if task not in waiting.values()]
+
+    # The returns of each pair are read once and shared with the workers
+    blocks, descriptions = sm.share_returns_pairs(data_folder, pairs)
+
+    fit_results = {}
+    failures = []
+    saved_environment = {name:os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name:'1' for name in BLAS_THREAD_VARIABLES})
+    try:
+        # Worker processes are started fresh rather than forked, so the
+        # thread limits are read when they import numpy
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=sm.attach_shared_returns, initargs=(descriptions,)) as executor:
+            futures = {submit(executor, task):task for task in runnable}
+            while futures:
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except BaseException as error:
+                        failures.append(task)
+                        print_traceback(task, error)
+                    else:
+                        if instrument.enabled:
+                            result, worker_records = result
+                            instrument.add(worker_records)
+                        if task[0] == 'fit parameters':
+                            fit_results[task[1]] = result
+
+                    # Start the parameter fit once the model 1 grid is done
+                    if task[0] == 'calculate grids' and task[2]['models'] == [1] and task[1] in waiting:
+                        dependent = waiting.pop(task[1])
+                        if task in failures:
+                            failures.append(dependent)
+                            print("  Task skipped:", label(dependent), "(needs", label(task)+")")
+                        else:
+                            futures[submit(executor, dependent)] = dependent
+    finally:
+        for name, value in saved_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    finish_tasks(analysis_folder, pairs, stages, tasks, failures, fit_results)
+    return failures
+
+def pair_inputs_hash(data_folder, pair, params, stages, write_outfile, settings=None):
+    # Hash of everything the analysis of a pair depends on: the returns of
+    # both assets, the market model parameters of the risky asset, the file
+    # overriding the defaults for the pair, the stages run, the settings that
+    # change the files written and the code
+    settings = settings or {}
+    asset1 = pair.split('-')[0]
+    asset2 = pair.split('-')[1]
+    files = store.read_files(data_folder+asset1)+store.read_files(data_folder+asset2)
+    files += ['modify-defaults/'+pair+'.yaml', __file__]
+    files += manifest.package_files('base', 'sme_functions', 'fit_parameters', 'exp_window', 'lopt_var', 'fixed_window',
+                                   'solver_stats')
+    return manifest.input_hash(files, params.get(asset1), stages, write_outfile, settings)
 
 def main(config_file):
 
@@ -14,49 +231,77 @@ def main(config_file):
     pairs = config['analysis']['pairs']
     runstage = config['analysis']['run']
     stages = config['analysis']['analysis stages']
+    # Number of worker processes to spread the analysis over. The default
+    # of 1 runs everything serially in this process.
+    workers = config['analysis'].get('workers', 1)
+    if workers == 'auto':
+        workers = os.cpu_count()
+    # In append mode the grids and the expanding and fixed window results
+    # already saved are extended to new dates rather than computed again
+    append = config['analysis'].get('append new data', False)
+    # The results are saved in the binary store read by the figures, and
+    # optionally also exported as pandas pickles
+    pickle_export = config['analysis'].get('pickle export', False)
+    # Given a memory budget (in MB) the leverage grids are computed and
+    # written a block of dates at a time, and they can be stored in single
+    # precision
+    grid_options = {'memory_budget':config['analysis'].get('grid memory budget', None),
+                    'precision':config['analysis'].get('grid precision', 'float64')}
+    # Statistics of the optimal leverage solvers for each window can be
+    # written next to the results (see leverage_efficiency/solver_stats.py)
+    solver_statistics = config['analysis'].get('solver statistics', False)
 
     if runstage:
         print("\n###")
         print("Running analysis.py. Results will be written to ", analysis_folder)
         print("###")
 
-        if stages['calculate grids']:
-            print("\nCalculating final equity for grid of leverage values.")
-            for p in pairs:
-                sm.grid(data_folder, analysis_folder, p)
+        # Pairs whose inputs are unchanged since they were last analysed are
+        # skipped if the stage cache is turned on. The market model
+        # parameters are hashed as written in model_parameters.yaml.
+        records = manifest.read_manifest(analysis_folder)
+        f = open('model_parameters.yaml','r')
+        params = yaml.load(f, Loader=yaml.SafeLoader)
+        f.close()
+        settings = {'pickle export':pickle_export, 'grid precision':grid_options['precision'],
+                    'solver statistics':solver_statistics}
+        keys = {pair:pair_inputs_hash(data_folder, pair, params, stages, pair == pairs[-1], settings) for pair in pairs}
+        run_pairs = pairs
+        if config.get('stage cache', False):
+            current = [pair for pair in pairs if manifest.is_current(analysis_folder, records, pair, keys[pair])]
+            if current:
+                print("\nUnchanged since last analysed: ", ', '.join(current))
+            run_pairs = [pair for pair in pairs if pair not in current]
+        start_time = time.time_ns()
 
-        if stages['fit parameters']:
-            print('\nFitting parameters of leverage parabolae: fit_parameters.py')
-            import leverage_efficiency.fit_parameters
-            leverage_efficiency.fit_parameters.main(data_folder,analysis_folder, pairs)
-
-        if stages['expanding window calculations']:
-            print('\n Calculation of optimal leverage for expanding windows : exp_window.py.')
-            import leverage_efficiency.exp_window
-            leverage_efficiency.exp_window.main(data_folder,analysis_folder, pairs)
+        # Both paths run the same tasks and report the tasks that fail
+        # without stopping the others. The pairs with a failed task are not
+        # recorded as analysed.
+        failures = []
+        if run_pairs and workers > 1:
+            failures = run_parallel(data_folder, analysis_folder, run_pairs, stages, workers, pairs[-1], append,
+                                    pickle_export, grid_options, solver_statistics)
+        elif run_pairs:
+            failures = run_serial(data_folder, analysis_folder, run_pairs, stages, pairs[-1], append,
+                                  pickle_export, grid_options, solver_statistics)
+        failed = [pair for pair in run_pairs if pair in [task[1] for task in failures]]
 
-        if stages['l_opt variance calculations']:
-            print('\nCalculation of variance in optimal leverage as a function of window length: lopt_var.py.')
-            import leverage_efficiency.lopt_var
-            leverage_efficiency.lopt_var.main(data_folder,analysis_folder, pairs)
+        # numbers.txt holds the fitted parameters of all the pairs, so it is
+        # put back together when only some of them have been fitted again
+        if stages['fit parameters'] and run_pairs != pairs:
+            import leverage_efficiency.fit_parameters
+            leverage_efficiency.fit_parameters.write_numbers(analysis_folder,
+                                    [pair for pair in pairs if pair not in failed])
 
-        if stages['fixed window calculations']:
-            print('\nCalculation of optimal leverage for some fixed-length windows: fixed_window.py')
-            import leverage_efficiency.fixed_window
-            # Define the window lengths to use for different asset pairs
-            # window_lists = {
-            #             'BTC-FED' : [365,2*365,3*365,4*365],
-            #             'BTC-DGS10' : [365,2*365,3*365,4*365],
-            #             'SP500TR-FED' : [365,5*365,10*365,20*365],
-            #             'SP500TR-DGS10' : [365,5*365,10*365,20*365],
-            #             'SP500-FED' : [365,5*365,10*365,20*365,40*365],
-            #             'SP500-DGS10' : [365,5*365,10*365,20*365,40*365],
-            #             'MAD-FEDM' : [365,2*365,3*365,4*365],
-            #             'BRK-FED' : [365,5*365,10*365,20*365],
-            #             'BRK-DGS10' : [365,5*365,10*365,20*365],
-            #             'DAX-IRDE' : [365,5*365,10*365,20*365]
-            #             }
-            leverage_efficiency.fixed_window.main(data_folder,analysis_folder, pairs)
+        # Record the files written for each pair that was analysed
+        written = manifest.outputs_since(analysis_folder, start_time)
+        for pair in run_pairs:
+            if pair not in failed:
+                outputs = [name for name in written if name.startswith(pair+'-') or name.startswith(pair+'_')]
+                if pair == pairs[-1] and 'outfile.txt' in written:
+                    outputs.append('outfile.txt')
+                manifest.record(analysis_folder, records, pair, keys[pair], outputs)
+        manifest.write_manifest(analysis_folder, records)
 
 
 # Execute the main() function
@@ -0,0 +1,111 @@
+import json
+import os
+import subprocess
+import sys
+
+# Measures how long the package and the pipeline scripts take to start, each
+# in a fresh interpreter, and checks the times against a budget. Importing
+# a module must also leave the heavy optional dependencies unloaded unless
+# the module plots: they are only imported inside the functions that use
+# them, so that short-lived worker processes do not pay for them.
+#
+# Every stage needs pandas, so the budgets are for the time taken on top of
+# importing pandas (measured the same way in the same run). This keeps them
+# meaningful on machines of different speeds.
+#
+# Run from the repository root:  python benchmarks/import_time.py
+# It exits with status 1 if any budget is exceeded.
+
+REPEATS = 5
+
+# Dependencies that must only be loaded by the code paths that use them
+HEAVY_MODULES = ['matplotlib', 'scipy', 'lmfit', 'yfinance', 'requests']
+
+# Budgets in seconds for the best of REPEATS imports, above the import of
+# pandas, and the heavy modules each import may load
+IMPORT_BUDGETS = {
+    'leverage_efficiency': (0.01, []),
+    'leverage_efficiency.manifest': (0.01, []),
+    'leverage_efficiency.base': (0.15, []),
+    'leverage_efficiency.store': (0.15, []),
+    'leverage_efficiency.results': (0.15, []),
+    'leverage_efficiency.sme_functions': (0.15, []),
+    'leverage_efficiency.data': (0.15, []),
+    'leverage_efficiency.fit_parameters': (0.15, []),
+    'leverage_efficiency.exp_window': (0.15, []),
+    'leverage_efficiency.fixed_window': (0.15, []),
+    'leverage_efficiency.lopt_var': (0.15, []),
+    'leverage_efficiency.figures': (0.8, ['matplotlib']),
+}
+
+# Budgets in seconds for the whole of `python <script> --help`, above
+# `python -c "import pandas"`
+SCRIPT_BUDGETS = {
+    'workflow.py': 0.2,
+    'extract.py': 0.2,
+    'transform.py': 0.2,
+    'analysis.py': 0.2,
+}
+
+MEASURE_IMPORT = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter()-start
+heavy = sorted(set(name.split('.')[0] for name in sys.modules) & set({heavy}))
+print(json.dumps([seconds, heavy]))
+'''
+
+MEASURE_COMMAND = '''
+import subprocess, sys, time, json
+start = time.perf_counter()
+subprocess.run([sys.executable]+{args!r}, stdout=subprocess.DEVNULL, check=True)
+print(json.dumps(time.perf_counter()-start))
+'''
+
+def run_measurement(code):
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def measure_import(module):
+    # Best time over REPEATS fresh interpreters, and the heavy modules loaded
+    measurements = [run_measurement(MEASURE_IMPORT.format(module=module, heavy=HEAVY_MODULES))
+                    for repeat in range(REPEATS)]
+    return min(seconds for seconds, heavy in measurements), measurements[0][1]
+
+def measure_command(args):
+    return min(run_measurement(MEASURE_COMMAND.format(args=args)) for repeat in range(REPEATS))
+
+def report(name, seconds, reference, budget, notes=''):
+    ok = seconds-reference <= budget
+    print('{:36s} {:8.3f} {:8.3f} {:8.3f}  {}{}'.format(name, seconds, seconds-reference, budget, notes,
+                                                     '' if ok else '  OVER BUDGET'))
+    return ok
+
+def main():
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    failed = False
+
+    reference, heavy = measure_import('pandas')
+    print('{:36s} {:>8s} {:>8s} {:>8s}  {}'.format('import', 'seconds', 'extra', 'budget', 'heavy modules loaded'))
+    print('{:36s} {:8.3f}'.format('pandas', reference))
+    for module, (budget, allowed) in IMPORT_BUDGETS.items():
+        seconds, heavy = measure_import(module)
+        unexpected = [name for name in heavy if name not in allowed]
+        failed = not report(module, seconds, reference, budget, ', '.join(heavy) or '-') or failed
+        if unexpected:
+            print('  {} should not import {}'.format(module, ', '.join(unexpected)))
+            failed = True
+
+    reference = measure_command(['-c', 'import pandas'])
+    print('{:36s} {:>8s} {:>8s} {:>8s}'.format('command', 'seconds', 'extra', 'budget'))
+    print('{:36s} {:8.3f}'.format('python -c "import pandas"', reference))
+    for script, budget in SCRIPT_BUDGETS.items():
+        seconds = measure_command([script, '--help'])
+        failed = not report('python '+script+' --help', seconds, reference, budget) or failed
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks for the core calculations, the analysis stages and the figures.
+# Each benchmark is run on synthetic daily return pairs of several lengths,
+# from 1 to 100 years, in a fresh interpreter so that nothing is cached from
+# one benchmark to the next. For each it reports
+#   seconds             best of the repeats
+#   samples_per_second  daily samples of the pair processed per second
+#   seconds_per_window  for the solvers, the time per window solved
+#   peak_memory_mb      the most memory allocated at once during one run
+#                       (traced with tracemalloc in a separate, untimed run)
+# as JSON, and compares them with a stored baseline. A benchmark that takes
+# longer or uses more memory than its baseline by more than the threshold
+# is a regression, and makes the run exit with status 1.
+#
+# Run from anywhere:
+#   python benchmarks/run.py                      all benchmarks and sizes
+#   python benchmarks/run.py --sizes 1 10 --only grid
+#   python benchmarks/run.py --save-baseline      store the results as the baseline
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(REPOSITORY, 'benchmarks', 'baseline.json')
+sys.path.insert(0, REPOSITORY)
+
+SIZES = [1, 10, 100]
+REPEATS = 3
+THRESHOLD = 0.25
+
+# The synthetic pair, a geometric Brownian motion against a constant rate.
+# SYN is registered in model_parameters.yaml
+RISKY = 'SYN'
+RISKLESS = 'SYNRF'
+PAIR = RISKY+'-'+RISKLESS
+SEED = 12345
+MU = 0.08
+SIGMA = 0.2
+RATE = 0.03
+
+def synthetic_pair(data_folder, years):
+    # Write a daily pair of the given length to data_folder (see
+    # leverage_efficiency/synthetic.py). Returns the number of samples.
+    import leverage_efficiency.synthetic as synthetic
+    return synthetic.write_pair(data_folder, PAIR, MU, RATE, SIGMA, years, 365.0, '1920-01-01', SEED)
+
+# Each benchmark is a function of the data, analysis and plots folders. It
+# returns the number of windows it solved, or None. The analysis stages
+# write the results that the figures read, so a size is always benchmarked
+# in the order below.
+
+def grid(data_folder, analysis_folder, plots_folder):
+    import leverage_efficiency.sme_functions as sm
+    sm.grid(data_folder, analysis_folder, PAIR)
+
+def optimal_leverage(model):
+    def benchmark(data_folder, analysis_folder, plots_folder):
+        # One window covering the whole series
+        import leverage_efficiency.base as base
+        import leverage_efficiency.sme_functions as sm
+        params = base.read_model_parameters()
+        returns = sm.get_returns_pair(data_folder+RISKY, data_folder+RISKLESS, {})
+        sm.calculate_optimal_leverage(returns, (returns.dates[0], returns.dates[-1]), model, params[RISKY])
+        return 1
+    return benchmark
+
+def fit_parameters(data_folder, analysis_folder, plots_folder):
+    import leverage_efficiency.fit_parameters as fit_parameters
+    fit_parameters.main(data_folder, analysis_folder, [PAIR])
+
+def solved_windows(analysis_folder, suffix, models=(1, 2, 3)):
+    # The windows with a result in the saved results of each model
+    import leverage_efficiency.store as store
+    return sum(int(store.load(analysis_folder+PAIR+'-'+str(model)+suffix).notna().values.sum())
+               for model in models)
+
+def expanding_window_fits(data_folder, analysis_folder, plots_folder):
+    import leverage_efficiency.exp_window as exp_window
+    exp_window.expanding_window_fits(data_folder, analysis_folder, PAIR, 10)
+    return solved_windows(analysis_folder, '_lopt_exp')
+
+def lopt_variance_vs_window_size(data_folder, analysis_folder, plots_folder):
+    import leverage_efficiency.lopt_var as lopt_var
+    lopt_var.lopt_variance_vs_window_size(data_folder, analysis_folder, PAIR, 10)
+    # outfile.txt has a line for every window solved
+    with open(analysis_folder+'outfile.txt') as f:
+        return sum(1 for line in f)
+
+def lopt_fixed_window_size(data_folder, analysis_folder, plots_folder):
+    import leverage_efficiency.fixed_window as fixed_window
+    fixed_window.lopt_fixed_window_size(data_folder, analysis_folder, PAIR)
+    return solved_windows(analysis_folder, '_lopt_fixed')
+
+def figure(function, *args):
+    def benchmark(data_folder, analysis_folder, plots_folder):
+        import leverage_efficiency.figures as figs
+        import leverage_efficiency.render as render
+        import leverage_efficiency.results as results
+        # Figures read their inputs through the results cache, which would
+        # otherwise make every repeat after the first a cache hit
+        results.cached_call.cache_clear()
+        render.use_agg_backend()
+        arguments = [analysis_folder]+[plots_folder if arg == 'plots' else arg for arg in args]
+        render.render_figure(figs.__name__, function, arguments, plots_folder+function+'.pdf', {})
+    return benchmark
+
+BENCHMARKS = {
+    'grid': grid,
+    'optimal leverage model 1': optimal_leverage(1),
+    'optimal leverage model 2': optimal_leverage(2),
+    'optimal leverage model 3': optimal_leverage(3),
+    'fit parameters': fit_parameters,
+    'expanding window fits': expanding_window_fits,
+    'lopt variance vs window size': lopt_variance_vs_window_size,
+    'lopt fixed window size': lopt_fixed_window_size,
+    'fig_exp_window': figure('fig_exp_window', PAIR),
+    'fig_exp_window_significance': figure('fig_exp_window_significance', PAIR),
+    'fig_growth_vs_leverage': figure('fig_growth_vs_leverage', 'plots', PAIR),
+    'fig_final_equity': figure('fig_final_equity', 'plots', PAIR),
+    'fig_equity_trajectories': figure('fig_equity_trajectories', 'plots', PAIR),
+    'fig_lopt_var': figure('fig_lopt_var', 'plots', [PAIR]),
+    'fig_leverage_vary_window': figure('fig_leverage_vary_window', 'plots', PAIR, 1),
+}
+
+# The analysis stages whose results the figures read, and the figures
+ANALYSIS_STAGES = ['grid', 'fit parameters', 'expanding window fits', 'lopt variance vs window size',
+                   'lopt fixed window size']
+FIGURES = [name for name in BENCHMARKS if name.startswith('fig')]
+
+def run_benchmark(name, folder, samples, repeats):
+    # Run one benchmark in this process and print its results as JSON
+    data_folder, analysis_folder, plots_folder = [os.path.join(folder, sub)+'/' for sub in ['data', 'analysis', 'plots']]
+    benchmark = BENCHMARKS[name]
+    # The modules are imported before anything is timed
+    import leverage_efficiency.sme_functions, leverage_efficiency.exp_window, leverage_efficiency.lopt_var
+    import leverage_efficiency.fixed_window, leverage_efficiency.fit_parameters, leverage_efficiency.store
+    if name in FIGURES:
+        import leverage_efficiency.figures, leverage_efficiency.render
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        if repeats == 0:
+            # Only run to make the results other benchmarks need
+            benchmark(data_folder, analysis_folder, plots_folder)
+            return
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            windows = benchmark(data_folder, analysis_folder, plots_folder)
+            times.append(time.perf_counter()-start)
+        tracemalloc.start()
+        benchmark(data_folder, analysis_folder, plots_folder)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    seconds = min(times)
+    print(json.dumps({'seconds':seconds,
+                      'samples_per_second':samples/seconds,
+                      'windows':windows,
+                      'seconds_per_window':None if not windows else seconds/windows,
+                      'peak_memory_mb':peak/2**20}))
+
+def run_size(years, names, repeats):
+    # Benchmark one length of data in a scratch folder, each benchmark in a
+    # fresh interpreter
+    folder = tempfile.mkdtemp(prefix='leverage_efficiency_benchmark_')
+    try:
+        for sub in ['data', 'analysis', 'plots']:
+            os.mkdir(os.path.join(folder, sub))
+        samples = synthetic_pair(os.path.join(folder, 'data')+'/', years)
+        results = []
+        for name in BENCHMARKS:
+            # The figures need the results of the analysis stages, which
+            # are run untimed before them if they are not benchmarked
+            if name not in names and not (name in ANALYSIS_STAGES and any(name in FIGURES for name in names)):
+                continue
+            command = [sys.executable, os.path.abspath(__file__), '--run', name, '--folder', folder,
+                       '--samples', str(samples), '--repeats', str(repeats if name in names else 0)]
+            output = subprocess.run(command, cwd=REPOSITORY, capture_output=True, text=True)
+            if output.returncode != 0:
+                sys.stderr.write(output.stderr)
+                raise RuntimeError('Benchmark '+name+' failed for '+str(years)+' years')
+            if name in names:
+                result = {'benchmark':name, 'years':years, 'samples':samples}
+                result.update(json.loads(output.stdout.splitlines()[-1]))
+                results.append(result)
+                print('  {:30s} {:4d} years {:9.3f}s {:12.0f} samples/s {:>12s} s/window {:9.1f} MB'.format(
+                    name, years, result['seconds'], result['samples_per_second'],
+                    '-' if result['seconds_per_window'] is None else '{:.3g}'.format(result['seconds_per_window']),
+                    result['peak_memory_mb']))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+def compare(results, baseline, threshold):
+    # The benchmarks that are slower or use more memory than their baseline
+    # by more than the threshold (a fraction)
+    stored = {(result['benchmark'], result['years']):result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = stored.get((result['benchmark'], result['years']))
+        if previous is None:
+            continue
+        for measure in ['seconds', 'peak_memory_mb']:
+            if result[measure] > previous[measure]*(1+threshold):
+                regressions.append('{} ({} years): {} {:.3f} against {:.3f} in the baseline'.format(
+                    result['benchmark'], result['years'], measure, result[measure], previous[measure]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the leverage efficiency calculations on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='lengths of data in years')
+    parser.add_argument('--only', nargs='+', default=None, help='benchmarks to run (names start with these)')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--output', default=None, help='file to write the results to as JSON')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='fraction by which a benchmark may exceed its baseline')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--folder', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--samples', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run_benchmark(args.run, args.folder, args.samples, args.repeats)
+        return
+
+    names = [name for name in BENCHMARKS if args.only is None or any(name.startswith(only) for only in args.only)]
+    results = []
+    for years in args.sizes:
+        results += run_size(years, names, args.repeats)
+    report = {'python':sys.version.split()[0], 'repeats':args.repeats, 'results':results}
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Baseline saved to', args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare with at', args.baseline)
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    if regressions:
+        print('Regressions beyond {:.0%} of the baseline:'.format(args.threshold))
+        for regression in regressions:
+            print('  '+regression)
+        sys.exit(1)
+    print('No regressions beyond {:.0%} of the baseline.'.format(args.threshold))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,58 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import leverage_efficiency.base
 import leverage_efficiency.data as data
+import leverage_efficiency.manifest as manifest
+import leverage_efficiency.instrument as instrument
+import leverage_efficiency.source_cache as source_cache
+import leverage_efficiency.store as store
 import yaml
 import sys
+import os
+import time
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+def extract(keys, source_folder, target_folder, formats=store.DEFAULT_FORMATS):
+    # Extract data sets one after the other, each measured as a step of the
+    # extract stage. Returns once the csv files written in the background are
+    # complete.
+    for key in keys:
+        with instrument.measure(item=key):
+            data.extract(key, source_folder, target_folder, formats)
+    store.finish_writes()
+
+def run_parallel(keys, source_folder, target_folder, workers, formats=store.DEFAULT_FORMATS):
+    # Run the extractors on a pool of worker processes, so that the extract
+    # takes about as long as the slowest data set. The files written are the
+    # same as in a serial run. An extractor that fails is reported and does
+    # not stop the others. Returns the keys that failed.
+    print("  Extracting", len(keys), "data sets on", min(workers, len(keys)), "worker processes.")
+    failures = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(keys)), mp_context=context) as executor:
+        # With the instrumentation on, each extractor is measured on its worker
+        if instrument.enabled:
+            futures = {executor.submit(instrument.call, extract, [key], source_folder, target_folder, formats):key
+                       for key in keys}
+        else:
+            futures = {executor.submit(extract, [key], source_folder, target_folder, formats):key for key in keys}
+        while futures:
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                try:
+                    result = future.result()
+                except BaseException as error:
+                    failures.append(key)
+                    print("  Extracting", key, "failed:")
+                    print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                else:
+                    if instrument.enabled:
+                        result, worker_records = result
+                        instrument.add(worker_records)
+    return failures
 
 def main(config_file):
     # Read the config information to control what gets executed
@@ -17,6 +65,10 @@ def main(config_file):
     assets = config['data processing stages']['assets']
     daily_interest_rates = config['data processing stages']['daily interest rates']
     monthly_interest_rates = config['data processing stages']['monthly interest rates']
+    formats = store.check_formats(config['data processing stages'].get('output formats', store.DEFAULT_FORMATS))
+    workers = config['data processing stages'].get('workers', 1)
+    if workers == 'auto':
+        workers = os.cpu_count()
 
     all_keys = assets + daily_interest_rates + monthly_interest_rates
 
@@ -24,31 +76,46 @@ def main(config_file):
         print("\n###")
         print("Running extract.py. Results will be written to ", target_folder)
         print("###")
-        # Extract source data and assemble into input files.
-        if 'BTC' in all_keys:
-            data.extract_BTC_data(source_folder, target_folder)
-        if 'SP500TR' in all_keys:
-            data.extract_SP500TR_data(source_folder, target_folder)
-        if 'SP500' in all_keys:
-            data.extract_SP500_data(source_folder, target_folder)
-        if 'DAX' in all_keys:
-            data.extract_DAX_data(source_folder, target_folder)
-        if 'BRK' in all_keys:
-            data.extract_BRK_data(source_folder, target_folder)
-        if 'FED' in all_keys:
-            data.extract_FED_data(source_folder, target_folder)
-        if 'BOE' in all_keys:
-            data.extract_BOE_data(source_folder, target_folder)
-        if 'FEDM' in all_keys:
-            data.extract_FEDM_data(source_folder, target_folder)
-        if 'IRDE' in all_keys:
-            data.extract_IRDE_data(source_folder, target_folder)
-        if 'DGS10' in all_keys:
-            data.extract_DGS10_data(source_folder, target_folder)
-        if 'MAD' in all_keys:
-            data.extract_Madoff_data(source_folder, target_folder)
-        if 'SMT' in all_keys:
-            data.extract_SMT_data(source_folder, target_folder)
+        unknown = [key for key in all_keys if key not in data.extractors]
+        if unknown:
+            print("  No extractor for: ", ', '.join(unknown))
+        all_keys = [key for key in all_keys if key in data.extractors]
+        # Data sets whose source files and the code reading them are unchanged
+        # since they were last extracted are skipped if the stage cache is
+        # turned on
+        records = manifest.read_manifest(target_folder)
+        keys = {key:manifest.input_hash([source_folder+name for name in data.extractors[key]['source files']]
+                        +manifest.package_files('data', 'source_cache'), formats) for key in all_keys}
+        if config.get('stage cache', False):
+            current = [key for key in all_keys if manifest.is_current(target_folder, records, key, keys[key])]
+            if current:
+                print("  Unchanged since last extracted: ", ', '.join(current))
+            all_keys = [key for key in all_keys if key not in current]
+        start_time = time.time_ns()
+        # Extract source data and assemble into input files. Each data set is
+        # extracted from its own source files, so they can be extracted in
+        # parallel.
+        failures = []
+        if workers > 1 and len(all_keys) > 1:
+            failures = run_parallel(all_keys, source_folder, target_folder, workers, formats)
+        else:
+            extract(all_keys, source_folder, target_folder, formats)
+
+        # Data sets that failed are not recorded, so they are extracted again
+        # next time
+        written = manifest.outputs_since(target_folder, start_time)
+        for key in all_keys:
+            if key not in failures:
+                manifest.record(target_folder, records, key, keys[key],
+                                [os.path.basename(path) for path in store.frame_files(key, formats)
+                                 if os.path.basename(path) in written])
+        manifest.write_manifest(target_folder, records)
+        # Drop the parsed source frames that can no longer be used
+        evicted = source_cache.evict(target_folder)
+        if evicted:
+            print("  Evicted from the source cache: ", ', '.join(evicted))
+        if failures:
+            print("  Extracting failed for: ", ', '.join(failures))
 
 # Execute the main() function
 
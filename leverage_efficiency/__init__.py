@@ -3,4 +3,4 @@
 print("Loading package leverage_efficiency")
 __all__ = ["data", "sme_functions", "figures", "fit_parameters",
         "exp_window", "lopt_var", "fixed_window",
-        "base"]
+        "base", "manifest", "store", "results", "instrument", "source_cache"]
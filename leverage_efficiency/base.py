@@ -8,6 +8,10 @@ def get_config_filename(argv):
     filename='config_default.yaml'
     if len(argv) == 1:
         print("No config file specified. Assuming config_default.yaml")
+    elif argv[1] in ['-h', '--help']:
+        print("Usage: python", os.path.basename(argv[0]), "[config file]")
+        print("The config file defaults to config_default.yaml")
+        exit()
     else:
         filename = argv[1]
         print("Using config file ", filename)
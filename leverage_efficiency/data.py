@@ -1,10 +1,10 @@
 import pandas as pd
 import numpy as np
-import requests
 from io import StringIO
-import yfinance as yf
 import datetime
 from . import base
+from . import source_cache
+from . import store
 import leverage_efficiency.sme_functions as sme
 
 # Functions to open source data files shipping with repository to create
@@ -13,20 +13,35 @@ import leverage_efficiency.sme_functions as sme
 # return a dataframe containing a single 'level' column with a datetime
 # index called 'date'
 
-# There is a problem with dates prior to 1969 being parsed as future dates
-def fix_date(x):
-    if x.year > 2020:
-        year = x.year - 100
-    else:
-        year = x.year
-    return datetime.date(year,x.month,x.day)
+# There is a problem with dates prior to 1969 being parsed as future dates,
+# since two digit years 69-99 are read as 1969-1999 and 00-68 as 2000-2068.
+# Move the dates after 2020 back by a century.
+def fix_century(dates):
+    return dates.mask(dates.dt.year > 2020, dates - pd.DateOffset(years=100))
+
+def read_table(inputfile, skiprows=0, **kwargs):
+    # Read a csv file with the fast C parser, leaving out any footer: the
+    # notes, links and copyright lines some sources append after the table.
+    # These are the lines at the end of the file that are blank or have a
+    # different number of fields from the header.
+    f = open(inputfile, 'rb')
+    lines = f.read().splitlines()[skiprows:]
+    f.close()
+    fields = lines[0].count(b',')
+    end = len(lines)
+    while end > 1 and (not lines[end-1].strip() or lines[end-1].count(b',') != fields):
+        end -= 1
+    # Blank lines within the table are skipped by the parser and not counted
+    rows = sum(1 for line in lines[1:end] if line.strip())
+    return pd.read_csv(inputfile, skiprows=skiprows, nrows=rows, **kwargs)
 
 def standardise_columns(df, date_format, columns=['date','level'], fix_dates=False):
-    # Standardise the column names and index
+    # Standardise the column names and index. Dates are kept as datetime64
+    # throughout and any time of day is dropped.
     df.columns = columns
-    df['date'] = pd.to_datetime(df.date,format=date_format).dt.date
+    df['date'] = pd.to_datetime(df.date,format=date_format).dt.normalize()
     if fix_dates:
-        df['date'] = df['date'].apply(fix_date)
+        df['date'] = fix_century(df['date'])
     df.set_index(pd.DatetimeIndex(df['date']), inplace=True, drop=True)
     df.sort_index(inplace=True)
     df.drop('date', axis=1, inplace=True)
@@ -51,7 +66,7 @@ def standardise_index(df, fill_method='forward fill'):
     df.index = df.index.rename('date')
     return df
 
-def extract_BTC_data(source_folder, target_folder):
+def extract_BTC_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting BTC data.")
     # Bitcoin Price Index from Coindesk
     inputfile1 = source_folder+'BPI_2010-07-18_2018-04-06_Coindesk.csv'
@@ -64,15 +79,15 @@ def extract_BTC_data(source_folder, target_folder):
     # Output files
     outputfile = target_folder+'BTC'
 
-    # Read in the raw data
-    df1 = pd.read_csv(inputfile1, skipfooter=3, engine='python')
-    df2 = pd.read_csv(inputfile2)
-
-    # Standardise the column names and indices
-    df1 = standardise_columns(df1, date_format1)
-    df1 = standardise_index(df1)
-    df2 = standardise_columns(df2, date_format2)
-    df2 = standardise_index(df2)
+    # Read in the raw data and standardise the column names and indices
+    def parse1():
+        df1 = standardise_columns(read_table(inputfile1), date_format1)
+        return standardise_index(df1)
+    def parse2():
+        df2 = standardise_columns(pd.read_csv(inputfile2), date_format2)
+        return standardise_index(df2)
+    df1 = source_cache.cached(target_folder, 'BTC-1', inputfile1, parse1)
+    df2 = source_cache.cached(target_folder, 'BTC-2', inputfile2, parse2)
 
     # Splice these timeseries together at these dates:
     d1 = datetime.date(2014, 9, 16)
@@ -82,10 +97,9 @@ def extract_BTC_data(source_folder, target_folder):
     df3 = pd.concat([ df1.loc[:d1], df2.loc[d2:] ])
 
     # Write output
-    df3.to_csv(outputfile+'.csv')
-    df3.to_pickle(outputfile+'.pkl')
+    store.write_frame(df3, outputfile, formats)
 
-def extract_SP500TR_data(source_folder, target_folder):
+def extract_SP500TR_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting SP500 TR data.")
     # SP500 Total Return index from Yahoo Finance
     inputfile = source_folder+'SP500TR_1988-01-04_2020-04-30_YF.csv'
@@ -94,18 +108,16 @@ def extract_SP500TR_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'SP500TR'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)[['Date','Close']]
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df)
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile)[['Date','Close']], date_format)
+        return standardise_index(df)
+    df = source_cache.cached(target_folder, 'SP500TR', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_SP500_data(source_folder, target_folder):
+def extract_SP500_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting SP500 data.")
     # SP500 index from Yahoo Finance
     inputfile = source_folder+'SP500_1927-12-31_2020-05-14.csv'
@@ -114,18 +126,16 @@ def extract_SP500_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'SP500'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)[['Date','Close']]
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format, fix_dates=True)
-    df = standardise_index(df)
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile)[['Date','Close']], date_format, fix_dates=True)
+        return standardise_index(df)
+    df = source_cache.cached(target_folder, 'SP500', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_DAX_data(source_folder, target_folder):
+def extract_DAX_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting DAX data.")
     # DAX index from Yahoo Finance
     inputfile = source_folder+'DAX_1987-12-30_2020-04-30_YF.csv'
@@ -134,18 +144,16 @@ def extract_DAX_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'DAX'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)[['Date','Close']]
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df)
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile)[['Date','Close']], date_format)
+        return standardise_index(df)
+    df = source_cache.cached(target_folder, 'DAX', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_BRK_data(source_folder, target_folder):
+def extract_BRK_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting BRK data.")
     # Berkshire share price from Yahoo Finance
     inputfile = source_folder+'BRK_1980-03-17_2020-04-30_YF.csv'
@@ -154,16 +162,14 @@ def extract_BRK_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'BRK'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)[['Date','Close']]
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df)
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile)[['Date','Close']], date_format)
+        return standardise_index(df)
+    df = source_cache.cached(target_folder, 'BRK', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
 # OLD: def extract_FED_data(source_folder, target_folder):
 #     print("Extracting FED data.")
@@ -185,7 +191,7 @@ def extract_BRK_data(source_folder, target_folder):
 #     df.to_csv(outputfile+'.csv')
 #     df.to_pickle(outputfile+'.pkl')
 
-def extract_FED_data(source_folder, target_folder):
+def extract_FED_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting FED data.")
     # Federal overnight rates from https://t.co/FDm5p3P828?amp=1
     inputfile1 = source_folder+'FED_1927-12-30_2020-05-14.csv'
@@ -197,15 +203,15 @@ def extract_FED_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'FED'
 
-    # Read in raw data
-    df1 = pd.read_csv(inputfile1,skiprows=5,skipfooter=1,engine='python',usecols=[0,4])
-    df2 = pd.read_csv(inputfile2)
-
-    # Standardise the column names and index
-    df1 = standardise_columns(df1, date_format1)
-    df1 = standardise_index(df1)
-    df2 = standardise_columns(df2, date_format2)
-    df2 = standardise_index(df2)
+    # Read in raw data and standardise the column names and index
+    def parse1():
+        df1 = standardise_columns(read_table(inputfile1,skiprows=5,usecols=[0,4]), date_format1)
+        return standardise_index(df1)
+    def parse2():
+        df2 = standardise_columns(pd.read_csv(inputfile2), date_format2)
+        return standardise_index(df2)
+    df1 = source_cache.cached(target_folder, 'FED-1', inputfile1, parse1)
+    df2 = source_cache.cached(target_folder, 'FED-2', inputfile2, parse2)
 
     #Rates in this data set are quoted as daily percentage returns for trading days.
     #This needs to be converted to annual interest rates in percent.
@@ -222,10 +228,9 @@ def extract_FED_data(source_folder, target_folder):
     df3=pd.concat([df1.loc[:d1],df2.loc[d2:]])
 
     # Write output
-    df3.to_csv(outputfile+'.csv')
-    df3.to_pickle(outputfile+'.pkl')
+    store.write_frame(df3, outputfile, formats)
 
-def extract_FEDM_data(source_folder, target_folder):
+def extract_FEDM_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting FED monthly data.")
     # Federal overnight rates from FRED
     inputfile = source_folder+'FED_1954-07-01_2020-03-01-FRED.csv'
@@ -234,18 +239,16 @@ def extract_FEDM_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'FEDM'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df, fill_method='interpolate')
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile), date_format)
+        return standardise_index(df, fill_method='interpolate')
+    df = source_cache.cached(target_folder, 'FEDM', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_DGS10_data(source_folder, target_folder):
+def extract_DGS10_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting DGS10 data.")
     # 10-Year Treasury Constant Maturity Rates from FRED
     inputfile = source_folder+'DGS10_1962-01-02_2020-05-07_FRED.csv'
@@ -254,23 +257,24 @@ def extract_DGS10_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'DGS10'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)
+    def parse():
+        # Read in raw data
+        df = pd.read_csv(inputfile)
 
-    # This data file contains some '.'s in the level column that need to be
-    # filtered out
-    df = df[~(df['DGS10']=='.')]
-    df['DGS10'] = df['DGS10'].astype(float)
+        # This data file contains some '.'s in the level column that need to be
+        # filtered out
+        df = df[~(df['DGS10']=='.')]
+        df['DGS10'] = df['DGS10'].astype(float)
 
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df, fill_method='forward fill')
+        # Standardise the column names and index
+        df = standardise_columns(df, date_format)
+        return standardise_index(df, fill_method='forward fill')
+    df = source_cache.cached(target_folder, 'DGS10', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_BOE_data(source_folder, target_folder):
+def extract_BOE_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting BOE data.")
     # Bank of England official bank rate
     inputfile = source_folder+'Bank Rate history and data Bank of England Database.csv'
@@ -279,23 +283,21 @@ def extract_BOE_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'BOE'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)
-
     # This data file contains some '.'s in the level column that need to be
     # filtered out
     #df = df[~(df['DGS10']=='.')]
     #df['DGS10'] = df['DGS10'].astype(float)
 
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df, fill_method='forward fill')
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile), date_format)
+        return standardise_index(df, fill_method='forward fill')
+    df = source_cache.cached(target_folder, 'BOE', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_IRDE_data(source_folder, target_folder):
+def extract_IRDE_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting German IR data.")
     # SP500 Total Return index from Yahoo Finance
     inputfile = source_folder+'IRDE_1960-01-01_2020-03-01-FRED.csv'
@@ -304,18 +306,16 @@ def extract_IRDE_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'IRDE'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile)
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format)
-    df = standardise_index(df, fill_method='interpolate')
+    # Read in raw data and standardise the column names and index
+    def parse():
+        df = standardise_columns(pd.read_csv(inputfile), date_format)
+        return standardise_index(df, fill_method='interpolate')
+    df = source_cache.cached(target_folder, 'IRDE', inputfile, parse)
 
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_Madoff_data(source_folder, target_folder):
+def extract_Madoff_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting Madoff data.")
     # Madoff data
     inputfile = source_folder+'MAD_1990-01-01_2005-05-01_DU.csv'
@@ -324,11 +324,10 @@ def extract_Madoff_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'MAD'
 
-    # Read in raw data
-    df = pd.read_csv(inputfile, header=None)
-
-    # Standardise the column names and index
-    df = standardise_columns(df, date_format, columns=['date','return'])
+    # Read in raw data and standardise the column names and index
+    def parse():
+        return standardise_columns(pd.read_csv(inputfile, header=None), date_format, columns=['date','return'])
+    df = source_cache.cached(target_folder, 'MAD', inputfile, parse)
 
     # This data file doesn't contain prices, only percentage returns so
     # we will not need to calculate returns at the next pipeline
@@ -336,10 +335,9 @@ def extract_Madoff_data(source_folder, target_folder):
     # returns:
     df['return'] = df['return']/100.0+1.0
     # Write output
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def extract_SMT_data(source_folder, target_folder):
+def extract_SMT_data(source_folder, target_folder, formats=store.DEFAULT_FORMATS):
     print("  Extracting SMT data.")
     # SMT Total Return data from BG
     inputfile1 = source_folder+'SMT_1964-12-30_2022-03-31.xlsx'
@@ -350,18 +348,20 @@ def extract_SMT_data(source_folder, target_folder):
     # Output file
     outputfile = target_folder+'SMT'
 
-    # Read in raw data
-    xl = pd.ExcelFile(str(inputfile1))
-    df1 = xl.parse('Sheet1', header=2)
-    df2 = pd.read_csv(inputfile2)
-    df1.drop(['Unnamed: 0','Unnamed: 3', 'Unnamed: 4', 'Unnamed: 5'], axis=1, inplace=True)
-    df1.rename(columns={'Name':'date', 'SCOTTISH MORTGAGE':'level'}, inplace=True)
-
-    # Standardise the column names and index
-    df1 = standardise_columns(df1, date_format1)
-    df1 = standardise_index(df1)
-    df2 = standardise_columns(df2[['Date','Adj Close']], date_format2)
-    df2 = standardise_index(df2)
+    # Read in raw data and standardise the column names and index. The
+    # spreadsheet is slow to parse, so the cached frame saves most of the time.
+    def parse1():
+        xl = pd.ExcelFile(str(inputfile1))
+        df1 = xl.parse('Sheet1', header=2)
+        df1.drop(['Unnamed: 0','Unnamed: 3', 'Unnamed: 4', 'Unnamed: 5'], axis=1, inplace=True)
+        df1.rename(columns={'Name':'date', 'SCOTTISH MORTGAGE':'level'}, inplace=True)
+        df1 = standardise_columns(df1, date_format1)
+        return standardise_index(df1)
+    def parse2():
+        df2 = standardise_columns(pd.read_csv(inputfile2)[['Date','Adj Close']], date_format2)
+        return standardise_index(df2)
+    df1 = source_cache.cached(target_folder, 'SMT-1', inputfile1, parse1)
+    df2 = source_cache.cached(target_folder, 'SMT-2', inputfile2, parse2)
 
 
     # Splice these timeseries together at these dates:
@@ -377,19 +377,46 @@ def extract_SMT_data(source_folder, target_folder):
 
 
     # Write output
-    df2.to_csv(outputfile+'.csv')
-    df2.to_pickle(outputfile+'.pkl')
+    store.write_frame(df2, outputfile, formats)
 
     #Note: we're not splicing the two data sets together here because they are incompatible.
     #it's unclear what the adjusted prices in the BG data set are, so restricting to yahoo! here.
     #We're ignoring the BG data set for now (it's only 4 more years that yahoo!).
 
+# Extractors of the data sets that can be listed in the data processing stages
+# of the config file: the source files each one reads from the source data
+# folder and the function that extracts it. The extract stage runs the
+# extractors independently of each other, so a new data set only needs an
+# entry here. A data set is only extracted again when one of its source files
+# (or the extraction code) has changed.
+extractors = {
+    'BTC' : {'source files':['BPI_2010-07-18_2018-04-06_Coindesk.csv', 'BTC-USD_2014-09-17_2020-05-01_YF.csv'],
+             'function':extract_BTC_data},
+    'SP500TR' : {'source files':['SP500TR_1988-01-04_2020-04-30_YF.csv'], 'function':extract_SP500TR_data},
+    'SP500' : {'source files':['SP500_1927-12-31_2020-05-14.csv'], 'function':extract_SP500_data},
+    'DAX' : {'source files':['DAX_1987-12-30_2020-04-30_YF.csv'], 'function':extract_DAX_data},
+    'BRK' : {'source files':['BRK_1980-03-17_2020-04-30_YF.csv'], 'function':extract_BRK_data},
+    'FED' : {'source files':['FED_1927-12-30_2020-05-14.csv', 'FED_1954-07-01_2020-03-01-FRED.csv'],
+             'function':extract_FED_data},
+    'BOE' : {'source files':['Bank Rate history and data Bank of England Database.csv'], 'function':extract_BOE_data},
+    'FEDM' : {'source files':['FED_1954-07-01_2020-03-01-FRED.csv'], 'function':extract_FEDM_data},
+    'IRDE' : {'source files':['IRDE_1960-01-01_2020-03-01-FRED.csv'], 'function':extract_IRDE_data},
+    'DGS10' : {'source files':['DGS10_1962-01-02_2020-05-07_FRED.csv'], 'function':extract_DGS10_data},
+    'MAD' : {'source files':['MAD_1990-01-01_2005-05-01_DU.csv'], 'function':extract_Madoff_data},
+    'SMT' : {'source files':['SMT_1964-12-30_2022-03-31.xlsx', 'SMT.L.csv'], 'function':extract_SMT_data},
+    }
+
+def extract(key, source_folder, target_folder, formats=store.DEFAULT_FORMATS):
+    # Extract one data set with its registered extractor. Used to run the
+    # extractors on worker processes, which only need the key.
+    extractors[key]['function'](source_folder, target_folder, formats)
+
 
 # Functions to transform intermediate data into input format
-def prepare_input_asset_data(source_folder, target_folder, tag):
-    inputfile = source_folder+tag+'.pkl'
+def prepare_input_asset_data(source_folder, target_folder, tag, formats=store.DEFAULT_FORMATS):
+    inputfile = source_folder+tag
     outputfile = target_folder+tag
-    df = pd.read_pickle(inputfile)
+    df = store.read_frame(inputfile)
 
     # If return is not already present, calculate it and add it as a new column
     if not 'return' in df.columns:
@@ -406,13 +433,12 @@ def prepare_input_asset_data(source_folder, target_folder, tag):
         print(" ", tag, ": Input data checks passed.")
 
     # Save the data
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-def prepare_input_interest_rate_data(source_folder, target_folder, tag, freq='daily'):
-    inputfile = source_folder+tag+'.pkl'
+def prepare_input_interest_rate_data(source_folder, target_folder, tag, freq='daily', formats=store.DEFAULT_FORMATS):
+    inputfile = source_folder+tag
     outputfile = target_folder+tag
-    df = pd.read_pickle(inputfile)
+    df = store.read_frame(inputfile)
 
     # For interest rate data, the 'level' is assumed to be quoted as an annual
     # rate of return. Convert these annual rates to daily returns
@@ -433,11 +459,12 @@ def prepare_input_interest_rate_data(source_folder, target_folder, tag, freq='da
 
 
     # Save the data
-    df.to_csv(outputfile+'.csv')
-    df.to_pickle(outputfile+'.pkl')
+    store.write_frame(df, outputfile, formats)
 
-# Functions to download new data to update
+# Functions to download new data to update. yfinance and requests are
+# imported by these functions only, as nothing else in the pipeline needs them
 def download_yahoo(tickers, end_date=None):
+    import yfinance as yf
     data = {}
     for t in tickers:
         print("  Downloading data for ", t)
@@ -454,6 +481,7 @@ def download_yahoo(tickers, end_date=None):
     return df
 
 def download_csv(data_url, old_column_names, new_column_names, header=0):
+    import requests
     req = requests.get(data_url, verify=False)
     data = pd.read_csv(StringIO(req.text), header=header)
     df=data[old_column_names]
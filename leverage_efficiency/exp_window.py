@@ -5,17 +5,20 @@ Created on Fri Jan 26 11:17:05 2018
 
 @author: obp48
 """
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from . import sme_functions as sm
 from . import base
+from . import store
+from . import instrument
+from . import solver_stats
 import datetime as dt
-import scipy.optimize
 import time
 import pickle
 
-def expanding_window_fits(data_folder, analysis_folder, pair, initial_window_size=10):
+@instrument.measured('expanding')
+def expanding_window_fits(data_folder, analysis_folder, pair, initial_window_size=10, models=None, append=False,
+                          pickle_export=False, solver_statistics=False):
     print('  expanding_window_fits() : ', pair)
     # Extract the individual asset codes from the asset pair
     asset1 = pair.split('-')[0]
@@ -29,28 +32,49 @@ def expanding_window_fits(data_folder, analysis_folder, pair, initial_window_siz
     properties = base.set_pair_properties('modify-defaults/', pair)
 
     # Read returns data for both assets
-    in_file_1=data_folder+asset1+".pkl" #risky
-    in_file_2=data_folder+asset2+".pkl" #riskless
-    start_date, end_date, rel_ret_1, rel_ret_2 = sm.get_returns_data(in_file_1, in_file_2, properties)
+    in_file_1=data_folder+asset1 #risky
+    in_file_2=data_folder+asset2 #riskless
+    returns = sm.get_returns_pair(in_file_1, in_file_2, properties)
+    start_date, end_date = returns.start_date, returns.end_date
 
-    date1 = rel_ret_1.index[initial_window_size]
+    date1 = returns.dates[initial_window_size]
     window_end_list = pd.date_range(start=date1,end=end_date)
 
-    for model in properties['models']:
+    # All models set for the pair are run unless a subset is given
+    if models is None:
+        models = properties['models']
+    for model in models:
     #for model in [1]:
         print('  expanding_window_fits() : ', pair, 'model '+str(model))
-        date1 = rel_ret_1.index[initial_window_size]
+        date1 = returns.dates[initial_window_size]
         lopt=pd.Series(index=pd.date_range(start=date1,end=end_date))
-        for date1 in window_end_list:
-            time_window=[start_date,date1]
-            value, equity = sm.calculate_optimal_leverage(rel_ret_1,rel_ret_2,time_window,
-                            model, params[asset1])
-            lopt[date1]=value
-        outfile = analysis_folder+pair+'-'+str(model)+'_lopt_exp.pkl'
-        lopt.to_pickle(outfile)
+        outfile = analysis_folder+pair+'-'+str(model)+'_lopt_exp'
+        # In append mode the windows ending on dates already in the saved
+        # results are kept, and only those ending on new dates are solved
+        new_ends = window_end_list
+        previous = None
+        if append:
+            previous = sm.previous_results(outfile, lopt.index)
+        if previous is not None:
+            print('  Extending results from', previous.index[-1])
+            lopt[previous.index]=previous
+            new_ends = window_end_list[len(previous):]
+        if len(new_ends)>0:
+            # Each window differs from the previous one by a single sample, so
+            # the windows are solved incrementally rather than one at a time
+            starts, ends = returns.windows([start_date],new_ends)
+            if solver_statistics:
+                solver_stats.start()
+            values, equity = sm.expanding_optimal_leverage(returns,starts[0],ends,
+                                model, params[asset1], from_shortest=previous is not None)
+            if solver_statistics:
+                solver_stats.write(analysis_folder+pair+'-'+str(model)+'_solver_exp', returns.dates)
+            lopt[new_ends]=values
+        store.save(lopt, outfile, pickle_export)
 
 
 
-def main(data_folder, analysis_folder, pairs):
+def main(data_folder, analysis_folder, pairs, append=False, pickle_export=False, solver_statistics=False):
     for pair in pairs:
-        expanding_window_fits(data_folder, analysis_folder, pair, 10)
+        expanding_window_fits(data_folder, analysis_folder, pair, 10, append=append, pickle_export=pickle_export,
+                              solver_statistics=solver_statistics)
@@ -3,8 +3,13 @@ import matplotlib.ticker as mticker
 import numpy as np
 import pandas as pd
 import pickle
+from . import results
+from . import sme_functions as sm
 from datetime import datetime
-from scipy.stats import norm
+
+# Leverages whose equity trajectories are plotted for the pairs that cannot
+# use the default ones
+TRAJECTORY_LEVERAGES = {'BTC-FED':[0.5,1.0,1.3,2.3]}
 
 def standard_plot(dataframe, columns, labels, ratio=1.0):
     # Create figure and axes objects for plotting to
@@ -26,15 +31,12 @@ def fig_exp_window(analysis_folder, pair):
     print('Figure: fig_exp_window() : '+pair)
 
     # Read in optimal leverage values for this asset pair
-    lopt_1=pd.read_pickle(analysis_folder+pair+"-1_lopt_exp.pkl")
-    lopt_2=pd.read_pickle(analysis_folder+pair+"-2_lopt_exp.pkl")
-    lopt_3=pd.read_pickle(analysis_folder+pair+"-3_lopt_exp.pkl")
+    lopt_1=results.load(analysis_folder+pair+"-1_lopt_exp")
+    lopt_2=results.load(analysis_folder+pair+"-2_lopt_exp")
+    lopt_3=results.load(analysis_folder+pair+"-3_lopt_exp")
 
     # Read in parameter information for this asset pair
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     sigma=parameters['sigma_est']
     l_max=parameters['max_leverage']
     l_min=parameters['min_leverage']
@@ -64,15 +66,12 @@ def fig_exp_window_significance(analysis_folder, pair):
     print('Figure: fig_exp_window_significance() : '+pair)
 
     # Read in optimal leverage values for this asset pair
-    lopt_1=pd.read_pickle(analysis_folder+pair+"-1_lopt_exp.pkl")
-#    lopt_2=pd.read_pickle(analysis_folder+pair+"-2_lopt_exp.pkl")
-#    lopt_3=pd.read_pickle(analysis_folder+pair+"-3_lopt_exp.pkl")
+    lopt_1=results.load(analysis_folder+pair+"-1_lopt_exp")
+#    lopt_2=results.load(analysis_folder+pair+"-2_lopt_exp")
+#    lopt_3=results.load(analysis_folder+pair+"-3_lopt_exp")
 
     # Read in parameter information for this asset pair
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     sigma=parameters['sigma_est']
     l_max=parameters['max_leverage']
     l_min=parameters['min_leverage']
@@ -87,6 +86,7 @@ def fig_exp_window_significance(analysis_folder, pair):
 #    plt.plot(lopt_1.index,1-2./np.sqrt(sigma*sigma*(lopt_1.index-lopt_1.index[0]).days/365.25),color='pink',linestyle=':')
 #    plt.plot(lopt_1, label='simple')
     z_score=(lopt_1-1)*np.sqrt(sigma*sigma*(lopt_1.index-lopt_1.index[0]).days/365.25)
+    from scipy.stats import norm
     exceedance_probability=1 - norm.cdf(z_score)
     plt.plot(z_score)
 #    plt.plot(lopt_1.index,exceedance_probability)
@@ -103,47 +103,12 @@ def fig_exp_window_significance(analysis_folder, pair):
 
 def fig_compare_assets(analysis_folder, plots_folder):
     print('Figure: fig_compare_assets() : ')
-    # Read in returns
-    returns_1=pd.read_pickle(analysis_folder+"MAD-FEDM-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+"SP500TR-FED-1.pkl")
-    returns_3=pd.read_pickle(analysis_folder+"DAX-IRDE-1.pkl")
-    returns_4=pd.read_pickle(analysis_folder+"BTC-FED-1.pkl")
-    returns_5=pd.read_pickle(analysis_folder+"BRK-DGS10-1.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-    final_equity_4=np.cumprod(returns_4)[-1:].T
-    final_equity_5=np.cumprod(returns_5)[-1:].T
-#
-    filename = analysis_folder+'MAD-FEDM_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['MAD-FEDM']
-    f.close()
-    years_1=parameters['years']
-
-    filename = analysis_folder+'SP500TR-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['SP500TR-FED']
-    f.close()
-    years_2=parameters['years']
-
-    filename = analysis_folder+'DAX-IRDE_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['DAX-IRDE']
-    f.close()
-    years_3=parameters['years']
-
-    filename = analysis_folder+'BTC-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['BTC-FED']
-    f.close()
-    years_4=parameters['years']
-
-    filename = analysis_folder+'BRK-DGS10_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['BRK-DGS10']
-    f.close()
-    years_5=parameters['years']
+    # Read in final equity summaries
+    grid_1=sm.GridResult(analysis_folder, "MAD-FEDM", 1)
+    grid_2=sm.GridResult(analysis_folder, "SP500TR-FED", 1)
+    grid_3=sm.GridResult(analysis_folder, "DAX-IRDE", 1)
+    grid_4=sm.GridResult(analysis_folder, "BTC-FED", 1)
+    grid_5=sm.GridResult(analysis_folder, "BRK-DGS10", 1)
 
     # Create plot
     fig=plt.figure()
@@ -151,11 +116,11 @@ def fig_compare_assets(analysis_folder, plots_folder):
     # Add lines to plot
     plt.axvline(x=1,linestyle=':',color='red',linewidth=.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    plt.plot(np.log(final_equity_1)/years_1,label='Madoff',linewidth=2,color='green')
-    plt.plot(np.log(final_equity_5)/years_5,label='Berkshire Hathaway',linewidth=2,color='magenta')
-    plt.plot(np.log(final_equity_2)/years_2,label='S&P500TR',linewidth=2,color='blue')
-    plt.plot(np.log(final_equity_3)/years_3,label='DAX',linewidth=2,color='orange')
-    plt.plot(np.log(final_equity_4)/years_4,label='Bitcoin',linewidth=2,color='red')
+    plt.plot(grid_1.growth_curve(),label='Madoff',linewidth=2,color='green')
+    plt.plot(grid_5.growth_curve(),label='Berkshire Hathaway',linewidth=2,color='magenta')
+    plt.plot(grid_2.growth_curve(),label='S&P500TR',linewidth=2,color='blue')
+    plt.plot(grid_3.growth_curve(),label='DAX',linewidth=2,color='orange')
+    plt.plot(grid_4.growth_curve(),label='Bitcoin',linewidth=2,color='red')
     # Add remaining plot details
     plt.xlim([-35,110])
     plt.ylim([-4,5])
@@ -169,23 +134,13 @@ def fig_compare_assets(analysis_folder, plots_folder):
 
 def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
     print('Figure: fig_growth_vs_leverage() : '+pair)
-    # Read in optimal leverage values for this asset pair
-    returns_1=pd.read_pickle(analysis_folder+pair+"-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+pair+"-2.pkl")
-    returns_3=pd.read_pickle(analysis_folder+pair+"-3.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-    equity_1=np.cumprod(returns_1)
-    equity_2=np.cumprod(returns_2)
-    equity_3=np.cumprod(returns_3)
+    # Read in final equity summaries for this asset pair
+    grid_1=sm.GridResult(analysis_folder, pair, 1)
+    grid_2=sm.GridResult(analysis_folder, pair, 2)
+    grid_3=sm.GridResult(analysis_folder, pair, 3)
     #
     # Read in parameter information for this asset pair
-    #filename = analysis_folder+'parameters_'+pair+'.pkl'
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     years=parameters['years']
     sigma=parameters['sigma_est']
     mu_e=parameters['mu_excess_est']
@@ -202,11 +157,11 @@ def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
     plt.axvline(x=1+2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axvline(x=1-2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    (np.log(final_equity_1.iloc[:,0].astype(float))/years).plot(label='simple', linewidth=5, color='blue')
-    (np.log(final_equity_2.iloc[:,0].astype(float))/years).plot(label='+ friction', linewidth=3, color='orange')
-    (np.log(final_equity_3.iloc[:,0].astype(float))/years).plot(label='+ borrowing premia', linewidth=1, color='green')
-    plt.plot(final_equity_1.index,\
-              (mu_r+mu_e*final_equity_1.index-sigma**2*final_equity_1.index**2/2),\
+    grid_1.growth_curve().plot(label='simple', linewidth=5, color='blue')
+    grid_2.growth_curve().plot(label='+ friction', linewidth=3, color='orange')
+    grid_3.growth_curve().plot(label='+ borrowing premia', linewidth=1, color='green')
+    plt.plot(grid_1.leverages(),\
+              (mu_r+mu_e*grid_1.leverages()-sigma**2*grid_1.leverages()**2/2),\
               linestyle="--",linewidth=4, color='red')
     # Add remaining plot details
     plt.xlim([-9,12])
@@ -223,23 +178,13 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
     print('Figure: fig_final_equity() : '+pair)
 
     # Read in parameter information for this asset pair
-    #filename = analysis_folder+'parameters_'+pair+'.pkl'
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     st_err=parameters['lopt_error']
 
-    # Read in optimal leverage values for this asset pair
-    returns_1=pd.read_pickle(analysis_folder+pair+"-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+pair+"-2.pkl")
-    returns_3=pd.read_pickle(analysis_folder+pair+"-3.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-    equity_1=np.cumprod(returns_1)
-    equity_2=np.cumprod(returns_2)
-    equity_3=np.cumprod(returns_3)
+    # Read in final equity summaries for this asset pair
+    grid_1=sm.GridResult(analysis_folder, pair, 1)
+    grid_2=sm.GridResult(analysis_folder, pair, 2)
+    grid_3=sm.GridResult(analysis_folder, pair, 3)
 
     # Create plot
     fig=plt.figure()
@@ -249,9 +194,9 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
     plt.axvline(x=1+2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axvline(x=1-2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    plt.plot(final_equity_1, label='Simple',linewidth=5)
-    plt.plot(final_equity_2, label='+ friction',linewidth=3)
-    plt.plot(final_equity_3, label='+ borrowing premia',linewidth=1)
+    plt.plot(grid_1.final_equity(), label='Simple',linewidth=5)
+    plt.plot(grid_2.final_equity(), label='+ friction',linewidth=3)
+    plt.plot(grid_3.final_equity(), label='+ borrowing premia',linewidth=1)
     # Add remaining plot details
     # #plt.xlim([final_equity_1.index.min(),final_equity_1.index.max()])
     plt.xlim([-2,6])
@@ -262,22 +207,25 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
 
 def fig_equity_trajectories(analysis_folder, plots_folder, pair):
     print('Figure: fig_equity_trajectories() : '+pair)
-    # Read in equity data
-    returns=pd.read_pickle(analysis_folder+pair+'-1.pkl')
-    equity=np.cumprod(returns)
+    # Equity over time for the leverages plotted, calculated for just
+    # those leverage values. Pairs with a narrow solvent range have leverages
+    # of their own; any still outside it are moved to its edge.
+    grid=sm.GridResult(analysis_folder, pair, 1)
+    leverages=TRAJECTORY_LEVERAGES.get(pair, [-0.3,1.0,1.8,4.2])
+    equity=grid.trajectory(grid.solvent(leverages))
     final_equity=equity[-1:].T
     #
     # #### equity trajectories ####
     fig=plt.figure()
     ax = plt.axes()
     # Add lines to plot
-    Delta_t=returns.index[-1] - returns.index[0]
+    Delta_t=equity.index[-1] - equity.index[0]
     years=Delta_t.days/365.25
 #    equity.iloc[:,99].plot(label='l='+str(round(equity.columns[99],2)))
-    equity.iloc[:,263].plot(label='l='+str(round(equity.columns[263],1)))
-    equity.iloc[:,320].plot(label='l='+str(round(equity.columns[320],1)))
-    equity.iloc[:,357].plot(label='l='+str(round(equity.columns[357],1)))
-    equity.iloc[:,467].plot(label='l='+str(round(equity.columns[467],1)))
+    equity.iloc[:,0].plot(label='l='+str(round(equity.columns[0],1)))
+    equity.iloc[:,1].plot(label='l='+str(round(equity.columns[1],1)))
+    equity.iloc[:,2].plot(label='l='+str(round(equity.columns[2],1)))
+    equity.iloc[:,3].plot(label='l='+str(round(equity.columns[3],1)))
     # Add remaining plot details
     ax.set_yscale('log')
     plt.xlabel('')
@@ -293,15 +241,11 @@ def fig_lopt_var(analysis_folder, plots_folder, pairs):
     lopt_var={}
     for pair in pairs:
         # Read in parameter information for this asset pair
-        #filename = analysis_folder+'parameters_'+pair+'.pkl'
-        filename = analysis_folder+pair+'_prm.pkl'
-        f=open(filename, 'rb')
-        parameters = pickle.load(f)[pair]
-        f.close()
+        parameters = results.parameters(analysis_folder, pair)
         sigma[pair]=parameters['sigma_est']
 
         # Read in leverage data
-        lopt_var[pair]=pd.read_pickle(analysis_folder+pair+"_lopt_var.pkl")
+        lopt_var[pair]=results.load(analysis_folder+pair+"_lopt_var")
 
     # Create plot
     fig=plt.figure()
@@ -326,7 +270,7 @@ def fig_leverage_vary_window(analysis_folder, plots_folder, pair, model):
     print('Figure: fig_leverage_vary_window() : '+pair)
     # Read in optimal leverage data for different window lengths
     #df=pd.read_pickle(analysis_folder+pair+'-'+str(model)+'_lopt_fixed_clean.pkl')
-    df=pd.read_pickle(analysis_folder+pair+'-'+str(model)+'_lopt_fixed.pkl')
+    df=results.load(analysis_folder+pair+'-'+str(model)+'_lopt_fixed')
 
     #
     # Create plot
@@ -34,22 +34,40 @@ def write_tex(pair, fit_parameters, tex):
               +'#lopt_error:\t'+str(round(float(fit_parameters['lopt_error']),2))+'\n')
     tex.write("\n")
 
-def main(data_folder, analysis_folder, pairs):
-    tex=open(analysis_folder+'numbers.txt', 'w')
-    for pair in pairs:
-        # Actual parameter fitting gets done here:
-        results = sm.fit_parameters(data_folder, analysis_folder, pair)
+def save_results(analysis_folder, pair, results, tex):
+    # Write fitted parameters to a text file that can be read easily
+    write_tex(pair, results, tex)
 
-        # Write fitted parameters to a text file that can be read easily
-        write_tex(pair, results, tex)
+    # Organise the results into a dataframe
+    fit_parameters=pd.DataFrame.from_dict(results,orient='index').rename(columns={0:pair})
 
-        # Organise the results into a dataframe
-        fit_parameters=pd.DataFrame.from_dict(results,orient='index').rename(columns={0:pair})
+    # Write dataframe with fitted parameters to a file for later use
+    filename = analysis_folder+pair+'_prm.pkl'
+    f=open(filename, 'wb')
+    pickle.dump(fit_parameters, f)
+    f.close()
 
-        # Write dataframe with fitted parameters to a file for later use
-        filename = analysis_folder+pair+'_prm.pkl'
-        f=open(filename, 'wb')
-        pickle.dump(fit_parameters, f)
-        f.close()
+def load_results(analysis_folder, pair):
+    # Read back the fitted parameters saved for a pair
+    filename = analysis_folder+pair+'_prm.pkl'
+    f=open(filename, 'rb')
+    results = pickle.load(f)[pair].to_dict()
+    f.close()
+    return results
+
+def write_numbers(analysis_folder, pairs):
+    # Rewrite numbers.txt from the fitted parameters saved for each pair, for
+    # when only some of the pairs have been fitted again
+    tex=open(analysis_folder+'numbers.txt', 'w')
+    for pair in pairs:
+        write_tex(pair, load_results(analysis_folder, pair), tex)
+    tex.close()
+
+def main(data_folder, analysis_folder, pairs, solver_statistics=False):
+    tex=open(analysis_folder+'numbers.txt', 'w')
+    for pair in pairs:
+        # Actual parameter fitting gets done here:
+        results = sm.fit_parameters(data_folder, analysis_folder, pair, solver_statistics)
+        save_results(analysis_folder, pair, results, tex)
 
     tex.close()
@@ -4,14 +4,14 @@
 Created on Fri Jan 26 11:17:05 2018
 @author: obp48
 """
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from . import base
 from . import sme_functions as sm
+from . import store
+from . import instrument
+from . import solver_stats
 import datetime as dt
-import scipy.optimize
-#from scipy.optimize import minimize
 import time
 import pickle
 
@@ -37,17 +37,19 @@ def my_log_range(start, end, n):
     # Done
     return values
 
-def determine_reasonable_window_lengths(ret):
+def determine_reasonable_window_lengths(dates):
     print("  Attempting to determine reasonable window lengths.")
-    data_start_date = ret.index[0]
-    data_end_date = ret.index[-1]
+    data_start_date = dates[0]
+    data_end_date = dates[-1]
     years = len(pd.date_range(start=data_start_date,end=data_end_date,freq='Y'))
     w_min = 1.0
     w_max = my_log_round(years/2.0)
     return my_log_range(w_min, w_max, 4)
 
 
-def lopt_fixed_window_size(data_folder, analysis_folder, pair):
+@instrument.measured('fixed')
+def lopt_fixed_window_size(data_folder, analysis_folder, pair, models=None, append=False, pickle_export=False,
+                           solver_statistics=False):
     print('  lopt_fixed_window_size() : ', pair)
     # Extract the individual asset codes from the asset pair
     asset1 = pair.split('-')[0]
@@ -61,33 +63,60 @@ def lopt_fixed_window_size(data_folder, analysis_folder, pair):
     properties = base.set_pair_properties('modify-defaults/', pair)
 
     # Read returns data for both assets
-    in_file_1=data_folder+asset1+".pkl" #risky
-    in_file_2=data_folder+asset2+".pkl" #riskless
-    min_start_date, max_end_date, rel_ret_1, rel_ret_2 = sm.get_returns_data(in_file_1, in_file_2, properties)
+    in_file_1=data_folder+asset1 #risky
+    in_file_2=data_folder+asset2 #riskless
+    returns = sm.get_returns_pair(in_file_1, in_file_2, properties)
+    min_start_date, max_end_date = returns.start_date, returns.end_date
 
 
     if properties['windows'] == 'auto':
-        window_list_years = determine_reasonable_window_lengths(rel_ret_1)
+        window_list_years = determine_reasonable_window_lengths(returns.dates)
     else:
         window_list_years = properties['windows']
     window_list = [ x * 365.0 for x in window_list_years ]
 
-    for model in properties['models']:
-        lopt=pd.DataFrame(index=pd.date_range(start=min_start_date,end=max_end_date),columns=window_list)
+    # All models set for the pair are run unless a subset is given
+    if models is None:
+        models = properties['models']
+    dates=pd.date_range(start=min_start_date,end=max_end_date)
+    for model in models:
+        # Results are collected in a preallocated float64 array, one column
+        # per window length, and only turned into a DataFrame to be saved
+        lopt=np.full((len(dates),len(window_list)),np.nan)
+        outfile = analysis_folder+pair+'-'+str(model)+'_lopt_fixed'
+        # In append mode the saved results for the same window lengths are
+        # kept, and only the windows ending on new dates are solved
+        last_date = None
+        if append:
+            previous = sm.previous_results(outfile, dates, window_list)
+            if previous is not None:
+                print('  Extending results from', previous.index[-1])
+                lopt[:len(previous)] = previous.values
+                last_date = previous.index[-1]
         print('  lopt_fixed_window_size() : ', pair, 'model '+str(model))
-        for window in window_list:
+        if solver_statistics:
+            solver_stats.start()
+        for column, window in enumerate(window_list):
             print('    window = ',window)
             size=dt.timedelta(days=window)
             start_list = pd.date_range(start=min_start_date,freq='D',end=max_end_date-dt.timedelta(days=window))
-            for window_start in start_list:
-                time_window=[window_start,window_start+size]
-                value, equity = sm.calculate_optimal_leverage(rel_ret_1,rel_ret_2,
-                        time_window, model, params[asset1])
-                lopt.loc[window_start+size,window]=value
-        outfile = analysis_folder+pair+'-'+str(model)+'_lopt_fixed.pkl'
-        lopt.to_pickle(outfile)
+            if last_date is not None:
+                start_list = start_list[start_list+size>last_date]
+            if len(start_list)==0:
+                continue
+            # Neighbouring windows share almost all of their samples, so the
+            # windows of this size are solved as one rolling sequence
+            positions=returns.windows(start_list,start_list+size)
+            values, equity = sm.sliding_optimal_leverage(returns,
+                    *positions, model, params[asset1])
+            lopt[dates.get_indexer(start_list+size),column]=values
+        if solver_statistics:
+            solver_stats.write(analysis_folder+pair+'-'+str(model)+'_solver_fixed', returns.dates)
+        lopt=pd.DataFrame(lopt,index=dates,columns=window_list)
+        store.save(lopt, outfile, pickle_export)
 
 
-def main(data_folder, analysis_folder, pairs):
+def main(data_folder, analysis_folder, pairs, append=False, pickle_export=False, solver_statistics=False):
     for pair in pairs:
-        lopt_fixed_window_size(data_folder, analysis_folder, pair)
+        lopt_fixed_window_size(data_folder, analysis_folder, pair, append=append, pickle_export=pickle_export,
+                               solver_statistics=solver_statistics)
@@ -0,0 +1,207 @@
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+
+# Instrumentation of a pipeline run, turned on with 'run report: True' in the
+# config file. Each measured step (a stage, an analysis sub-stage of a pair or
+# a figure) is recorded with its wall time, CPU time, peak resident memory and
+# the bytes read and written, and workflow.py writes the records to a run
+# report. When the instrumentation is off, measuring a step costs a single
+# check of the enabled flag.
+#
+# Steps can be nested: a figure is measured inside the plots stage. Labels
+# that a step does not set are taken from the step it is nested in. Steps
+# run on worker processes are measured there and their records added to the
+# records of the main process, inside the step that started the workers.
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPORT_FILE = 'run_report'
+FIELDS = ['stage', 'step', 'pair', 'item', 'start', 'wall seconds', 'cpu seconds', 'peak rss MB',
+          'bytes read', 'bytes written', 'process']
+
+enabled = False
+records = []
+started = None
+stack = []
+
+def enable():
+    global enabled, started
+    enabled = True
+    if started is None:
+        started = time.time()
+
+def read_proc(name, keys):
+    # Values of some of the keys of a file in /proc/self, or None where they
+    # cannot be read (on systems other than Linux)
+    values = {}
+    try:
+        f = open('/proc/self/'+name, 'r')
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in keys:
+                values[key] = int(value.split()[0])
+        f.close()
+    except OSError:
+        return None
+    return values
+
+def maxrss_MB(who):
+    # Largest resident memory so far of this process or of its terminated
+    # children, from getrusage
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss/2**20 if sys.platform == 'darwin' else maxrss/2**10
+
+def reset_peak():
+    # Reset the peak resident memory of this process to its current size, so
+    # that the peak of each step can be read separately (Linux only)
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        f.write('5')
+        f.close()
+        return True
+    except OSError:
+        return False
+
+def peak_MB():
+    status = read_proc('status', ['VmHWM'])
+    if status:
+        return status['VmHWM']/2**10
+    return maxrss_MB(resource.RUSAGE_SELF if resource else None)
+
+def children_cpu():
+    # CPU time of the terminated worker processes of this process
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime+usage.ru_stime
+
+class Step:
+    # A measured step. Used as a context manager by measure().
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        if stack:
+            parent = stack[-1]
+            for name, value in parent.labels.items():
+                if self.labels.get(name) is None:
+                    self.labels[name] = value
+            parent.peak = max(parent.peak, peak_MB() or 0.0)
+        stack.append(self)
+        self.peak = 0.0
+        reset_peak()
+        self.io = read_proc('io', ['rchar', 'wchar'])
+        self.children_peak = maxrss_MB(resource.RUSAGE_CHILDREN) if resource else None
+        self.children_cpu = children_cpu()
+        self.cpu = time.process_time()
+        self.clock = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        wall = time.perf_counter()-self.start
+        cpu = time.process_time()-self.cpu+children_cpu()-self.children_cpu
+        peak = max(self.peak, peak_MB() or 0.0)
+        # Workers that finished during the step count with the largest of them
+        if self.children_peak is not None:
+            children_peak = maxrss_MB(resource.RUSAGE_CHILDREN)
+            if children_peak > self.children_peak:
+                peak = max(peak, children_peak)
+        io = read_proc('io', ['rchar', 'wchar'])
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        record = dict(self.labels)
+        record.update({'start':self.clock, 'wall seconds':wall, 'cpu seconds':cpu, 'peak rss MB':peak,
+                       'bytes read':io['rchar']-self.io['rchar'] if io and self.io else None,
+                       'bytes written':io['wchar']-self.io['wchar'] if io and self.io else None,
+                       'process':os.getpid()})
+        records.append(record)
+        return False
+
+class Nothing:
+    # Stands in for a step when the instrumentation is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+nothing = Nothing()
+
+def measure(stage=None, step=None, pair=None, item=None):
+    # Measure the code run inside a with block
+    if not enabled:
+        return nothing
+    return Step({'stage':stage, 'step':step, 'pair':pair, 'item':item})
+
+def measured(step):
+    # Decorator measuring each call of a function that takes the name of a
+    # pair and optionally the models to calculate, e.g. grid() or
+    # expanding_window_fits()
+    def decorate(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            models = arguments.arguments.get('models')
+            item = None
+            if models is not None:
+                item = 'models '+' '.join(str(model) for model in models)
+            with Step({'stage':None, 'step':step, 'pair':arguments.arguments.get('pair'), 'item':item}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def call(function, *args):
+    # Run a function on a worker process with the instrumentation on. Returns
+    # its result together with the records of the steps it measured.
+    enable()
+    del records[:]
+    result = function(*args)
+    return result, [dict(record) for record in records]
+
+def add(worker_records):
+    # Add the records returned by call() on a worker process. Their missing
+    # labels are taken from the step they were run in.
+    for record in worker_records:
+        if stack:
+            for name, value in stack[-1].labels.items():
+                if record.get(name) is None:
+                    record[name] = value
+        records.append(record)
+
+def write_report(folder, config_file):
+    # Write the records, in the order the steps started, to run_report.json
+    # and run_report.csv in folder. Start times are in seconds from when the
+    # instrumentation was turned on.
+    import csv
+    ordered = [dict(record, start=record['start']-started) for record in sorted(records, key=lambda record: record['start'])]
+    f = open(os.path.join(folder, REPORT_FILE+'.json'), 'w')
+    json.dump({'config file':config_file, 'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'steps':ordered}, f, indent=1)
+    f.close()
+    f = open(os.path.join(folder, REPORT_FILE+'.csv'), 'w', newline='')
+    writer = csv.DictWriter(f, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(ordered)
+    f.close()
+
+def print_summary():
+    # Print the time and memory of each stage
+    for record in sorted(records, key=lambda record: record['start']):
+        if record['step'] is None and record['pair'] is None and record['item'] is None:
+            print('  {:15s} {:9.2f}s wall {:9.2f}s cpu {:9.1f} MB peak'.format(
+                record['stage'], record['wall seconds'], record['cpu seconds'], record['peak rss MB']))
@@ -2,6 +2,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pickle
+from . import results
+from . import sme_functions as sm
 from datetime import datetime
 
 def standard_plot(dataframe, columns, labels, ratio=1.0):
@@ -24,15 +26,12 @@ def fig_exp_window(analysis_folder, pair):
     print('Figure: fig_exp_window() : '+pair)
 
     # Read in optimal leverage values for this asset pair
-    lopt_1=pd.read_pickle(analysis_folder+pair+"-1_lopt_exp.pkl")
-    lopt_2=pd.read_pickle(analysis_folder+pair+"-2_lopt_exp.pkl")
-    lopt_3=pd.read_pickle(analysis_folder+pair+"-3_lopt_exp.pkl")
+    lopt_1=results.load(analysis_folder+pair+"-1_lopt_exp")
+    lopt_2=results.load(analysis_folder+pair+"-2_lopt_exp")
+    lopt_3=results.load(analysis_folder+pair+"-3_lopt_exp")
 
     # Read in parameter information for this asset pair
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     sigma=parameters['sigma_est']
     l_max=parameters['max_leverage']
     l_min=parameters['min_leverage']
@@ -62,47 +61,12 @@ def fig_exp_window(analysis_folder, pair):
 
 def fig_compare_assets(analysis_folder, plots_folder):
     print('Figure: fig_compare_assets() : ')
-    # Read in returns
-    returns_1=pd.read_pickle(analysis_folder+"MAD-FEDM-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+"SP500-FED-1.pkl")
-    # returns_3=pd.read_pickle(analysis_folder+"DAX-IRDE-1.pkl")
-    returns_4=pd.read_pickle(analysis_folder+"BTC-FED-1.pkl")
-    returns_5=pd.read_pickle(analysis_folder+"BRK-FED-1.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    # final_equity_3=np.cumprod(returns_3)[-1:].T
-    final_equity_4=np.cumprod(returns_4)[-1:].T
-    final_equity_5=np.cumprod(returns_5)[-1:].T
-#
-    filename = analysis_folder+'MAD-FEDM_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['MAD-FEDM']
-    f.close()
-    years_1=parameters['years']
-
-    filename = analysis_folder+'SP500-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['SP500-FED']
-    f.close()
-    years_2=parameters['years']
-
-    # filename = analysis_folder+'DAX-IRDE_prm.pkl'
-    # f=open(filename, 'rb')
-    # parameters = pickle.load(f)['DAX-IRDE']
-    # f.close()
-    # years_3=parameters['years']
-
-    filename = analysis_folder+'BTC-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['BTC-FED']
-    f.close()
-    years_4=parameters['years']
-
-    filename = analysis_folder+'BRK-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['BRK-FED']
-    f.close()
-    years_5=parameters['years']
+    # Read in final equity summaries
+    grid_1=sm.GridResult(analysis_folder, "MAD-FEDM", 1)
+    grid_2=sm.GridResult(analysis_folder, "SP500-FED", 1)
+    # grid_3=sm.GridResult(analysis_folder, "DAX-IRDE", 1)
+    grid_4=sm.GridResult(analysis_folder, "BTC-FED", 1)
+    grid_5=sm.GridResult(analysis_folder, "BRK-FED", 1)
 
     # Create plot
     fig=plt.figure()
@@ -110,11 +74,11 @@ def fig_compare_assets(analysis_folder, plots_folder):
     # Add lines to plot
     plt.axvline(x=1,linestyle=':',color='red',linewidth=.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    plt.plot(np.log(final_equity_1)/years_1,label='Madoff',linewidth=2,color='green')
-    plt.plot(np.log(final_equity_5)/years_5,label='Berkshire Hathaway',linewidth=2,color='orange')
-    plt.plot(np.log(final_equity_2)/years_2,label='S&P500',linewidth=2,color='blue')
-    # plt.plot(np.log(final_equity_3)/years_3,label='DAX',linewidth=2,color='magenta')
-    plt.plot(np.log(final_equity_4)/years_4,label='Bitcoin',linewidth=2,color='red')
+    plt.plot(grid_1.growth_curve(),label='Madoff',linewidth=2,color='green')
+    plt.plot(grid_5.growth_curve(),label='Berkshire Hathaway',linewidth=2,color='orange')
+    plt.plot(grid_2.growth_curve(),label='S&P500',linewidth=2,color='blue')
+    # plt.plot(grid_3.growth_curve(),label='DAX',linewidth=2,color='magenta')
+    plt.plot(grid_4.growth_curve(),label='Bitcoin',linewidth=2,color='red')
     # Add remaining plot details
     plt.xlim([-35,110])
     plt.ylim([-4,5])
@@ -128,22 +92,13 @@ def fig_compare_assets(analysis_folder, plots_folder):
 
 def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
     print('Figure: fig_growth_vs_leverage() : '+pair)
-    # Read in optimal leverage values for this asset pair
-    returns_1=pd.read_pickle(analysis_folder+pair+"-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+pair+"-2.pkl")
-    returns_3=pd.read_pickle(analysis_folder+pair+"-3.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-    equity_1=np.cumprod(returns_1)
-    equity_2=np.cumprod(returns_2)
-    equity_3=np.cumprod(returns_3)
+    # Read in final equity summaries for this asset pair
+    grid_1=sm.GridResult(analysis_folder, pair, 1)
+    grid_2=sm.GridResult(analysis_folder, pair, 2)
+    grid_3=sm.GridResult(analysis_folder, pair, 3)
     #
     # Read in parameter information for this asset pair
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     years=parameters['years']
     sigma=parameters['sigma_est']
     mu_e=parameters['mu_excess_est']
@@ -160,11 +115,11 @@ def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
     plt.axvline(x=1+2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axvline(x=1-2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    (np.log(final_equity_1.iloc[:,0].astype(float))/years).plot(label='simple', linewidth=5, color='blue')
-    (np.log(final_equity_2.iloc[:,0].astype(float))/years).plot(label='+ friction', linewidth=3, color='orange')
-    (np.log(final_equity_3.iloc[:,0].astype(float))/years).plot(label='+ borrowing premia', linewidth=1, color='green')
-    plt.plot(final_equity_1.index,\
-              (mu_r+mu_e*final_equity_1.index-sigma**2*final_equity_1.index**2/2),\
+    grid_1.growth_curve().plot(label='simple', linewidth=5, color='blue')
+    grid_2.growth_curve().plot(label='+ friction', linewidth=3, color='orange')
+    grid_3.growth_curve().plot(label='+ borrowing premia', linewidth=1, color='green')
+    plt.plot(grid_1.leverages(),\
+              (mu_r+mu_e*grid_1.leverages()-sigma**2*grid_1.leverages()**2/2),\
               linestyle="--",linewidth=4, color='red')
     # Add remaining plot details
     plt.xlim([-6.5,8.5])
@@ -178,27 +133,13 @@ def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
 
 def fig_growth_vs_leverage_all(analysis_folder, plots_folder):
     input_dir=analysis_folder
-    returns_1=pd.read_pickle(input_dir+"SP500-FED-1.pkl")
-    returns_2=pd.read_pickle(input_dir+"BRK-FED-1.pkl")
-    returns_3=pd.read_pickle(input_dir+"BTC-FED-1.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-
-    f=open(analysis_folder+'SP500-FED_prm.pkl', 'rb')
-    parameters = pickle.load(f)
-    lopt_error_1=parameters['SP500-FED']['lopt_error']
-    f.close()
-
-    f=open(analysis_folder+'BRK-FED_prm.pkl', 'rb')
-    parameters = pickle.load(f)
-    lopt_error_2=parameters['BRK-FED']['lopt_error']
-    f.close()
-
-    f=open(analysis_folder+'BTC-FED_prm.pkl', 'rb')
-    parameters = pickle.load(f)
-    lopt_error_3=parameters['BTC-FED']['lopt_error']
-    f.close()
+    final_equity_1=sm.GridResult(input_dir, "SP500-FED", 1).final_equity()
+    final_equity_2=sm.GridResult(input_dir, "BRK-FED", 1).final_equity()
+    final_equity_3=sm.GridResult(input_dir, "BTC-FED", 1).final_equity()
+
+    lopt_error_1=results.parameters(analysis_folder, 'SP500-FED')['lopt_error']
+    lopt_error_2=results.parameters(analysis_folder, 'BRK-FED')['lopt_error']
+    lopt_error_3=results.parameters(analysis_folder, 'BTC-FED')['lopt_error']
 
     ####final equity vs. leverage#####
     fig, ax1=plt.subplots()
@@ -233,22 +174,13 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
     print('Figure: fig_final_equity() : '+pair)
 
     # Read in parameter information for this asset pair
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     st_err=parameters['lopt_error']
 
     # Read in optimal leverage values for this asset pair
-    returns_1=pd.read_pickle(analysis_folder+pair+"-1.pkl")
-    # returns_2=pd.read_pickle(analysis_folder+pair+"-2.pkl")
-    # returns_3=pd.read_pickle(analysis_folder+pair+"-3.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    # final_equity_2=np.cumprod(returns_2)[-1:].T
-    # final_equity_3=np.cumprod(returns_3)[-1:].T
-    equity_1=np.cumprod(returns_1)
-    # equity_2=np.cumprod(returns_2)
-    # equity_3=np.cumprod(returns_3)
+    final_equity_1=sm.GridResult(analysis_folder, pair, 1).final_equity()
+    # final_equity_2=sm.GridResult(analysis_folder, pair, 2).final_equity()
+    # final_equity_3=sm.GridResult(analysis_folder, pair, 3).final_equity()
 
     # Create plot
     fig=plt.figure()
@@ -264,35 +196,38 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
     # Add remaining plot details
     # #plt.xlim([final_equity_1.index.min(),final_equity_1.index.max()])
     if pair=='SP500-FED':
-        ax.plot(final_equity_1.index[277],final_equity_1.iloc[277],marker='o',markerfacecolor='none',linewidth=.1,color='C0')
-        ax.plot(final_equity_1.index[299],final_equity_1.iloc[299],marker='o',markerfacecolor='none',linewidth=.1,color='C1')
-        ax.plot(final_equity_1.index[320],final_equity_1.iloc[320],marker='o',markerfacecolor='none',linewidth=.1,color='C2')
-        ax.plot(final_equity_1.index[344],final_equity_1.iloc[344],marker='o',markerfacecolor='none',linewidth=.1,color='C3')
-        ax.plot(final_equity_1.index[366],final_equity_1.iloc[366],marker='o',markerfacecolor='none',linewidth=.1,color='C4')
-        ax.plot(final_equity_1.index[390],final_equity_1.iloc[390],marker='o',markerfacecolor='none',linewidth=.1,color='C5')
+        # Final equity of the leverages plotted in fig_equity_trajectories
+        grid=sm.GridResult(analysis_folder, pair, 1)
+        points=grid.final_equity(grid.solvent([0.0,0.5,1.0,1.5,2.0,2.5]))
+        ax.plot(points.index[0],points.iloc[0],marker='o',markerfacecolor='none',linewidth=.1,color='C0')
+        ax.plot(points.index[1],points.iloc[1],marker='o',markerfacecolor='none',linewidth=.1,color='C1')
+        ax.plot(points.index[2],points.iloc[2],marker='o',markerfacecolor='none',linewidth=.1,color='C2')
+        ax.plot(points.index[3],points.iloc[3],marker='o',markerfacecolor='none',linewidth=.1,color='C3')
+        ax.plot(points.index[4],points.iloc[4],marker='o',markerfacecolor='none',linewidth=.1,color='C4')
+        ax.plot(points.index[5],points.iloc[5],marker='o',markerfacecolor='none',linewidth=.1,color='C5')
 
         ax.annotate('l=0',
-            xy=(0,final_equity_1.iloc[277]), xycoords='data',
+            xy=(points.index[0],points.iloc[0]), xycoords='data',
             xytext=(-60, 0), textcoords='offset points',
             arrowprops=dict(color='C0',arrowstyle="->"))
         ax.annotate('l=0.5',
-            xy=(0.5,final_equity_1.iloc[299]), xycoords='data',
+            xy=(points.index[1],points.iloc[1]), xycoords='data',
             xytext=(-60, 0), textcoords='offset points',
             arrowprops=dict(color='C1',arrowstyle="->"))
         ax.annotate('l=1',
-            xy=(1,final_equity_1.iloc[320]), xycoords='data',
+            xy=(points.index[2],points.iloc[2]), xycoords='data',
             xytext=(-60, 0), textcoords='offset points',
             arrowprops=dict(color='C2',arrowstyle="->"))
         ax.annotate('l=1.5',
-            xy=(1.5,final_equity_1.iloc[344]), xycoords='data',
+            xy=(points.index[3],points.iloc[3]), xycoords='data',
             xytext=(50, 0), textcoords='offset points',
             arrowprops=dict(color='C3',arrowstyle="->"))
         ax.annotate('l=2',
-            xy=(2,final_equity_1.iloc[366]), xycoords='data',
+            xy=(points.index[4],points.iloc[4]), xycoords='data',
             xytext=(50, 0), textcoords='offset points',
             arrowprops=dict(color='C4',arrowstyle="->"))
         ax.annotate('l=2.5',
-            xy=(2.5,final_equity_1.iloc[390]), xycoords='data',
+            xy=(points.index[5],points.iloc[5]), xycoords='data',
             xytext=(50, 0), textcoords='offset points',
             arrowprops=dict(color='C5',arrowstyle="->"))
     plt.xlim([-2,4])
@@ -303,37 +238,39 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
 
 def fig_equity_trajectories(analysis_folder, plots_folder, pair):
     print('Figure: fig_equity_trajectories() : '+pair)
-    # Read in equity data
-    returns=pd.read_pickle(analysis_folder+pair+'-1.pkl')
-    equity=np.cumprod(returns)
+    # Equity over time for the leverages plotted, calculated for just
+    # those leverage values. Leverages beyond the bankruptcy bounds of the
+    # pair are moved to the bounds.
+    grid=sm.GridResult(analysis_folder, pair, 1)
+    equity=grid.trajectory(grid.solvent([0.0,0.5,1.0,1.5,2.0,2.5]))
     final_equity=equity[-1:].T
     #
     # #### equity trajectories ####
     fig=plt.figure()
     ax = plt.axes()
     # Add lines to plot
-    Delta_t=returns.index[-1] - returns.index[0]
+    Delta_t=equity.index[-1] - equity.index[0]
     years=Delta_t.days/365.25
 #    equity.iloc[:,99].plot(label='l='+str(round(equity.columns[99],2)))
-    equity.iloc[:,277].plot(label='l='+str(round(equity.columns[277],1)))
-    equity.iloc[:,299].plot(label='l='+str(round(equity.columns[299],1)))
-    equity.iloc[:,320].plot(label='l='+str(round(equity.columns[320],1)))
-    equity.iloc[:,344].plot(label='l='+str(round(equity.columns[344],1)))
-    equity.iloc[:,366].plot(label='l='+str(round(equity.columns[366],1)))
-    equity.iloc[:,390].plot(label='l='+str(round(equity.columns[390],1)))
+    equity.iloc[:,0].plot(label='l='+str(round(equity.columns[0],1)))
+    equity.iloc[:,1].plot(label='l='+str(round(equity.columns[1],1)))
+    equity.iloc[:,2].plot(label='l='+str(round(equity.columns[2],1)))
+    equity.iloc[:,3].plot(label='l='+str(round(equity.columns[3],1)))
+    equity.iloc[:,4].plot(label='l='+str(round(equity.columns[4],1)))
+    equity.iloc[:,5].plot(label='l='+str(round(equity.columns[5],1)))
     # Add remaining plot details
     if pair=='SP500-FED':
-        # plt.annotate(r'l=0',(equity.index[-1],equity.iloc[-1,277]))
+        # plt.annotate(r'l=0',(equity.index[-1],equity.iloc[-1,0]))
         plt.annotate(r'l=0',(1.02,.183),xycoords='axes fraction')
-        # plt.annotate(r'l=0.5',(equity.index[-1],equity.iloc[-1,299]))
+        # plt.annotate(r'l=0.5',(equity.index[-1],equity.iloc[-1,1]))
         plt.annotate(r'l=0.5',(1.02,.53),xycoords='axes fraction')
-        # plt.annotate(r'l=1',(equity.index[-1],equity.iloc[-1,320]))
+        # plt.annotate(r'l=1',(equity.index[-1],equity.iloc[-1,2]))
         plt.annotate(r'l=1',(1.02,.845),xycoords='axes fraction')
-        # plt.annotate(r'l=1.5',(equity.index[-1],equity.iloc[-1,344]))
+        # plt.annotate(r'l=1.5',(equity.index[-1],equity.iloc[-1,3]))
         plt.annotate(r'l=1.5',(1.02,.655),xycoords='axes fraction')
-        # plt.annotate(r'l=2',(equity.index[-1],equity.iloc[-1,366]))
+        # plt.annotate(r'l=2',(equity.index[-1],equity.iloc[-1,4]))
         plt.annotate(r'l=2',(1.02,.26),xycoords='axes fraction')
-        # plt.annotate(r'l=2.5',(equity.index[-1],equity.iloc[-1,390]))
+        # plt.annotate(r'l=2.5',(equity.index[-1],equity.iloc[-1,5]))
         plt.annotate(r'l=2.5',(1.02,.073),xycoords='axes fraction')
 #    ax.set_yscale('log')
     plt.xlabel('')
@@ -350,14 +287,11 @@ def fig_lopt_var(analysis_folder, plots_folder, pairs):
     lopt_var={}
     for pair in pairs:
         # Read in parameter information for this asset pair
-        filename = analysis_folder+pair+'_prm.pkl'
-        f=open(filename, 'rb')
-        parameters = pickle.load(f)[pair]
-        f.close()
+        parameters = results.parameters(analysis_folder, pair)
         sigma[pair]=parameters['sigma_est']
 
         # Read in leverage data
-        lopt_var[pair]=pd.read_pickle(analysis_folder+pair+"_lopt_var.pkl")
+        lopt_var[pair]=results.load(analysis_folder+pair+"_lopt_var")
 
     # Create plot
     fig=plt.figure()
@@ -383,7 +317,7 @@ def fig_lopt_var(analysis_folder, plots_folder, pairs):
 def fig_leverage_vary_window(analysis_folder, plots_folder, pair, model):
     print('Figure: fig_leverage_vary_window() : '+pair)
     # Read in optimal leverage data for different window lengths
-    df=pd.read_pickle(analysis_folder+pair+'-'+str(model)+'_lopt_fixed.pkl')
+    df=results.load(analysis_folder+pair+'-'+str(model)+'_lopt_fixed')
     #
     # Create plot
     fig=plt.figure()
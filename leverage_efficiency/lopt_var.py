@@ -5,18 +5,22 @@ Created on Fri Jan 26 11:17:05 2018
 
 @author: obp48
 """
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from . import base
 from . import sme_functions as sm
+from . import store
+from . import instrument
+from . import solver_stats
 import datetime as dt
-import scipy.optimize
 import time
 import pickle
+import os
 
 
-def lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_window_size=10):
+@instrument.measured('variance')
+def lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_window_size=10, write_outfile=True,
+                                 pickle_export=False, solver_statistics=False):
     print('  lopt_variance_vs_window_size() : ', pair)
     # Extract the individual asset codes from the asset pair
     asset1 = pair.split('-')[0]
@@ -30,12 +34,13 @@ def lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_win
     properties = base.set_pair_properties('modify-defaults/', pair)
 
     # Read returns data for both assets
-    in_file_1=data_folder+asset1+".pkl" #risky
-    in_file_2=data_folder+asset2+".pkl" #riskless
-    min_start_date, max_end_date, rel_ret_1, rel_ret_2 = sm.get_returns_data(in_file_1, in_file_2, properties)
+    in_file_1=data_folder+asset1 #risky
+    in_file_2=data_folder+asset2 #riskless
+    returns = sm.get_returns_pair(in_file_1, in_file_2, properties)
+    min_start_date, max_end_date = returns.start_date, returns.end_date
 
-    start = rel_ret_1.index[initial_window_size]
-    end = rel_ret_1.index[-1]
+    start = returns.dates[initial_window_size]
+    end = returns.dates[-1]
     if start<min_start_date:
         print("  start_date not supported by data (too early)")
     if end>max_end_date:
@@ -51,22 +56,32 @@ def lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_win
             yield start
             start += step
 
-    f=open(analysis_folder+'outfile.txt','w')
+    # outfile.txt is shared by all pairs and ends up holding the windows of
+    # the last pair analysed. Parallel runs only let that pair write it.
+    if write_outfile:
+        f=open(analysis_folder+'outfile.txt','w')
+    else:
+        f=open(os.devnull,'w')
     lopt_var=pd.Series()
 
     # This line produces a hardcoded windown lenght of 17 days. Can presumably
     # be replaced by a Timedelta
     #window_size=pd.Timestamp(2010,8,5)-pd.Timestamp(2010,7,19)
     #window_size=pd.Timedelta('17 days 00:00:00')
-    window_size=17*(rel_ret_1.index[1]-rel_ret_1.index[0])
+    step=returns.dates[1]-returns.dates[0]
+    window_size=17*step
+    if solver_statistics:
+        solver_stats.start()
     while window_size<(end-start)/2:
         lopt_0=0.0
         lopt_1=0.0
         lopt_2=0.0
-        for window_start in my_a_range(start,end-window_size,window_size):
-            time_window=[window_start,window_start+window_size]
-            lopt, equity = sm.calculate_optimal_leverage(rel_ret_1,rel_ret_2,
-                            time_window, 1 , params[asset1])
+        # All non-overlapping windows of this size are solved in one batch
+        window_starts=pd.DatetimeIndex(list(my_a_range(start,end-window_size,window_size)))
+        positions=returns.windows(window_starts,window_starts+window_size)
+        lopt_values, equity = sm.calculate_optimal_leverage_windows(returns,
+                                *positions, 1, params[asset1])
+        for window_start, lopt in zip(window_starts, lopt_values):
             s=str(window_start)+" "+str(lopt)+" "+str(window_size.days)+"\n"
             f.write(s)
             lopt_0+=1.0
@@ -76,11 +91,22 @@ def lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_win
             lopt_var[window_size]=lopt_2/lopt_0-(lopt_1/lopt_0)**2.0
         else:
             lopt_var[window_size] = np.inf
-        window_size=int(1.1*window_size.days)*pd.Timedelta('1 days 00:00:00')
+        # Windows grow by 10% in whole days, or in whole samples for series
+        # sampled more than once a day
+        if step<pd.Timedelta('1 days 00:00:00'):
+            window_size=int(1.1*(window_size/step))*step
+        else:
+            window_size=int(1.1*window_size.days)*pd.Timedelta('1 days 00:00:00')
     f.close()
-    outfile = analysis_folder+pair+'_lopt_var.pkl'
-    lopt_var.to_pickle(outfile)
+    if solver_statistics:
+        solver_stats.write(analysis_folder+pair+'-1_solver_var', returns.dates)
+    outfile = analysis_folder+pair+'_lopt_var'
+    store.save(lopt_var, outfile, pickle_export)
 
-def main(data_folder, analysis_folder, pairs):
+def main(data_folder, analysis_folder, pairs, outfile_pair=None, pickle_export=False, solver_statistics=False):
+    # outfile.txt is written by every pair in turn unless a single pair is
+    # given to write it
     for pair in pairs:
-        lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_window_size=10)
+        lopt_variance_vs_window_size(data_folder, analysis_folder, pair, initial_window_size=10,
+                                     write_outfile=outfile_pair is None or pair == outfile_pair,
+                                     pickle_export=pickle_export, solver_statistics=solver_statistics)
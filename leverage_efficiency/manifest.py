@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+
+# Each pipeline output folder keeps a manifest recording, for every item a
+# stage produces (a data set, an asset pair or a set of figures), a hash of
+# the inputs it was made from and the files that were written. An item whose
+# inputs hash to the recorded value and whose files are still in place is
+# up to date and does not need to be made again.
+
+MANIFEST_FILE = 'manifest.json'
+# Files in the output folders that are not data: the manifest itself and the
+# run report written by workflow.py
+BOOKKEEPING_FILES = (MANIFEST_FILE, 'run_report.')
+
+def read_manifest(folder):
+    filename = os.path.join(folder, MANIFEST_FILE)
+    manifest = {'items':{}, 'files':{}}
+    if os.access(filename, os.R_OK):
+        f = open(filename,'r')
+        try:
+            manifest = json.load(f)
+        except ValueError:
+            print("  Error parsing manifest ", filename, ". Everything in ", folder, " will be made again.")
+        f.close()
+    return manifest
+
+def write_manifest(folder, manifest):
+    # Write to a temporary file first so that an interrupted run cannot leave
+    # a half written manifest behind
+    filename = os.path.join(folder, MANIFEST_FILE)
+    f = open(filename+'.tmp','w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    os.replace(filename+'.tmp', filename)
+
+def file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def content_hash(path):
+    h = hashlib.sha256()
+    f = open(path,'rb')
+    for chunk in iter(lambda: f.read(2**20), b''):
+        h.update(chunk)
+    f.close()
+    return h.hexdigest()
+
+def file_hash(path):
+    # Content hash of a file, or None if it does not exist. Files recorded in
+    # the manifest of their folder are only read again if their size or
+    # modification time has changed since.
+    if not os.path.isfile(path):
+        return None
+    folder, name = os.path.split(path)
+    recorded = read_manifest(folder)['files'].get(name)
+    if recorded is not None and recorded[:2] == file_stat(path):
+        return recorded[2]
+    return content_hash(path)
+
+def folder_files(folder):
+    # All data files in a folder, leaving out the manifest and the run report
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if os.path.isfile(os.path.join(folder, name)) and not name.startswith(BOOKKEEPING_FILES)]
+
+def package_files(*modules):
+    # Source files of modules in this package, so that editing the code of a
+    # stage also counts as a change to its inputs
+    return [os.path.join(os.path.dirname(__file__), module+'.py') for module in modules]
+
+def input_hash(files, *values):
+    # Hash of the contents of the input files together with any settings
+    # (config sections, model parameters) that the outputs depend on
+    h = hashlib.sha256()
+    for path in files:
+        h.update((os.path.basename(path)+':'+str(file_hash(path))+'\n').encode())
+    h.update(json.dumps(values, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def is_current(folder, manifest, item, key, check_files=True):
+    # An item is up to date if it was made from inputs with the same hash and
+    # all of its files still exist (unchanged, if check_files is set)
+    entry = manifest['items'].get(item)
+    if entry is None or entry['inputs'] != key:
+        return False
+    for name in entry['outputs']:
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path):
+            return False
+        if check_files and manifest['files'].get(name, [None, None])[:2] != file_stat(path):
+            return False
+    return True
+
+def record(folder, manifest, item, key, outputs):
+    # Record the files written for an item along with the hash of its inputs
+    for name in outputs:
+        path = os.path.join(folder, name)
+        manifest['files'][name] = file_stat(path)+[content_hash(path)]
+    manifest['items'][item] = {'inputs':key, 'outputs':sorted(outputs)}
+
+def outputs_since(folder, start_time):
+    # Names of the files in a folder written since start_time (in ns)
+    return [os.path.basename(path) for path in folder_files(folder)
+            if os.stat(path).st_mtime_ns >= start_time]
+
+def recorded_state(manifest, item):
+    # The recorded inputs and files of an item. This changes whenever the item
+    # is made again, so later stages overwriting some of the same files can
+    # include it in their own inputs.
+    entry = manifest['items'].get(item)
+    if entry is None:
+        return None
+    return [entry['inputs'], [manifest['files'].get(name) for name in entry['outputs']]]
@@ -2,6 +2,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pickle
+from . import results
+from . import sme_functions as sm
 from datetime import datetime
 
 def standard_plot(dataframe, columns, labels, ratio=1.0):
@@ -24,16 +26,12 @@ def fig_exp_window(analysis_folder, pair):
     print('Figure: fig_exp_window() : '+pair)
 
     # Read in optimal leverage values for this asset pair
-    lopt_1=pd.read_pickle(analysis_folder+pair+"-1_lopt_exp.pkl")
-    lopt_2=pd.read_pickle(analysis_folder+pair+"-2_lopt_exp.pkl")
-    lopt_3=pd.read_pickle(analysis_folder+pair+"-3_lopt_exp.pkl")
+    lopt_1=results.load(analysis_folder+pair+"-1_lopt_exp")
+    lopt_2=results.load(analysis_folder+pair+"-2_lopt_exp")
+    lopt_3=results.load(analysis_folder+pair+"-3_lopt_exp")
 
     # Read in parameter information for this asset pair
-    #filename = analysis_folder+'parameters_'+pair+'.pkl'
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     sigma=parameters['sigma_est']
     l_max=parameters['max_leverage']
     l_min=parameters['min_leverage']
@@ -63,42 +61,12 @@ def fig_exp_window(analysis_folder, pair):
 
 def fig_compare_assets(analysis_folder, plots_folder):
     print('Figure: fig_compare_assets() : ')
-    # Read in returns
-    returns_1=pd.read_pickle(analysis_folder+"MAD-FEDM-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+"SP500-FED-1.pkl")
-    # returns_3=pd.read_pickle(analysis_folder+"DAX-IRDE-1.pkl")
-    returns_4=pd.read_pickle(analysis_folder+"BTC-FED-1.pkl")
-    returns_5=pd.read_pickle(analysis_folder+"BRK-FED-1.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    # final_equity_3=np.cumprod(returns_3)[-1:].T
-    final_equity_4=np.cumprod(returns_4)[-1:].T
-    final_equity_5=np.cumprod(returns_5)[-1:].T
-#
-    filename = analysis_folder+'MAD-FEDM_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['MAD-FEDM']
-    f.close()
-    years_1=parameters['years']
-
-    filename = analysis_folder+'SP500-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['SP500-FED']
-    f.close()
-    years_2=parameters['years']
-
-
-    filename = analysis_folder+'BTC-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['BTC-FED']
-    f.close()
-    years_4=parameters['years']
-
-    filename = analysis_folder+'BRK-FED_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)['BRK-FED']
-    f.close()
-    years_5=parameters['years']
+    # Read in final equity summaries
+    grid_1=sm.GridResult(analysis_folder, "MAD-FEDM", 1)
+    grid_2=sm.GridResult(analysis_folder, "SP500-FED", 1)
+    # grid_3=sm.GridResult(analysis_folder, "DAX-IRDE", 1)
+    grid_4=sm.GridResult(analysis_folder, "BTC-FED", 1)
+    grid_5=sm.GridResult(analysis_folder, "BRK-FED", 1)
 
     # Create plot
     fig=plt.figure()
@@ -106,11 +74,11 @@ def fig_compare_assets(analysis_folder, plots_folder):
     # Add lines to plot
     plt.axvline(x=1,linestyle=':',color='red',linewidth=.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    plt.plot(np.log(final_equity_1)/years_1,label='Madoff',linewidth=2,color='green')
-    plt.plot(np.log(final_equity_5)/years_5,label='Berkshire Hathaway',linewidth=2,color='orange')
-    plt.plot(np.log(final_equity_2)/years_2,label='S&P500',linewidth=2,color='blue')
-    # plt.plot(np.log(final_equity_3)/years_3,label='DAX',linewidth=2,color='magenta')
-    plt.plot(np.log(final_equity_4)/years_4,label='Bitcoin',linewidth=2,color='red')
+    plt.plot(grid_1.growth_curve(),label='Madoff',linewidth=2,color='green')
+    plt.plot(grid_5.growth_curve(),label='Berkshire Hathaway',linewidth=2,color='orange')
+    plt.plot(grid_2.growth_curve(),label='S&P500',linewidth=2,color='blue')
+    # plt.plot(grid_3.growth_curve(),label='DAX',linewidth=2,color='magenta')
+    plt.plot(grid_4.growth_curve(),label='Bitcoin',linewidth=2,color='red')
     # Add remaining plot details
     plt.xlim([-35,110])
     plt.ylim([-4,5])
@@ -124,23 +92,13 @@ def fig_compare_assets(analysis_folder, plots_folder):
 
 def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
     print('Figure: fig_growth_vs_leverage() : '+pair)
-    # Read in optimal leverage values for this asset pair
-    returns_1=pd.read_pickle(analysis_folder+pair+"-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+pair+"-2.pkl")
-    returns_3=pd.read_pickle(analysis_folder+pair+"-3.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-    equity_1=np.cumprod(returns_1)
-    equity_2=np.cumprod(returns_2)
-    equity_3=np.cumprod(returns_3)
+    # Read in final equity summaries for this asset pair
+    grid_1=sm.GridResult(analysis_folder, pair, 1)
+    grid_2=sm.GridResult(analysis_folder, pair, 2)
+    grid_3=sm.GridResult(analysis_folder, pair, 3)
     #
     # Read in parameter information for this asset pair
-    #filename = analysis_folder+'parameters_'+pair+'.pkl'
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     years=parameters['years']
     sigma=parameters['sigma_est']
     mu_e=parameters['mu_excess_est']
@@ -157,11 +115,11 @@ def fig_growth_vs_leverage(analysis_folder, plots_folder, pair):
     plt.axvline(x=1+2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axvline(x=1-2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    (np.log(final_equity_1.iloc[:,0].astype(float))/years).plot(label='simple', linewidth=5, color='blue')
-    (np.log(final_equity_2.iloc[:,0].astype(float))/years).plot(label='+ friction', linewidth=3, color='orange')
-    (np.log(final_equity_3.iloc[:,0].astype(float))/years).plot(label='+ borrowing premia', linewidth=1, color='green')
-    plt.plot(final_equity_1.index,\
-              (mu_r+mu_e*final_equity_1.index-sigma**2*final_equity_1.index**2/2),\
+    grid_1.growth_curve().plot(label='simple', linewidth=5, color='blue')
+    grid_2.growth_curve().plot(label='+ friction', linewidth=3, color='orange')
+    grid_3.growth_curve().plot(label='+ borrowing premia', linewidth=1, color='green')
+    plt.plot(grid_1.leverages(),\
+              (mu_r+mu_e*grid_1.leverages()-sigma**2*grid_1.leverages()**2/2),\
               linestyle="--",linewidth=4, color='red')
     # Add remaining plot details
     plt.xlim([-6.5,8.5])
@@ -177,23 +135,13 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
     print('Figure: fig_final_equity() : '+pair)
 
     # Read in parameter information for this asset pair
-    #filename = analysis_folder+'parameters_'+pair+'.pkl'
-    filename = analysis_folder+pair+'_prm.pkl'
-    f=open(filename, 'rb')
-    parameters = pickle.load(f)[pair]
-    f.close()
+    parameters = results.parameters(analysis_folder, pair)
     st_err=parameters['lopt_error']
 
-    # Read in optimal leverage values for this asset pair
-    returns_1=pd.read_pickle(analysis_folder+pair+"-1.pkl")
-    returns_2=pd.read_pickle(analysis_folder+pair+"-2.pkl")
-    returns_3=pd.read_pickle(analysis_folder+pair+"-3.pkl")
-    final_equity_1=np.cumprod(returns_1)[-1:].T
-    final_equity_2=np.cumprod(returns_2)[-1:].T
-    final_equity_3=np.cumprod(returns_3)[-1:].T
-    equity_1=np.cumprod(returns_1)
-    equity_2=np.cumprod(returns_2)
-    equity_3=np.cumprod(returns_3)
+    # Read in final equity summaries for this asset pair
+    grid_1=sm.GridResult(analysis_folder, pair, 1)
+    grid_2=sm.GridResult(analysis_folder, pair, 2)
+    grid_3=sm.GridResult(analysis_folder, pair, 3)
 
     # Create plot
     fig=plt.figure()
@@ -203,9 +151,9 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
     plt.axvline(x=1+2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axvline(x=1-2*st_err,linestyle=':',color='pink',linewidth=1.5)
     plt.axhline(y=0,linestyle=':',color='grey',linewidth=.5)
-    plt.plot(final_equity_1, label='Simple',linewidth=5)
-    plt.plot(final_equity_2, label='+ friction',linewidth=3)
-    plt.plot(final_equity_3, label='+ borrowing premia',linewidth=1)
+    plt.plot(grid_1.final_equity(), label='Simple',linewidth=5)
+    plt.plot(grid_2.final_equity(), label='+ friction',linewidth=3)
+    plt.plot(grid_3.final_equity(), label='+ borrowing premia',linewidth=1)
     # Add remaining plot details
     # #plt.xlim([final_equity_1.index.min(),final_equity_1.index.max()])
     plt.xlim([-2,4])
@@ -216,28 +164,30 @@ def fig_final_equity(analysis_folder, plots_folder, pair):
 
 def fig_equity_trajectories(analysis_folder, plots_folder, pair):
     print('Figure: fig_equity_trajectories() : '+pair)
-    # Read in equity data
-    returns=pd.read_pickle(analysis_folder+pair+'-1.pkl')
-    equity=np.cumprod(returns)
+    # Equity over time for the leverages plotted, calculated for just
+    # those leverage values. Leverages beyond the bankruptcy bounds of the
+    # pair are moved to the bounds.
+    grid=sm.GridResult(analysis_folder, pair, 1)
+    equity=grid.trajectory(grid.solvent([-1.0,0.0,1.0,3.5]))
     final_equity=equity[-1:].T
     #
     # #### equity trajectories ####
     fig=plt.figure()
     ax = plt.axes()
     # Add lines to plot
-    Delta_t=returns.index[-1] - returns.index[0]
+    Delta_t=equity.index[-1] - equity.index[0]
     years=Delta_t.days/365.25
 #    equity.iloc[:,99].plot(label='l='+str(round(equity.columns[99],2)))
-    equity.iloc[:,232].plot(label='l='+str(round(equity.columns[232],1)))
-    equity.iloc[:,277].plot(label='l='+str(round(equity.columns[277],1)))
-    equity.iloc[:,320].plot(label='l=+'+str(round(equity.columns[320],1)))
-    equity.iloc[:,436].plot(label='l=+'+str(round(equity.columns[436],1)))
+    equity.iloc[:,0].plot(label='l='+str(round(equity.columns[0],1)))
+    equity.iloc[:,1].plot(label='l='+str(round(equity.columns[1],1)))
+    equity.iloc[:,2].plot(label='l=+'+str(round(equity.columns[2],1)))
+    equity.iloc[:,3].plot(label='l=+'+str(round(equity.columns[3],1)))
     # Add remaining plot details
     if pair=='SP500-FED':
-        plt.annotate(r'l=+1, S&P500',(equity.index[22000],8*equity.iloc[22000,320]))
-        plt.annotate(r'l=0, FED',(equity.index[25000],.5*equity.iloc[25000,277]))
-        plt.annotate(r'l=-1',(equity.index[21000],1.5*equity.iloc[21000,232]))
-        plt.annotate(r'l=+3.5',(equity.index[21500],10*equity.iloc[22000,436]))
+        plt.annotate(r'l=+1, S&P500',(equity.index[22000],8*equity.iloc[22000,2]))
+        plt.annotate(r'l=0, FED',(equity.index[25000],.5*equity.iloc[25000,1]))
+        plt.annotate(r'l=-1',(equity.index[21000],1.5*equity.iloc[21000,0]))
+        plt.annotate(r'l=+3.5',(equity.index[21500],10*equity.iloc[22000,3]))
     ax.set_yscale('log')
     plt.xlabel('')
     plt.ylabel('equity')
@@ -253,15 +203,11 @@ def fig_lopt_var(analysis_folder, plots_folder, pairs):
     lopt_var={}
     for pair in pairs:
         # Read in parameter information for this asset pair
-        #filename = analysis_folder+'parameters_'+pair+'.pkl'
-        filename = analysis_folder+pair+'_prm.pkl'
-        f=open(filename, 'rb')
-        parameters = pickle.load(f)[pair]
-        f.close()
+        parameters = results.parameters(analysis_folder, pair)
         sigma[pair]=parameters['sigma_est']
 
         # Read in leverage data
-        lopt_var[pair]=pd.read_pickle(analysis_folder+pair+"_lopt_var.pkl")
+        lopt_var[pair]=results.load(analysis_folder+pair+"_lopt_var")
 
     # Create plot
     fig=plt.figure()
@@ -287,7 +233,7 @@ def fig_lopt_var(analysis_folder, plots_folder, pairs):
 def fig_leverage_vary_window(analysis_folder, plots_folder, pair, model):
     print('Figure: fig_leverage_vary_window() : '+pair)
     # Read in optimal leverage data for different window lengths
-    df=pd.read_pickle(analysis_folder+pair+'-'+str(model)+'_lopt_fixed.pkl')
+    df=results.load(analysis_folder+pair+'-'+str(model)+'_lopt_fixed')
     #
     # Create plot
     fig=plt.figure()
@@ -0,0 +1,63 @@
+import importlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from . import instrument
+
+# Figures are made by figure tasks: a figure function of one of the figure
+# modules, its arguments, the file the figure is saved to and any tweaks
+# applied to it before saving (a legend position or the y limits). A list of
+# tasks is rendered either one after the other in this process or on a pool
+# of worker processes using the non-interactive Agg backend. The files saved
+# are the same either way: the creation date that would otherwise make every
+# pdf different is left out.
+
+def task(module, function, args, outputfile, **tweaks):
+    return (module.__name__, function, tuple(args), outputfile, tweaks)
+
+def use_agg_backend():
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+def render_figure(module, function, args, outputfile, tweaks):
+    # Make and save one figure. Returns the time it took in seconds.
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    with instrument.measure(step=function, item=os.path.basename(outputfile)):
+        fig, ax = getattr(importlib.import_module(module), function)(*args)
+        if 'legend' in tweaks:
+            plt.legend(**tweaks['legend'])
+        if 'ylim' in tweaks:
+            plt.ylim(tweaks['ylim'])
+        fig.savefig(outputfile, bbox_inches='tight', metadata={'CreationDate':None})
+        plt.close()
+    return time.perf_counter()-start
+
+def render_figures(tasks, workers=1):
+    # Render the tasks and print how long each figure took. Returns the
+    # times in seconds by output file.
+    timings = {}
+    if workers > 1 and len(tasks) > 1:
+        # Workers are started fresh and switched to the Agg backend before
+        # any figure is made
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=context,
+                                 initializer=use_agg_backend) as executor:
+            # With the instrumentation on, each figure is measured on its worker
+            if instrument.enabled:
+                futures = [executor.submit(instrument.call, render_figure, *figure_task) for figure_task in tasks]
+            else:
+                futures = [executor.submit(render_figure, *figure_task) for figure_task in tasks]
+            for figure_task, future in zip(tasks, futures):
+                result = future.result()
+                if instrument.enabled:
+                    result, worker_records = result
+                    instrument.add(worker_records)
+                timings[figure_task[3]] = result
+    else:
+        for figure_task in tasks:
+            timings[figure_task[3]] = render_figure(*figure_task)
+    for outputfile, seconds in timings.items():
+        print('  {:7.2f}s  {}'.format(seconds, outputfile))
+    return timings
@@ -0,0 +1,43 @@
+import functools
+import os
+import pickle
+from . import store
+
+# The analysis results as read by the figures. plots.py, paper_plots.py and
+# lecture_plots.py make many figures from the same files, so whatever is read
+# or calculated from a file is kept in an in-process cache keyed by the file
+# and its modification time, and is shared by all three when workflow.py runs
+# them one after the other. A file that has been written again since is read
+# afresh. The objects returned are shared between callers and must not be
+# modified.
+
+CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def cached_call(function, args, stamps):
+    return function(*args)
+
+def memoize(function, args, filenames):
+    # function(*args), taken from the cache if it has already been called
+    # with the same arguments since the files it reads were last modified
+    stamps = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        stamps.append((filename, stat.st_mtime_ns, stat.st_size))
+    return cached_call(function, tuple(args), tuple(stamps))
+
+def load(filename, columns=None):
+    # A result saved in the store (see store.load)
+    if columns is not None:
+        columns = tuple(columns)
+    return memoize(store.load, (filename, columns), [filename+store.VALUES, filename+store.LABELS])
+
+def read_parameters(analysis_folder, pair):
+    f = open(analysis_folder+pair+'_prm.pkl', 'rb')
+    parameters = pickle.load(f)[pair]
+    f.close()
+    return parameters
+
+def parameters(analysis_folder, pair):
+    # The fitted parameters of a pair, written by fit_parameters
+    return memoize(read_parameters, (analysis_folder, pair), [analysis_folder+pair+'_prm.pkl'])
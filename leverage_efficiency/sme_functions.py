@@ -7,9 +7,14 @@ Created on Wed Apr  4 14:38:01 2018
 import numpy as np
 import pandas as pd
 import pickle
-import scipy.optimize
-from lmfit import Model, Parameters
+import time
+from collections import deque
+from multiprocessing import shared_memory
 from . import base
+from . import store
+from . import results
+from . import instrument
+from . import solver_stats
 
 
 def price_to_return(price_series):
@@ -19,9 +24,9 @@ def price_to_return(price_series):
 
 
 def get_returns_data(in_file_1, in_file_2, properties):
-    #Read in data
-    return_series_1=pd.read_pickle(in_file_1)['return']
-    return_series_2=pd.read_pickle(in_file_2)['return']
+    #Read in data, from the fastest format each data set was written in
+    return_series_1=store.read_frame(in_file_1)['return']
+    return_series_2=store.read_frame(in_file_2)['return']
 
     # We want to keep only dates where both series have a value.
     # We use an inner join to do this neatly
@@ -64,8 +69,173 @@ def get_returns_data(in_file_1, in_file_2, properties):
     return start_date, end_date, rel_ret_1, rel_ret_2
 
 
-def grid(data_folder, analysis_folder, pair):
+def get_returns_pair(in_file_1, in_file_2, properties):
+    # As get_returns_data(), but returns the data as a ReturnsPair. In the
+    # worker processes of a parallel analysis the pair is taken from the
+    # shared memory published by the parent (see share_returns_pairs()).
+    key=returns_key(in_file_1, in_file_2, properties)
+    if key in shared_returns:
+        return shared_returns[key]
+    start_date, end_date, rel_ret_1, rel_ret_2 = get_returns_data(in_file_1, in_file_2, properties)
+    return ReturnsPair(rel_ret_1, rel_ret_2, start_date, end_date)
+
+
+# ReturnsPairs attached to shared memory in this process, keyed by
+# returns_key()
+shared_returns={}
+
+def returns_key(in_file_1, in_file_2, properties):
+    return (in_file_1, in_file_2, str(properties.get('date range')))
+
+
+def share_returns_pairs(data_folder, pairs):
+    # Read the returns of each pair once and copy them into shared memory
+    # blocks that worker processes attach to with attach_shared_returns().
+    # Returns the blocks, which the caller must close and unlink when the
+    # workers are done, and the descriptions to pass to the workers. Pairs
+    # whose data cannot be read are left out; their tasks report the error.
+    blocks=[]
+    descriptions={}
+    for pair in pairs:
+        asset1 = pair.split('-')[0]
+        asset2 = pair.split('-')[1]
+        properties = base.set_pair_properties('modify-defaults/', pair)
+        in_file_1=data_folder+asset1
+        in_file_2=data_folder+asset2
+        key=returns_key(in_file_1, in_file_2, properties)
+        if key in descriptions:
+            continue
+        try:
+            returns=get_returns_pair(in_file_1, in_file_2, properties)
+        except Exception:
+            continue
+        block, descriptions[key] = returns.to_shared_memory()
+        blocks.append(block)
+    return blocks, descriptions
+
+
+def attach_shared_returns(descriptions):
+    # Attach to the ReturnsPairs published by share_returns_pairs(). Used as
+    # the initializer of the worker processes.
+    for key, description in descriptions.items():
+        shared_returns[key]=ReturnsPair.from_shared_memory(description)
+
+
+def time_stamps(dates):
+    # Nanoseconds since 1970-01-01 of an array of dates
+    return np.asarray(pd.DatetimeIndex(dates).asi8,dtype=np.int64)
+
+
+class ReturnsPair:
+    # The aligned returns of a risky and a riskless asset held as contiguous
+    # float64 arrays, so that the analysis can work on integer positions
+    # instead of slicing pandas Series by date:
+    #   R1, R2  : returns of the risky and riskless asset
+    #   a       : R1-R2
+    #   log_R2  : log(R2)
+    #   ratio   : R2/(R2-R1), the leverage at which the day's return is zero
+    #   b       : -(1+R2)/a, the bounds used by the optimal leverage solvers
+    #   time    : int64 time stamps of the samples (see time_stamps())
+    # dates keeps the original DatetimeIndex for labelling results.
+    __slots__=('dates','time','R1','R2','a','log_R2','ratio','b','start_date','end_date','shared')
+
+    # Arrays laid out in shared memory, one row each, by to_shared_memory().
+    # The first row holds the int64 time stamps of the dates.
+    shared_fields=('dates','R1','R2','a','log_R2','ratio','b')
+
+    def __init__(self, rel_ret_1, rel_ret_2, start_date, end_date):
+        self.dates=rel_ret_1.index
+        self.time=time_stamps(self.dates)
+        self.R1=np.ascontiguousarray(rel_ret_1.values,dtype=np.float64)
+        self.R2=np.ascontiguousarray(rel_ret_2.values,dtype=np.float64)
+        self.a=self.R1-self.R2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.log_R2=np.log(self.R2)
+            self.ratio=self.R2/(self.R2-self.R1)
+            self.b=-((1.0+self.R2)/self.a)
+        self.start_date=start_date
+        self.end_date=end_date
+        self.shared=None
+
+    def to_shared_memory(self):
+        # Copy the arrays into a new shared memory block. Returns the block
+        # and a small picklable description that other processes pass to
+        # from_shared_memory() to use the arrays without copying them.
+        n=len(self)
+        block=shared_memory.SharedMemory(create=True,size=max(1,8*n*len(self.shared_fields)))
+        rows=np.ndarray((len(self.shared_fields),n),dtype=np.float64,buffer=block.buf)
+        rows[0].view(np.int64)[:]=self.time
+        for row, field in enumerate(self.shared_fields[1:],1):
+            rows[row]=getattr(self,field)
+        description={'name':block.name,'length':n,
+                     'dates name':self.dates.name,'dates freq':self.dates.freqstr,
+                     'start_date':self.start_date,'end_date':self.end_date}
+        return block, description
+
+    @classmethod
+    def from_shared_memory(cls, description):
+        # A ReturnsPair whose arrays are read-only views of a shared memory
+        # block written by to_shared_memory()
+        returns=cls.__new__(cls)
+        returns.shared=shared_memory.SharedMemory(name=description['name'])
+        rows=np.ndarray((len(cls.shared_fields),description['length']),dtype=np.float64,
+                        buffer=returns.shared.buf)
+        rows.flags.writeable=False
+        returns.dates=pd.DatetimeIndex(rows[0].view('datetime64[ns]'),name=description['dates name'],
+                                       freq=description['dates freq'])
+        returns.time=rows[0].view(np.int64)
+        for row, field in enumerate(cls.shared_fields[1:],1):
+            setattr(returns,field,rows[row])
+        returns.start_date=description['start_date']
+        returns.end_date=description['end_date']
+        return returns
+
+    def __len__(self):
+        return self.R1.shape[0]
+
+    def windows(self, window_starts, window_ends):
+        # Convert windows given as [start date, end date] (both ends included,
+        # as in label slicing of a Series) into integer positions [start, end).
+        # Works at any sampling frequency, daily or intraday.
+        starts=np.searchsorted(self.time,time_stamps(window_starts),side='left')
+        ends=np.searchsorted(self.time,time_stamps(window_ends),side='right')
+        return starts.astype(np.int64), ends.astype(np.int64)
+
+    def window(self, window_start, window_end):
+        # Integer positions [start, end) of a single window
+        starts, ends = self.windows([window_start],[window_end])
+        return int(starts[0]), int(ends[0])
+
+
+def previous_rows(filename, index, columns=None):
+    # The number of leading rows of index covered by results saved by an
+    # earlier run that can be extended instead of being computed again, or 0
+    # if there are none. Saved results with different columns from those
+    # given are not used. Only the labels are read. It is assumed that the
+    # returns on the dates they cover have not changed since.
+    if not store.exists(filename):
+        return 0
+    values, header, saved_index, saved_columns = store.open_values(filename)
+    n=len(saved_index)
+    if n==0 or n>len(index) or not saved_index.equals(index[:n]):
+        return 0
+    if columns is not None and not np.array_equal(np.asarray(saved_columns),np.asarray(columns)):
+        return 0
+    return n
+
+def previous_results(filename, index, columns=None):
+    # The saved results that can be extended (see previous_rows), or None
+    if previous_rows(filename, index, columns)==0:
+        return None
+    return store.load(filename)
+
+@instrument.measured('grid')
+def grid(data_folder, analysis_folder, pair, models=None, append=False, pickle_export=False,
+         memory_budget=None, precision='float64'):
  print(" ", pair, ": sm.grid()")
+ # All three market models by default
+ if models is None:
+  models=[1, 2, 3]
  # Extract the individual asset codes from the asset pair
  asset1 = pair.split('-')[0]
  asset2 = pair.split('-')[1]
@@ -83,45 +253,244 @@ def grid(data_folder, analysis_folder, pair):
  properties = base.set_pair_properties('modify-defaults/', pair)
 
  #Read in returns data
- in_file_1=data_folder+asset1+".pkl" #risky
- in_file_2=data_folder+asset2+".pkl" #riskless
- start_date, end_date, rel_ret_1, rel_ret_2 = get_returns_data(in_file_1, in_file_2, properties)
+ in_file_1=data_folder+asset1 #risky
+ in_file_2=data_folder+asset2 #riskless
+ returns = get_returns_pair(in_file_1, in_file_2, properties)
+ start_date, end_date = returns.start_date, returns.end_date
  print("  Using date range "+str(start_date)+ ' - '+str(end_date))
 
+ Delta_t=end_date-start_date
+ years=Delta_t.days/365.25
+
 #Set range of leverages avoiding bankruptcy
- min_leverage=-abs(rel_ret_2/(rel_ret_2-rel_ret_1)[rel_ret_2/(rel_ret_2-rel_ret_1)<0]).min()
- max_leverage=abs(rel_ret_2/(rel_ret_2-rel_ret_1)[rel_ret_2/(rel_ret_2-rel_ret_1)>0]).min()
+ min_leverage=-np.abs(returns.ratio[returns.ratio<0]).min()
+ max_leverage=np.abs(returns.ratio[returns.ratio>0]).min()
 
  delta_leverage=max_leverage-min_leverage
  leverage_step_size=delta_leverage/leverage_resolution
  leverage_range=np.arange(min_leverage+eps,max_leverage-eps,leverage_step_size)
 
-#Set up the relative return array (function of time and leverage)
- rel_ret_l=pd.DataFrame(index=rel_ret_1.index,columns=leverage_range)
+#Keep the aligned returns with the grids, so that the equity for any leverage
+#can be calculated later without reading a grid (see GridResult)
+ store.save(pd.DataFrame({'R1':returns.R1,'R2':returns.R2},index=returns.dates),
+            analysis_folder+pair+'_returns',pickle_export)
 
-#Model 1 (simplest case)
- for l in range (0,leverage_range.shape[0]):
-     rel_ret_l.iloc[:,l]=model_1(leverage_range[l],rel_ret_1,rel_ret_2)
- rel_ret_l.to_pickle(analysis_folder+pair+'-1.pkl')
+#Calculate the relative return array (function of time and leverage) for each
+#model and write it to file, together with a compact summary of the final
+#equity for each leverage
+ for model in models:
+  outfile=analysis_folder+pair+'-'+str(model)
+  summary_file=analysis_folder+pair+'-'+str(model)+'_summary'
+  # In append mode a saved grid over the same leverages is extended by the
+  # rows for the new dates, and its summary carried forward over them
+  # Given a memory budget (in MB) the grid is computed and written a
+  # block of rows at a time rather than held in memory as a whole
+  if memory_budget is not None:
+   block_rows=grid_block_rows(memory_budget,len(leverage_range))
+   summary=grid_in_blocks(returns,leverage_range,model,friction,short_rate,long_rate,years,
+                          outfile,summary_file,block_rows,precision,append,pickle_export)
+   store.save(summary,summary_file,pickle_export)
+   continue
+  previous=None
+  if append and store.exists(summary_file):
+   previous=previous_results(outfile,returns.dates,leverage_range)
+  if previous is not None:
+   n=len(previous)
+   print("  Extending model "+str(model)+" grid from "+str(previous.index[-1]))
+   rel_ret_l=leveraged_return_grid(leverage_range,returns.R1[n:],returns.R2[n:],model,friction,short_rate,long_rate)
+   # Leverages that went bankrupt stay bankrupt
+   if model!=1:
+    rel_ret_l[:,np.isnan(previous.values[-1])]=np.nan
+   rel_ret_l=pd.concat([previous,pd.DataFrame(rel_ret_l,index=returns.dates[n:],columns=previous.columns)])
+   store.save(rel_ret_l,outfile,pickle_export,precision)
+   summary=grid_summary(rel_ret_l,years,previous=store.load(summary_file),first_row=n)
+  else:
+   rel_ret_l=leveraged_return_grid(leverage_range,returns.R1,returns.R2,model,friction,short_rate,long_rate)
+   rel_ret_l=pd.DataFrame(rel_ret_l,index=returns.dates,columns=leverage_range)
+   store.save(rel_ret_l,outfile,pickle_export,precision)
+   summary=grid_summary(rel_ret_l,years)
+  store.save(summary,summary_file,pickle_export)
+ return
 
-#Model 2 with friction
- for l in range (0,leverage_range.shape[0]):
-  rel_ret_l.iloc[:,l]=model_2(leverage_range[l],friction,rel_ret_1,rel_ret_2)
-#Check if bankruptcy has occurred, declare future returns nan
- rel_ret_l[rel_ret_l<0]=np.nan
- for t in range (1,rel_ret_2.shape[0]):
-  rel_ret_l.iloc[t,:]=rel_ret_l.iloc[t,:]+np.where(rel_ret_l.iloc[t-1,:].isna(),np.nan,0)
- rel_ret_l.to_pickle(analysis_folder+pair+'-2.pkl')
+def grid_summary(rel_ret_l, years, block_size=4096, previous=None, first_row=0):
+    # Reduce a grid of leveraged returns (time x leverage) to one row per
+    # leverage containing the final log-equity, the time-averaged growth rate
+    # and the date of bankruptcy (NaT if the leverage never goes bankrupt).
+    # The log-equity is accumulated as a running sum of log returns over
+    # blocks of rows, so long series can neither overflow nor underflow the
+    # way np.cumprod can, and only one block of logs is held in memory.
+    # Given the summary of the rows before first_row as previous, the sums
+    # are carried on from it and only the later rows are read.
+    values=np.asarray(rel_ret_l,dtype=np.float64)
+    T,L=values.shape
+    log_equity, bankruptcy_day = summary_state(L, rel_ret_l.index, previous)
+    for start in range(first_row,T,block_size):
+        accumulate_summary(values[start:start+block_size], start, log_equity, bankruptcy_day)
+    return summary_frame(log_equity, bankruptcy_day, rel_ret_l.index, rel_ret_l.columns, years)
 
-#Model 3 with friction and borrowing costs
- for l in range (0,leverage_range.shape[0]):
-  rel_ret_l.iloc[:,l]=model_3(leverage_range[l],friction,short_rate,long_rate,rel_ret_1,rel_ret_2)
- #Check if bankruptcy has occurred, declare future returns nan
- rel_ret_l[rel_ret_l<0]=np.nan
- for t in range (1,rel_ret_2.shape[0]):
-  rel_ret_l.iloc[t,:]=rel_ret_l.iloc[t,:]+np.where(rel_ret_l.iloc[t-1,:].isna(),np.nan,0)
- rel_ret_l.to_pickle(analysis_folder+pair+'-3.pkl')
- return
+def summary_state(L, dates, previous=None):
+    # Running log-equity and day of bankruptcy (-1 if none yet) of each
+    # leverage, either starting afresh or carried on from a previous summary
+    log_equity=np.zeros(L)
+    bankruptcy_day=np.full(L,-1,dtype=np.int64)
+    if previous is not None:
+        log_equity=previous['log_equity'].values.copy()
+        went_bankrupt=previous['bankruptcy_date'].notna().values
+        bankruptcy_day[went_bankrupt]=dates.get_indexer(previous['bankruptcy_date'][went_bankrupt])
+    return log_equity, bankruptcy_day
+
+def accumulate_summary(block, start, log_equity, bankruptcy_day):
+    # Add a block of rows of the grid, starting at row start, to the running
+    # log-equity and bankruptcy days (updated in place)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_equity+=np.log(block).sum(axis=0)
+    # Bankrupt leverages have nan returns from the day of bankruptcy
+    bankrupt=np.isnan(block)
+    new=(bankruptcy_day<0) & bankrupt.any(axis=0)
+    bankruptcy_day[new]=start+bankrupt[:,new].argmax(axis=0)
+
+def summary_frame(log_equity, bankruptcy_day, dates, leverages, years):
+    bankruptcy_date=pd.Series(pd.NaT,index=leverages,dtype='datetime64[ns]')
+    went_bankrupt=bankruptcy_day>=0
+    bankruptcy_date[went_bankrupt]=dates[bankruptcy_day[went_bankrupt]]
+
+    summary=pd.DataFrame({'log_equity':log_equity,
+                          'growth_rate':log_equity/years,
+                          'bankruptcy_date':bankruptcy_date.values},
+                         index=leverages)
+    summary.index.names=['leverage']
+    return summary
+
+def grid_block_rows(memory_budget, L):
+    # Number of rows of a T x L grid to compute at a time so that the working
+    # arrays stay within memory_budget (in MB). Computing a block of model 3
+    # takes around 8 float64 arrays of its size.
+    return max(1, int(memory_budget*2**20)//(8*8*L))
+
+def grid_in_blocks(returns, leverage_range, model, friction, short_rate, long_rate, years,
+                   outfile, summary_file, block_rows, precision='float64', append=False, pickle_export=False):
+    # Calculate the grid of leveraged returns and its summary a block of rows
+    # at a time, writing each block straight to the store, so that memory use
+    # does not grow with the length of the series or the number of leverages.
+    # The running log-equity, the bankruptcy days and the leverages that have
+    # gone bankrupt are carried over from one block to the next.
+    dates=returns.dates
+    T,L=len(dates),len(leverage_range)
+    # In append mode the rows of a saved grid over the same leverages are
+    # copied over, and its summary carried forward from them
+    n=0
+    if append and store.exists(summary_file):
+        n=previous_rows(outfile,dates,leverage_range)
+    writer=store.create(outfile,dates,pd.Index(leverage_range),precision)
+    if n>0:
+        print("  Extending model "+str(model)+" grid from "+str(dates[n-1]))
+        log_equity, bankruptcy_day = summary_state(L, dates, store.load(summary_file))
+        previous=store.open_values(outfile)[0]
+        for start in range(0,n,block_rows):
+            store.write_rows(writer, start, previous[start:min(start+block_rows,n)])
+        bankrupt=np.isnan(previous[n-1])
+    else:
+        log_equity, bankruptcy_day = summary_state(L, dates)
+        bankrupt=np.zeros(L,dtype=bool)
+    for start in range(n,T,block_rows):
+        end=min(start+block_rows,T)
+        block=leveraged_return_grid(leverage_range,returns.R1[start:end],returns.R2[start:end],
+                                    model,friction,short_rate,long_rate)
+        # Leverages that went bankrupt in an earlier block stay bankrupt
+        if model!=1:
+            block[:,bankrupt]=np.nan
+            bankrupt=np.isnan(block[-1])
+        # The summary is taken from the float64 values whatever the
+        # precision the grid is stored in
+        accumulate_summary(block, start, log_equity, bankruptcy_day)
+        store.write_rows(writer, start, block)
+    store.finish(writer)
+    if pickle_export:
+        store.load(outfile).to_pickle(outfile+'.pkl')
+    return summary_frame(log_equity, bankruptcy_day, dates, pd.Index(leverage_range), years)
+
+class GridResult:
+    # Read access to the results of grid() for one pair and model, as used by
+    # the figures. Everything is read through the cache in results.py, so
+    # figures of the same pair share the summary and trajectories. Equity
+    # trajectories are calculated for just the leverages asked for from the
+    # aligned returns saved with the grids, so the T x L grid itself is never
+    # loaded.
+    def __init__(self, analysis_folder, pair, model=1):
+        self.analysis_folder=analysis_folder
+        self.pair=pair
+        self.model=model
+        self.filename=analysis_folder+pair+'-'+str(model)
+
+    def summary(self):
+        return results.load(self.filename+'_summary')
+
+    def leverages(self):
+        return self.summary().index
+
+    def final_equity(self, leverage=None):
+        # Final equity for each leverage of the grid, or for the leverage
+        # values given
+        if leverage is not None:
+            return self.trajectory(leverage).iloc[-1]
+        return np.exp(self.summary()['log_equity'])
+
+    def growth_curve(self):
+        # Time-averaged growth rate as a function of leverage
+        return self.summary()['growth_rate']
+
+    def solvent_range(self):
+        # Smallest and largest leverage of the grid. The grid spans the
+        # leverages between the bankruptcy bounds of the pair.
+        leverages=self.leverages()
+        return leverages[0], leverages[-1]
+
+    def solvent(self, leverage):
+        # Leverage values moved into the solvent range where they are outside
+        # it, for figures plotting fixed leverages for any pair
+        lower, upper=self.solvent_range()
+        return np.clip(np.asarray(leverage,dtype=np.float64),lower,upper).tolist()
+
+    def trajectory(self, leverage):
+        # Equity over time, starting from 1, for a leverage value or a list of
+        # them, with one column per leverage. Leverages outside the solvent
+        # range are rejected.
+        leverages=tuple(np.atleast_1d(np.asarray(leverage,dtype=np.float64)).tolist())
+        lower, upper=self.solvent_range()
+        tolerance=1e-9*(upper-lower)
+        outside=[l for l in leverages if not lower-tolerance <= l <= upper+tolerance]
+        if outside:
+            raise ValueError('Leverages '+', '.join(str(l) for l in outside)+' are outside the solvent range ['
+                             +str(lower)+', '+str(upper)+'] of '+self.pair)
+        returns_file=self.analysis_folder+self.pair+'_returns'
+        if store.exists(returns_file):
+            files=[returns_file+store.VALUES,returns_file+store.LABELS,'model_parameters.yaml']
+        else:
+            files=[self.filename+store.VALUES,self.filename+store.LABELS]
+        return results.memoize(equity_trajectory,(self.analysis_folder,self.pair,self.model,leverages),files)
+
+def equity_trajectory(analysis_folder, pair, model, leverages):
+    # Equity over time for each of the leverages, calculated from the aligned
+    # returns saved by grid()
+    leverages=np.asarray(leverages,dtype=np.float64)
+    returns_file=analysis_folder+pair+'_returns'
+    if store.exists(returns_file):
+        returns=results.load(returns_file)
+        params=base.read_model_parameters()[pair.split('-')[0]]
+        rel_ret_l=leveraged_return_grid(leverages,returns['R1'],returns['R2'],model,
+                                        params['friction'],params['short rate'],params['long rate'])
+        dates=returns.index
+    else:
+        # Grids saved without their returns: only the columns of the nearest
+        # leverages in the grid are read
+        values, header, dates, columns = store.open_values(analysis_folder+pair+'-'+str(model))
+        positions=[int(np.abs(columns.values-l).argmin()) for l in leverages]
+        rel_ret_l=np.array(values[:,positions],dtype=np.float64)
+        leverages=columns.values[positions]
+    rel_ret_l=pd.DataFrame(rel_ret_l,index=dates,columns=pd.Index(leverages,name='leverage'))
+    # Equity is undefined from the first day it is not positive (bankruptcy)
+    equity=rel_ret_l.cumprod()
+    return equity.where((equity>0).cummin())
 
 #function to fit data: needs to be found
 def return_parabola(x, a, xm, b):
@@ -134,7 +503,8 @@ def print_fit_summary(fit_parameters, pair):
     print("    Optimal leverage (model 3) = ", fit_parameters['lopt_3'])
     return
 
-def fit_parameters(data_folder, analysis_folder, pair):
+@instrument.measured('fit')
+def fit_parameters(data_folder, analysis_folder, pair, solver_statistics=False):
  print(" ", pair, ": sm.fit_parameters()")
  # Extract the individual asset codes from the asset pair
  asset1 = pair.split('-')[0]
@@ -148,9 +518,10 @@ def fit_parameters(data_folder, analysis_folder, pair):
  properties = base.set_pair_properties('modify-defaults/', pair)
 
  # Read the returns data for both assets
- in_file_1=data_folder+asset1+".pkl" #risky
- in_file_2=data_folder+asset2+".pkl" #riskless
- start_date, end_date, rel_ret_1, rel_ret_2 = get_returns_data(in_file_1, in_file_2, properties)
+ in_file_1=data_folder+asset1 #risky
+ in_file_2=data_folder+asset2 #riskless
+ returns = get_returns_pair(in_file_1, in_file_2, properties)
+ start_date, end_date = returns.start_date, returns.end_date
 
  print("  Using date range "+str(start_date)+ ' - '+str(end_date))
 
@@ -158,30 +529,37 @@ def fit_parameters(data_folder, analysis_folder, pair):
  years=Delta_t.days/365.25
 
 #Find range of leverages avoiding bankruptcy
- min_leverage=-abs(rel_ret_2/(rel_ret_2-rel_ret_1)[rel_ret_2/(rel_ret_2-rel_ret_1)<0]).min()
- max_leverage=abs(rel_ret_2/(rel_ret_2-rel_ret_1)[rel_ret_2/(rel_ret_2-rel_ret_1)>0]).min()
+ min_leverage=-np.abs(returns.ratio[returns.ratio<0]).min()
+ max_leverage=np.abs(returns.ratio[returns.ratio>0]).min()
 
 #find optimal leverages for all models
- lopt_1, eq1 =calculate_optimal_leverage(rel_ret_1,rel_ret_2,[start_date,end_date], 1, params[asset1],bounds=(min_leverage,max_leverage))
- lopt_2, eq2 =calculate_optimal_leverage(rel_ret_1,rel_ret_2,[start_date,end_date], 2, params[asset1],bounds=(min_leverage,max_leverage))
- lopt_3, eq3 =calculate_optimal_leverage(rel_ret_1,rel_ret_2,[start_date,end_date], 3, params[asset1],bounds=(min_leverage,max_leverage))
+ if solver_statistics:
+  solver_stats.start()
+ lopt_1, eq1 =calculate_optimal_leverage(returns,[start_date,end_date], 1, params[asset1],bounds=(min_leverage,max_leverage))
+ if solver_statistics:
+  solver_stats.write(analysis_folder+pair+'-1_solver_fit', returns.dates)
+  solver_stats.start()
+ lopt_2, eq2 =calculate_optimal_leverage(returns,[start_date,end_date], 2, params[asset1],bounds=(min_leverage,max_leverage))
+ if solver_statistics:
+  solver_stats.write(analysis_folder+pair+'-2_solver_fit', returns.dates)
+  solver_stats.start()
+ lopt_3, eq3 =calculate_optimal_leverage(returns,[start_date,end_date], 3, params[asset1],bounds=(min_leverage,max_leverage))
+ if solver_statistics:
+  solver_stats.write(analysis_folder+pair+'-3_solver_fit', returns.dates)
 
  lopt_fix=lopt_1
  opt_growth=- eq1/years
 
- leveraged_returns=pd.read_pickle(analysis_folder+pair+"-1.pkl")
- leveraged_equity=np.cumprod(leveraged_returns)
- final_leveraged_equity=leveraged_equity[-1:].T
-  # Reformat this to a sensible configuration
- final_leveraged_equity.columns = ['equity']
- final_leveraged_equity.index.names = ['leverage']
- final_leveraged_equity = final_leveraged_equity.astype({'equity':'float64'})
- leveraged_growth=np.log(final_leveraged_equity)/years
+ # Growth rates for the grid of leverages are read from the summary written
+ # by grid() rather than from the full grid of returns
+ leveraged_growth=store.load(analysis_folder+pair+"-1_summary",columns=['growth_rate'])['growth_rate']
 
 #create x and y data to be used for curve fitting
  l_input=np.array(leveraged_growth.index[50:-50])
- g_input=np.array(leveraged_growth.iloc[50:-50,0])
+ g_input=np.array(leveraged_growth.iloc[50:-50])
 
+ # lmfit is only needed here, so it is not imported with the module
+ from lmfit import Model, Parameters
  fmodel = Model(return_parabola)
  params = Parameters()
  params.add('a', value=.5, vary=True)
@@ -203,8 +581,8 @@ def fit_parameters(data_folder, analysis_folder, pair):
                 'sigma_est':sigma,
                 'mu_riskless_est':mu_r,
                 'mu_excess_est':mu_e,
-                'g_riskless_measured':np.log(np.cumprod(rel_ret_2)[-1])/years,
-                'g_risky_measured':np.log(np.cumprod(rel_ret_1)[-1])/years,
+                'g_riskless_measured':returns.log_R2.sum()/years,
+                'g_risky_measured':np.log(returns.R1).sum()/years,
                 'lopt_1':lopt_1,
                 'lopt_2':lopt_2,
                 'lopt_3':lopt_3,
@@ -214,51 +592,981 @@ def fit_parameters(data_folder, analysis_folder, pair):
  return(fit_parameters)
 
 
-def calculate_optimal_leverage(rel_ret_1,rel_ret_2,time_window,model,model_parameters, bounds=(-500.0,500.0)):
+def calculate_optimal_leverage(returns,time_window,model,model_parameters, bounds=(-500.0,500.0),
+                               method='newton', guess=None, tol=1e-8):
+    # Optimal leverage is found by maximising the final log-equity. The default
+    # method='newton' uses the analytic derivatives of the log-growth with a
+    # safeguarded Newton iteration, optionally warm-started from guess (e.g.
+    # the optimum for a neighbouring window). method='scipy' uses
+    # scipy.optimize.minimize_scalar on leveraged_return() and is kept for
+    # cross-checking.
     friction=model_parameters['friction']
     long_rate=model_parameters['long rate']
     short_rate=model_parameters['short rate']
 
-    R1=rel_ret_1[time_window[0]:time_window[1]].values
-    R2=rel_ret_2[time_window[0]:time_window[1]].values
+    start, end = returns.window(time_window[0],time_window[1])
+    R1=returns.R1[start:end]
+    R2=returns.R2[start:end]
 
     # There are 4 cases based on the properties of the array of differences
     # between the risky and riskless returns in the window
-    a = R1 - R2
+    a = returns.a[start:end]
 
     if (a == 0.0).all():
         # Optimal leverage is undefined if the returns on the two assets are
         # always equal
         #print(time_window, ' l_opt undefined.')
+        if solver_stats.enabled:
+            solver_stats.record(start, end, 'undefined')
         return 0.0, 1.0
     elif (a > 0.0).all():
         # Optimal leverage is infinite if the return on the risky asset always
         # exceeds the return on the riskless asset
         #print(time_window, ' l_opt infinite.')
+        if solver_stats.enabled:
+            solver_stats.record(start, end, 'infinite')
         return np.inf, np.inf
     elif (a < 0.0).all():
         # Optimal leverage is negative infinite if the return on the riskless asset always
         # exceeds the return on the risky asset
         #print(time_window, ' l_opt negative infinite. L = ', (time_window[1]-time_window[0]).days)
+        if solver_stats.enabled:
+            solver_stats.record(start, end, 'negative infinite')
         return -np.inf, np.inf
     else:
         # Otherwise optimal leverage is in a bounded interval and should be found
         # by optimising the total equity
 
-        # First find lower and upper bounds. It's OK if we get some divisions
-        # by zero since the resulting -np.inf will never be the lower bound
-        with np.errstate(divide='ignore'):
-            b = -((1.0+R2)/a)
+        # First find lower and upper bounds from the ratios b=-(1+R2)/a. Where
+        # a is zero b is -np.inf, which will never be the lower bound
+        b = returns.b[start:end]
 
-        lower = max(np.where(b<0.0, b, -np.inf))
-        upper = min(np.where(b>0.0,b,np.inf))
+        lower = np.max(np.where(b<0.0, b, -np.inf))
+        upper = np.min(np.where(b>0.0,b,np.inf))
         # Perform optimisation
+        clock=time.perf_counter()
+        if method=='newton' and np.isfinite(lower) and np.isfinite(upper):
+            counts=solver_stats.counters()
+            x, fun = newton_optimal_leverage(R1,R2,lower,upper,model,friction,long_rate,short_rate,
+                                             guess=guess,tol=tol,counts=counts)
+            if solver_stats.enabled:
+                solver_stats.record(start, end, solver_stats.with_bound('newton',x,lower,upper),
+                                    counts['iterations'], counts['evaluations'], counts['bracket'],
+                                    time.perf_counter()-clock)
+            return x, fun
+        import scipy.optimize
         with np.errstate(invalid='ignore', divide='ignore', over='ignore', under='ignore'):
             res = scipy.optimize.minimize_scalar(leveraged_return,  args =(R1,R2,friction, long_rate, short_rate, model),
                 bounds=(lower,upper), method='bounded')
+        if solver_stats.enabled:
+            solver_stats.record(start, end, solver_stats.with_bound('scipy',res.x,lower,upper), res.nit, res.nfev,
+                                seconds=time.perf_counter()-clock)
         return res.x, res.fun
 
 
+def leveraged_log_growth(l,rel_ret_1,rel_ret_2,friction, long_rate, short_rate, model, value=True):
+    # Final log-equity G(l) = sum_t log r_t(l) for leverage l, together with
+    # its first and second derivatives with respect to l. The leveraged return
+    # r_t(l) of every model is piecewise quadratic in l with kinks at l=0 and
+    # l=1, so on each piece the derivatives are known in closed form:
+    #   G'(l)  = sum_t r_t'(l)/r_t(l)
+    #   G''(l) = sum_t r_t''(l)/r_t(l) - (r_t'(l)/r_t(l))**2
+    # The first return value is False if the leverage leads to bankruptcy
+    # (some r_t(l) <= 0), in which case G and its derivatives are undefined.
+    # With value=False the (comparatively expensive) logarithms are skipped
+    # and G is returned as nan.
+    a=rel_ret_1-rel_ret_2
+#Model 1 (simplest case)
+    r=rel_ret_2+l*a
+    dr=a
+    d2g=0.0
+#Model 2 with friction. Within a piece the friction term is
+#  -friction*|a|*s*l*(1-l) with s = sign(l*(1-l)) fixed
+    if model>=2:
+        s=np.sign(l*(1.0-l))
+        fa=friction*np.abs(a)
+        r=r-(s*l*(1.0-l))*fa
+        dr=dr-(s*(1.0-2.0*l))*fa
+#Model 3 with friction and borrowing costs
+    if model==3:
+        if l<0:
+            r=r+l*short_rate
+            dr=dr+short_rate
+        elif l>1:
+            r=r-(l-1.0)*long_rate
+            dr=dr-long_rate
+
+    if not r.min()>0.0:
+        return False, -np.inf, np.nan, np.nan
+    x=dr/r
+    if model>=2:
+        d2g=2.0*s*np.sum(fa/r)
+    d2g=d2g-np.dot(x,x)
+    g=np.log(r).sum() if value else np.nan
+    return True, g, x.sum(), d2g
+
+
+def newton_optimal_leverage(rel_ret_1,rel_ret_2,lower,upper,model,friction,long_rate,short_rate,
+                            guess=None, tol=1e-8, max_iter=200, counts=None):
+    # Maximise the final log-equity on (lower, upper). For model 1 the
+    # log-growth is strictly concave so a single safeguarded Newton solve on
+    # the whole interval suffices. For models 2 and 3 it is only smooth on the
+    # pieces (lower, 0), (0, 1) and (1, upper). The outer pieces are concave,
+    # but friction can make the middle piece convex so that both kinks are
+    # local maxima. Each piece is therefore searched separately and the best
+    # candidate is kept. The work done is added to counts (see
+    # solver_stats.counters()), if given, along with the final bracket of the
+    # piece of the optimum.
+    if counts is None:
+        counts=solver_stats.counters()
+    args=(rel_ret_1,rel_ret_2,friction,long_rate,short_rate,model)
+    if model==1:
+        x=safeguarded_newton(lower,upper,guess,args,tol,max_iter,counts)
+        candidates=[x]
+        brackets=[counts['bracket']]
+    else:
+        # One-sided derivatives just either side of the kinks
+        dg_0_left=leveraged_log_growth(np.nextafter(0.0,-1.0),*args,value=False)[2]
+        dg_0_right=leveraged_log_growth(np.nextafter(0.0,1.0),*args,value=False)[2]
+        dg_1_left=leveraged_log_growth(np.nextafter(1.0,0.0),*args,value=False)[2]
+        dg_1_right=leveraged_log_growth(np.nextafter(1.0,2.0),*args,value=False)[2]
+        counts['evaluations']+=4
+
+        candidates=[0.0,1.0]
+        brackets=[0.0,0.0]
+        pieces=[(dg_0_left<0.0, lower, 0.0),
+                (dg_0_right>0.0 and dg_1_left<0.0, 0.0, 1.0),
+                (dg_1_right>0.0, 1.0, upper)]
+        for needed, lo, hi in pieces:
+            if needed:
+                candidates.append(safeguarded_newton(lo,hi,guess,args,tol,max_iter,counts))
+                brackets.append(counts['bracket'])
+
+    best_x=candidates[0]
+    best_g=-np.inf
+    best_bracket=brackets[0]
+    for x, bracket in zip(candidates, brackets):
+        feasible, g, dg, d2g = leveraged_log_growth(x,*args)
+        counts['evaluations']+=1
+        if feasible and g>best_g:
+            best_x=x
+            best_g=g
+            best_bracket=bracket
+    counts['bracket']=best_bracket
+    return best_x, -best_g
+
+
+def safeguarded_newton(lo,hi,guess,args,tol=1e-8,max_iter=200,counts=None):
+    # Find a maximum of the log-growth in (lo, hi) by Newton's method on G',
+    # safeguarded by bisection. The bracket is shrunk so that G'(lo) > 0 and
+    # G'(hi) < 0 throughout, so the iteration cannot escape and converges to
+    # an end of the interval if G' does not change sign inside it.
+    #
+    # For every model the set of leverages avoiding bankruptcy is an interval
+    # containing [0, 1], so a bankrupt leverage below 0.5 means the optimum is
+    # further right and one above 0.5 means it is further left. The
+    # iterations are added to counts, if given, and the final bracket width
+    # stored in it.
+    if guess is not None and np.isfinite(guess) and lo<guess<hi:
+        x=float(guess)
+    elif lo<0.0<hi:
+        x=0.0
+    elif hi<=0.0:
+        x=np.nextafter(hi,lo)
+    else:
+        x=np.nextafter(lo,hi)
+    dx_old=hi-lo
+    dx=dx_old
+    for i in range(max_iter):
+        feasible, g, dg, d2g = leveraged_log_growth(x,*args,value=False)
+        if not feasible:
+            dg=np.inf if x<0.5 else -np.inf
+        if dg>0.0:
+            lo=x
+        elif dg<0.0:
+            hi=x
+        else:
+            break
+
+        # Take the Newton step if the curvature has the right sign, the step
+        # stays inside the bracket and it is shrinking fast enough. Otherwise
+        # bisect.
+        dx_older=dx_old
+        dx_old=dx
+        if feasible and d2g<0.0:
+            x_new=x-dg/d2g
+        else:
+            x_new=np.nan
+        if not (lo<x_new<hi) or abs(x_new-x)>0.5*abs(dx_older):
+            x_new=0.5*(lo+hi)
+        dx=x_new-x
+        x=x_new
+        if abs(dx)<tol or hi-lo<tol:
+            break
+    if counts is not None:
+        counts['iterations']+=i+1
+        counts['evaluations']+=i+1
+        counts['bracket']=hi-lo
+    return x
+
+
+def calculate_optimal_leverage_windows(returns,starts,ends,model,model_parameters,
+                                       guess=None, tol=1e-8, batch_size=2**15):
+    # Batched version of calculate_optimal_leverage() for many windows of a
+    # ReturnsPair. Window i covers the samples at positions
+    # starts[i] <= t < ends[i] (see ReturnsPair.windows()). All windows are
+    # solved together: the samples of a batch of windows are laid end to end
+    # in flat arrays and every Newton iteration works on all of them at once,
+    # reducing per window with np.add.reduceat. Batches hold roughly
+    # batch_size samples. Returns arrays of optimal leverages and of the
+    # corresponding negative final log-equity.
+    friction=model_parameters['friction']
+    long_rate=model_parameters['long rate']
+    short_rate=model_parameters['short rate']
+
+    R1=returns.R1
+    R2=returns.R2
+    starts=np.asarray(starts,dtype=np.int64)
+    ends=np.asarray(ends,dtype=np.int64)
+    lengths=np.maximum(ends-starts,0)
+    n_windows=starts.shape[0]
+    if guess is None:
+        guess=np.nan
+    guess=np.broadcast_to(np.asarray(guess,dtype=np.float64),(n_windows,))
+
+    lopt=np.empty(n_windows)
+    fun=np.empty(n_windows)
+
+    # The same 4 cases as in calculate_optimal_leverage(), classified from
+    # prefix counts of the sign of the differences between the returns
+    a=returns.a
+    n_pos=np.concatenate(([0],np.cumsum(a>0.0)))
+    n_neg=np.concatenate(([0],np.cumsum(a<0.0)))
+    n_pos=n_pos[starts+lengths]-n_pos[starts]
+    n_neg=n_neg[starts+lengths]-n_neg[starts]
+    # Optimal leverage is undefined if the returns on the two assets are
+    # always equal
+    undefined=(n_pos==0) & (n_neg==0)
+    lopt[undefined]=0.0
+    fun[undefined]=1.0
+    # Infinite if the return on one asset always exceeds the other
+    positive=(n_pos==lengths) & ~undefined
+    lopt[positive]=np.inf
+    fun[positive]=np.inf
+    negative=(n_neg==lengths) & ~undefined
+    lopt[negative]=-np.inf
+    fun[negative]=np.inf
+    if solver_stats.enabled:
+        for name, chosen in [('undefined',undefined),('infinite',positive),('negative infinite',negative)]:
+            solver_stats.record(starts[chosen],ends[chosen],name)
+
+    # Otherwise optimal leverage is in a bounded interval
+    bounded=np.flatnonzero(~(undefined | positive | negative))
+    if bounded.shape[0]==0:
+        return lopt, fun
+    b_lower=np.where(returns.b<0.0,returns.b,-np.inf)
+    b_upper=np.where(returns.b>0.0,returns.b,np.inf)
+    fa=friction*np.abs(a)
+
+    # Split the bounded windows into batches of about batch_size samples
+    batch_id=(np.cumsum(lengths[bounded])-1)//batch_size
+    for batch in np.split(bounded,np.flatnonzero(np.diff(batch_id))+1):
+        idx,offsets=segment_index(starts[batch],lengths[batch])
+        lower=np.maximum.reduceat(b_lower[idx],offsets)
+        upper=np.minimum.reduceat(b_upper[idx],offsets)
+        finite=np.isfinite(lower) & np.isfinite(upper)
+
+        # Windows with an unbounded side are left to the scipy path, as in
+        # calculate_optimal_leverage()
+        if not finite.all():
+            import scipy.optimize
+        for i in np.flatnonzero(~finite):
+            w=batch[i]
+            window=slice(starts[w],ends[w])
+            clock=time.perf_counter()
+            with np.errstate(invalid='ignore', divide='ignore', over='ignore', under='ignore'):
+                res = scipy.optimize.minimize_scalar(leveraged_return,
+                    args =(R1[window],R2[window],friction, long_rate, short_rate, model),
+                    bounds=(lower[i],upper[i]), method='bounded')
+            lopt[w]=res.x
+            fun[w]=res.fun
+            if solver_stats.enabled:
+                solver_stats.record(starts[w],ends[w],solver_stats.with_bound('scipy',res.x,lower[i],upper[i]),
+                                    res.nit,res.nfev,seconds=time.perf_counter()-clock)
+
+        batch=batch[finite]
+        if batch.shape[0]==0:
+            continue
+        clock=time.perf_counter()
+        counts=solver_stats.counters(batch.shape[0]) if solver_stats.enabled else None
+        segments=window_segments(a,R2,fa,starts[batch],lengths[batch],model,long_rate,short_rate)
+        lopt[batch], fun[batch] = batched_newton_optimal_leverage(lower[finite],upper[finite],
+                                        guess[batch],segments,tol,counts=counts)
+        if solver_stats.enabled:
+            solver_stats.record(starts[batch],ends[batch],
+                                solver_stats.with_bound('newton',lopt[batch],lower[finite],upper[finite]),
+                                counts['iterations'],counts['evaluations'],counts['bracket'],
+                                solver_stats.share(time.perf_counter()-clock,counts['evaluations'],lengths[batch]))
+    return lopt, fun
+
+
+def segment_index(starts, lengths):
+    # Flat sample positions of the windows [starts, starts+lengths) laid end
+    # to end, and the offset of each window within the flat array
+    offsets=np.zeros(lengths.shape[0],dtype=np.int64)
+    np.cumsum(lengths[:-1],out=offsets[1:])
+    idx=np.arange(offsets[-1]+lengths[-1])-np.repeat(offsets-starts,lengths)
+    return idx, offsets
+
+
+def window_segments(a, R2, fa, starts, lengths, model, long_rate, short_rate):
+    # Gather the samples of a set of windows into flat arrays, laid end to
+    # end, for use by batched_log_growth(). Everything is kept in a tuple so
+    # that a subset of the windows can be gathered again with
+    # subset_segments().
+    idx,offsets=segment_index(starts,lengths)
+    window_id=np.repeat(np.arange(lengths.shape[0]),lengths)
+    return (a,R2,fa,starts,lengths,model,long_rate,short_rate,
+            a[idx],R2[idx],fa[idx],window_id,offsets)
+
+
+def subset_segments(segments, w):
+    # Restrict the windows described by segments to those in w
+    a,R2,fa,starts,lengths,model,long_rate,short_rate=segments[:8]
+    return window_segments(a,R2,fa,starts[w],lengths[w],model,long_rate,short_rate)
+
+
+def batched_log_growth(l, segments, value=True):
+    # Vectorised leveraged_log_growth() for one leverage per window: returns
+    # per-window arrays of feasibility, G, G' and G''
+    model,long_rate,short_rate=segments[5:8]
+    A,R2,F,window_id,offsets=segments[8:]
+#Model 1 (simplest case)
+    r=R2+l[window_id]*A
+    dr=A
+#Model 2 with friction
+    if model>=2:
+        s=np.sign(l*(1.0-l))
+        r-=(s*l*(1.0-l))[window_id]*F
+        dr=dr-(s*(1.0-2.0*l))[window_id]*F
+#Model 3 with friction and borrowing costs
+    if model==3:
+        r+=np.where(l<0,l*short_rate,np.where(l>1,-(l-1.0)*long_rate,0.0))[window_id]
+        dr+=np.where(l<0,short_rate,np.where(l>1,-long_rate,0.0))[window_id]
+
+    feasible=np.minimum.reduceat(r,offsets)>0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x=dr/r
+        dg=np.add.reduceat(x,offsets)
+        x*=x
+        d2g=-np.add.reduceat(x,offsets)
+        if model>=2:
+            np.divide(F,r,out=x)
+            d2g+=2.0*s*np.add.reduceat(x,offsets)
+        if value:
+            np.log(r,out=r)
+            g=np.add.reduceat(r,offsets)
+        else:
+            g=np.full(l.shape,np.nan)
+    g[~feasible]=-np.inf
+    dg[~feasible]=np.nan
+    d2g[~feasible]=np.nan
+    return feasible, g, dg, d2g
+
+
+def batched_newton_optimal_leverage(lower,upper,guess,segments,tol=1e-8,max_iter=200,counts=None):
+    # Vectorised newton_optimal_leverage() for a batch of windows. The work
+    # done on each window is added to counts (see solver_stats.counters()),
+    # if given, along with the final bracket of the piece of its optimum.
+    n=lower.shape[0]
+    model=segments[5]
+    if model==1:
+        x=batched_safeguarded_newton(lower,upper,guess,segments,tol,max_iter,counts)
+        candidates=[x]
+        brackets=[counts['bracket'] if counts is not None else None]
+    else:
+        # One-sided derivatives just either side of the kinks
+        dg_0_left=batched_log_growth(np.full(n,np.nextafter(0.0,-1.0)),segments,value=False)[2]
+        dg_0_right=batched_log_growth(np.full(n,np.nextafter(0.0,1.0)),segments,value=False)[2]
+        dg_1_left=batched_log_growth(np.full(n,np.nextafter(1.0,0.0)),segments,value=False)[2]
+        dg_1_right=batched_log_growth(np.full(n,np.nextafter(1.0,2.0)),segments,value=False)[2]
+        if counts is not None:
+            counts['evaluations']+=4
+
+        candidates=[np.zeros(n),np.ones(n)]
+        brackets=[np.zeros(n),np.zeros(n)]
+        pieces=[(dg_0_left<0.0, lower, np.zeros(n)),
+                ((dg_0_right>0.0) & (dg_1_left<0.0), np.zeros(n), np.ones(n)),
+                (dg_1_right>0.0, np.ones(n), upper)]
+        for needed, lo, hi in pieces:
+            x=np.full(n,np.nan)
+            bracket=np.full(n,np.nan)
+            w=np.flatnonzero(needed)
+            if w.shape[0]>0:
+                piece_counts=solver_stats.counters(w.shape[0]) if counts is not None else None
+                x[w]=batched_safeguarded_newton(lo[w],hi[w],guess[w],subset_segments(segments,w),tol,max_iter,
+                                                piece_counts)
+                if counts is not None:
+                    counts['iterations'][w]+=piece_counts['iterations']
+                    counts['evaluations'][w]+=piece_counts['evaluations']
+                    bracket[w]=piece_counts['bracket']
+            candidates.append(x)
+            brackets.append(bracket)
+
+    best_x=candidates[0].copy()
+    best_g=np.full(n,-np.inf)
+    best_bracket=np.copy(brackets[0])
+    for x, bracket in zip(candidates, brackets):
+        w=np.flatnonzero(~np.isnan(x))
+        if w.shape[0]==0:
+            continue
+        if w.shape[0]<n:
+            feasible, g, dg, d2g = batched_log_growth(x[w],subset_segments(segments,w))
+        else:
+            feasible, g, dg, d2g = batched_log_growth(x,segments)
+        better=feasible & (g>best_g[w])
+        best_x[w[better]]=x[w[better]]
+        best_g[w[better]]=g[better]
+        if counts is not None:
+            counts['evaluations'][w]+=1
+            best_bracket[w[better]]=bracket[w[better]]
+    if counts is not None:
+        counts['bracket']=best_bracket
+    return best_x, -best_g
+
+
+def batched_safeguarded_newton(lo,hi,guess,segments,tol=1e-8,max_iter=200,counts=None):
+    # Vectorised safeguarded_newton(). Windows that have converged are
+    # dropped from the evaluation once they make up half of those still
+    # being evaluated, so the cost follows the number of iterations each
+    # window needs rather than the slowest window in the batch. The
+    # iterations and evaluations of each window are added to counts, if
+    # given, and the final bracket widths stored in it.
+    lo=lo.copy()
+    hi=hi.copy()
+    x=np.where(hi<=0.0,np.nextafter(hi,lo),np.nextafter(lo,hi))
+    x[(lo<0.0) & (hi>0.0)]=0.0
+    use_guess=np.isfinite(guess) & (lo<guess) & (guess<hi)
+    x[use_guess]=guess[use_guess]
+    dx_old=hi-lo
+    dx=dx_old.copy()
+    # Windows being evaluated, and which of them have not converged yet
+    evaluated=np.arange(x.shape[0])
+    active=np.ones(x.shape[0],dtype=bool)
+    for i in range(max_iter):
+        if not active.any():
+            break
+        if 2*active.sum()<=evaluated.shape[0]:
+            segments=subset_segments(segments,np.flatnonzero(active))
+            evaluated=evaluated[active]
+            active=active[active]
+        xe=x[evaluated]
+        feasible, g, dg, d2g = batched_log_growth(xe,segments,value=False)
+        dg=np.where(feasible,dg,np.where(xe<0.5,np.inf,-np.inf))
+        loe=np.where(dg>0.0,xe,lo[evaluated])
+        hie=np.where(dg<0.0,xe,hi[evaluated])
+
+        # Newton step where possible, otherwise bisect
+        dx_older=dx_old[evaluated]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_new=np.where(feasible & (d2g<0.0),xe-dg/d2g,np.nan)
+        bisect=~((loe<x_new) & (x_new<hie)) | (np.abs(x_new-xe)>0.5*np.abs(dx_older))
+        x_new=np.where(bisect,0.5*(loe+hie),x_new)
+        stationary=dg==0.0
+        x_new=np.where(stationary,xe,x_new)
+        step=x_new-xe
+
+        # Only windows that had not converged are updated
+        update=evaluated[active]
+        if counts is not None:
+            counts['evaluations'][evaluated]+=1
+            counts['iterations'][update]+=1
+        lo[update]=loe[active]
+        hi[update]=hie[active]
+        dx_old[update]=dx[update]
+        dx[update]=step[active]
+        x[update]=x_new[active]
+        done=stationary | (np.abs(step)<tol) | (hie-loe<tol)
+        active&=~done
+    if counts is not None:
+        counts['bracket']=hi-lo
+    return x
+
+
+def log_growth_series_terms(l, a, R2, fa, model, long_rate, short_rate, n_terms):
+    # Per-sample terms of the Taylor series of the log-growth about leverage l.
+    # Within a piece the leveraged return is quadratic in l, so
+    #   r_t(l+d) = r_t(l)*(1 + u_t*d + w_t*d**2) = r_t(l)*(1 + alpha_t*d)*(1 + beta_t*d)
+    # with u=r'/r and w=r''/(2r), and
+    #   log r_t(l+d) = log r_t(l) + sum_m (-1)**(m+1) p_m,t d**m/m
+    # where p_m = alpha**m + beta**m follows p_m = u*p_(m-1) - w*p_(m-2).
+    # Row 0 of the returned array holds log r_t(l) and row m holds p_m,t, so
+    # sums over samples give the series for the log-growth of any window. The
+    # series converges for |d| < 1/rho_t with rho_t = max(|alpha_t|,|beta_t|),
+    # returned as the second value. Bankrupt samples are nan.
+    r=R2+l*a
+    dr=a
+    c=0.0
+    if model>=2:
+        s=np.sign(l*(1.0-l))
+        r=r-s*l*(1.0-l)*fa
+        dr=dr-s*(1.0-2.0*l)*fa
+        c=s*fa
+    if model==3:
+        if l<0:
+            r=r+l*short_rate
+            dr=dr+short_rate
+        elif l>1:
+            r=r-(l-1.0)*long_rate
+            dr=dr-long_rate
+    r=np.where(r>0.0,r,np.nan)
+    terms=np.empty((n_terms+1,r.shape[0]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.log(r,out=terms[0])
+        u=dr/r
+        w=c/r
+        terms[1]=u
+        if n_terms>1:
+            terms[2]=u*u-2.0*w
+        for m in range(3,n_terms+1):
+            terms[m]=u*terms[m-1]-w*terms[m-2]
+        disc=u*u-4.0*w
+        rho=np.where(disc>=0.0,0.5*(np.abs(u)+np.sqrt(np.abs(disc))),np.sqrt(np.abs(w)))
+    return terms, rho
+
+
+def log_growth_series_root(sums, rho, l, piece, tol=1e-8, radius=0.15, max_iter=50, counts=None):
+    # Solve G'(l+d)=0 by Newton's method on the Taylor series of G about the
+    # node l, for a set of windows whose series sums (rows as in
+    # log_growth_series_terms(), one column per window) and largest rho are
+    # given. A solution is only trusted while rho*|d| <= radius, where the
+    # truncated series is exact to rounding, and l+d lies inside the open
+    # interval piece on which the series applies. Returns the leverage, G at
+    # that leverage and whether it was trusted. The iterations of each window
+    # are added to counts, if given.
+    n_terms=sums.shape[0]-1
+    m=np.arange(1,n_terms+1)[:,None]
+    c=np.where(m%2==1,1.0,-1.0)*sums[1:]
+    d=np.zeros(sums.shape[1])
+    converged=np.zeros(sums.shape[1],dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        for i in range(max_iter):
+            # Horner's scheme for G'(d) and G''(d)
+            dg=c[-1].copy()
+            d2g=np.zeros_like(d)
+            for k in range(n_terms-2,-1,-1):
+                d2g=d2g*d+dg
+                dg=dg*d+c[k]
+            step=np.where(d2g<0.0,-dg/d2g,np.nan)
+            if counts is not None:
+                counts['iterations'][~converged]+=1
+            d=np.where(converged,d,d+step)
+            converged|=~(np.abs(step)>=tol)
+            if converged.all():
+                break
+        g=c[-1]/n_terms
+        for k in range(n_terms-2,-1,-1):
+            g=g*d+c[k]/(k+1)
+        g=sums[0]+g*d
+        x=l+d
+        trusted=(converged & np.isfinite(g) & (rho*np.abs(d)<=radius)
+                 & (piece[0]<x) & (x<piece[1]))
+    return x, g, trusted
+
+
+def expanding_optimal_leverage(returns,start,ends,model,model_parameters,
+                               tol=1e-8, n_terms=20, block_size=4096, from_shortest=False):
+    # Optimal leverage for the expanding windows of samples start <= t < end
+    # of a ReturnsPair, for every end in ends (positions as from
+    # ReturnsPair.windows()), as would
+    # be returned by calculate_optimal_leverage_windows(). Windows grow one
+    # sample at a time, so instead of solving each of them from scratch the
+    # sums over samples of the Taylor series terms of the log-growth (see
+    # log_growth_series_terms()) are kept for a node on each smooth piece of
+    # G, and each window is solved with a few Newton corrections on the
+    # series about the node, starting from the node itself. A node is moved
+    # to the exact optimum (and its sums recomputed) only when a window's
+    # optimum leaves the range in which the series can be trusted. Returns
+    # arrays of optimal leverages and of the corresponding negative final
+    # log-equity. With from_shortest set, windows shorter than the shortest
+    # of ends are not solved along the way and the nodes are first placed for
+    # the shortest window, so that extending a set of results costs time in
+    # proportion to the new windows.
+    friction=model_parameters['friction']
+    long_rate=model_parameters['long rate']
+    short_rate=model_parameters['short rate']
+
+    # Samples are counted from the start of the windows
+    ends=np.asarray(ends,dtype=np.int64)
+    lengths=np.maximum(ends-start,0)
+    n_max=int(lengths.max(initial=0))
+    R2=returns.R2[start:start+n_max]
+    a=returns.a[start:start+n_max]
+    b=returns.b[start:start+n_max]
+    fa=friction*np.abs(a)
+
+    # Both bounds on the optimal leverage are finite, and the Newton path of
+    # calculate_optimal_leverage() applies, from the first window with
+    # returns on both sides of the riskless return onwards
+    both=np.logical_or.accumulate(a>0.0) & np.logical_or.accumulate(a<0.0)
+    n_0=int(np.argmax(both))+1 if both.any() else n_max+1
+    lower=np.maximum.accumulate(np.where(b<0.0,b,-np.inf))
+    upper=np.minimum.accumulate(np.where(b>0.0,b,np.inf))
+
+    # Results by window length
+    x_n=np.full(n_max+1,np.nan)
+    fun_n=np.full(n_max+1,np.nan)
+    exact=np.zeros(n_max+1,dtype=bool)
+    exact[:min(n_0,n_max+1)]=True
+
+    # The smooth pieces of G. For models 2 and 3 the candidates 0 and 1 and
+    # the one-sided derivatives at the kinks, which decide in which pieces
+    # G has a maximum, are plain prefix sums.
+    if model==1:
+        pieces=[(-np.inf,np.inf)]
+    else:
+        pieces=[(-np.inf,0.0),(0.0,1.0),(1.0,np.inf)]
+        def prefix(l,row):
+            terms=log_growth_series_terms(l,a,R2,fa,model,long_rate,short_rate,1)[0][row]
+            return np.concatenate(([0.0],np.cumsum(terms)))
+        g_0=prefix(0.0,0)
+        g_1=prefix(1.0,0)
+        g_0[np.isnan(g_0)]=-np.inf
+        g_1[np.isnan(g_1)]=-np.inf
+        dg_0_left=prefix(np.nextafter(0.0,-1.0),1)
+        dg_0_right=prefix(np.nextafter(0.0,1.0),1)
+        dg_1_left=prefix(np.nextafter(1.0,0.0),1)
+        dg_1_right=prefix(np.nextafter(1.0,2.0),1)
+        with np.errstate(invalid='ignore'):
+            needed=[dg_0_left<0.0,(dg_0_right>0.0) & (dg_1_left<0.0),dg_1_right>0.0]
+
+    # Node of each piece: leverage, series sums over the first n-1 samples
+    # and the largest rho over those samples
+    nodes=[None]*len(pieces)
+    recentred=-1
+    n=n_0
+    if from_shortest and lengths.shape[0]>0:
+        n=max(n_0,int(lengths.min()))
+    while n<=n_max:
+        m=min(n+block_size,n_max+1)
+        failed=m
+        results=[]
+        clock=time.perf_counter()
+        counts=solver_stats.counters(m-n) if solver_stats.enabled else None
+        for p, piece in enumerate(pieces):
+            need=np.ones(m-n,dtype=bool) if model==1 else needed[p][n:m]
+            if nodes[p] is None:
+                fail=n+int(np.argmax(need)) if need.any() else m
+                results.append((None,None,None,fail))
+                failed=min(failed,fail)
+                continue
+            l, base, base_rho = nodes[p]
+            terms, rho = log_growth_series_terms(l,a[n-1:m-1],R2[n-1:m-1],fa[n-1:m-1],
+                                                 model,long_rate,short_rate,n_terms)
+            sums=base[:,None]+np.cumsum(terms,axis=1)
+            rho=np.maximum(base_rho,np.fmax.accumulate(rho))
+            x, g, trusted = log_growth_series_root(sums,rho,l,piece,tol,counts=counts)
+            bad=need & ~trusted
+            fail=n+int(np.argmax(bad)) if bad.any() else m
+            results.append((x,g,(sums,rho),fail))
+            failed=min(failed,fail)
+
+        # Accept the windows before the first one that could not be solved
+        # from the nodes
+        k=failed-n
+        if k>0 and model==1:
+            x_n[n:failed]=results[0][0][:k]
+            fun_n[n:failed]=-results[0][1][:k]
+        elif k>0:
+            best_x=np.zeros(k)
+            best_g=np.full(k,-np.inf)
+            candidates=[(np.zeros(k),g_0[n:failed]),(np.ones(k),g_1[n:failed])]
+            for p in range(3):
+                if results[p][0] is not None:
+                    candidates.append((np.where(needed[p][n:failed],results[p][0][:k],np.nan),
+                                       results[p][1][:k]))
+            for x, g in candidates:
+                better=~np.isnan(x) & (g>best_g)
+                best_x[better]=x[better]
+                best_g[better]=g[better]
+            x_n[n:failed]=best_x
+            fun_n[n:failed]=-best_g
+        if solver_stats.enabled and k>0:
+            solver_stats.record(np.full(k,start),start+np.arange(n,failed),'series',counts['iterations'][:k],
+                                counts['iterations'][:k],seconds=(time.perf_counter()-clock)/k)
+        if failed>n_max:
+            break
+
+        # Bring the nodes up to date, then move those of the pieces that
+        # failed to the exact optimum of that piece for the failing window
+        for p, piece in enumerate(pieces):
+            x, g, state, fail = results[p]
+            if state is not None and failed>n:
+                sums, rho = state
+                nodes[p]=(nodes[p][0],sums[:,k-1],rho[k-1])
+            if fail!=failed:
+                continue
+            if recentred==failed:
+                # The moved node did not help, so solve this window exactly
+                exact[failed]=True
+                nodes[p]=None
+                continue
+            lo=max(piece[0],lower[failed-1])
+            hi=min(piece[1],upper[failed-1])
+            clock=time.perf_counter()
+            counts=solver_stats.counters(1)
+            segments=window_segments(a,R2,fa,np.array([0]),np.array([failed]),model,long_rate,short_rate)
+            l=batched_safeguarded_newton(np.array([lo]),np.array([hi]),np.array([np.nan]),segments,tol,
+                                         counts=counts)[0]
+            # The node has to be strictly inside the piece for the series to
+            # be that of the piece
+            l=min(max(l,np.nextafter(piece[0],piece[1])),np.nextafter(piece[1],piece[0]))
+            terms, rho = log_growth_series_terms(l,a[:failed-1],R2[:failed-1],fa[:failed-1],
+                                                 model,long_rate,short_rate,n_terms)
+            nodes[p]=(l,terms.sum(axis=1),rho.max(initial=0.0))
+            if solver_stats.enabled:
+                solver_stats.record(start,start+failed,'node move',counts['iterations'],counts['evaluations'],
+                                    counts['bracket'],time.perf_counter()-clock)
+        if exact[failed]:
+            n=failed+1
+            for p, piece in enumerate(pieces):
+                if nodes[p] is not None:
+                    l, base, base_rho = nodes[p]
+                    terms, rho = log_growth_series_terms(l,a[failed-1:failed],R2[failed-1:failed],
+                                    fa[failed-1:failed],model,long_rate,short_rate,n_terms)
+                    nodes[p]=(l,base+terms[:,0],max(base_rho,rho[0]))
+        else:
+            recentred=failed
+            n=failed
+
+    # Windows before both bounds are finite, and any that could not be
+    # solved from the nodes, are solved directly
+    w=np.flatnonzero(exact[lengths])
+    lopt=x_n[lengths]
+    fun=fun_n[lengths]
+    if w.shape[0]>0:
+        lopt[w], fun[w] = calculate_optimal_leverage_windows(returns,np.full(w.shape[0],start),
+                                                             start+lengths[w],model,model_parameters,tol=tol)
+    return lopt, fun
+
+
+def sliding_window_bounds(b_lower, b_upper, starts, ends):
+    # Largest lower and smallest upper bankruptcy bound in each of a sequence
+    # of windows [starts, ends) whose starts and ends never decrease. Each
+    # deque holds the positions of the samples that can still become the
+    # extreme of a later window, so every sample is pushed and popped at most
+    # once.
+    b_lower=b_lower.tolist()
+    b_upper=b_upper.tolist()
+    lower=np.full(len(starts),-np.inf)
+    upper=np.full(len(starts),np.inf)
+    max_queue=deque()
+    min_queue=deque()
+    t=0
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        while t<end:
+            while max_queue and b_lower[max_queue[-1]]<=b_lower[t]:
+                max_queue.pop()
+            max_queue.append(t)
+            while min_queue and b_upper[min_queue[-1]]>=b_upper[t]:
+                min_queue.pop()
+            min_queue.append(t)
+            t+=1
+        while max_queue and max_queue[0]<start:
+            max_queue.popleft()
+        while min_queue and min_queue[0]<start:
+            min_queue.popleft()
+        if max_queue:
+            lower[i]=b_lower[max_queue[0]]
+        if min_queue:
+            upper[i]=b_upper[min_queue[0]]
+    return lower, upper
+
+
+def window_sums(terms, starts, ends):
+    # Sums of the rows of terms over the windows [starts, ends), as
+    # differences of prefix sums. Samples that are nan (bankrupt) are counted
+    # separately so that they only spoil the windows that contain them.
+    bad=np.isnan(terms[0])
+    terms=np.where(bad,0.0,terms)
+    prefix=np.zeros((terms.shape[0],terms.shape[1]+1))
+    np.cumsum(terms,axis=1,out=prefix[:,1:])
+    n_bad=np.concatenate(([0],np.cumsum(bad)))
+    sums=prefix[:,ends]-prefix[:,starts]
+    sums[:,n_bad[ends]>n_bad[starts]]=np.nan
+    return sums
+
+
+def sliding_optimal_leverage(returns,starts,ends,model,model_parameters,
+                             tol=1e-8, n_terms=20, block_size=4096, min_block_size=16):
+    # Optimal leverage for a sequence of windows [starts, ends) of a
+    # ReturnsPair (positions as from ReturnsPair.windows()) whose starts and
+    # ends never decrease, as would
+    # be returned by calculate_optimal_leverage_windows(). Neighbouring
+    # windows share almost all of their samples, so as for
+    # expanding_optimal_leverage() each smooth piece of G has a node about
+    # which the window sums of the Taylor series terms of the log-growth are
+    # kept, here as differences of prefix sums over a block of consecutive
+    # windows, and each window is solved by a few Newton corrections on the
+    # series. A node is moved to the exact optimum of the first window that
+    # cannot be solved from it, warm-started from the neighbouring window.
+    # The bankruptcy bounds come from sliding_window_bounds() and the windows
+    # are classified from prefix counts, both O(1) amortized per window.
+    # Returns arrays of optimal leverages and of the corresponding negative
+    # final log-equity.
+    friction=model_parameters['friction']
+    long_rate=model_parameters['long rate']
+    short_rate=model_parameters['short rate']
+
+    R2=returns.R2
+    a=returns.a
+    starts=np.asarray(starts,dtype=np.int64)
+    ends=np.maximum(np.asarray(ends,dtype=np.int64),starts)
+    fa=friction*np.abs(a)
+    lopt=np.full(starts.shape[0],np.nan)
+    fun=np.full(starts.shape[0],np.nan)
+
+    # Windows with returns on both sides of the riskless return have finite
+    # bounds and take the Newton path of calculate_optimal_leverage()
+    n_pos=np.concatenate(([0],np.cumsum(a>0.0)))
+    n_neg=np.concatenate(([0],np.cumsum(a<0.0)))
+    bounded=(n_pos[ends]>n_pos[starts]) & (n_neg[ends]>n_neg[starts])
+    exact=~bounded
+    windows=np.flatnonzero(bounded)
+    starts_w=starts[windows]
+    ends_w=ends[windows]
+    b=returns.b
+    lower, upper = sliding_window_bounds(np.where(b<0.0,b,-np.inf),np.where(b>0.0,b,np.inf),
+                                         starts_w,ends_w)
+
+    # The smooth pieces of G, and for models 2 and 3 the candidates 0 and 1
+    # and the one-sided derivatives at the kinks
+    if model==1:
+        pieces=[(-np.inf,np.inf)]
+        needed=[np.ones(windows.shape[0],dtype=bool)]
+    else:
+        pieces=[(-np.inf,0.0),(0.0,1.0),(1.0,np.inf)]
+        def kink_sums(l,row):
+            terms=log_growth_series_terms(l,a,R2,fa,model,long_rate,short_rate,1)[0]
+            return window_sums(terms,starts_w,ends_w)[row]
+        g_0=kink_sums(0.0,0)
+        g_1=kink_sums(1.0,0)
+        g_0[np.isnan(g_0)]=-np.inf
+        g_1[np.isnan(g_1)]=-np.inf
+        dg_0_left=kink_sums(np.nextafter(0.0,-1.0),1)
+        dg_0_right=kink_sums(np.nextafter(0.0,1.0),1)
+        dg_1_left=kink_sums(np.nextafter(1.0,0.0),1)
+        dg_1_right=kink_sums(np.nextafter(1.0,2.0),1)
+        with np.errstate(invalid='ignore'):
+            needed=[dg_0_left<0.0,(dg_0_right>0.0) & (dg_1_left<0.0),dg_1_right>0.0]
+
+    # Leverage of the node of each piece, and the last solution on each
+    # piece as the warm start for moving the node
+    nodes=[None]*len(pieces)
+    guesses=[np.nan]*len(pieces)
+    recentred=-1
+    size=min_block_size
+    i=0
+    while i<windows.shape[0]:
+        j=min(i+size,windows.shape[0])
+        first=starts_w[i]
+        last=ends_w[j-1]
+        failed=j
+        results=[]
+        clock=time.perf_counter()
+        counts=solver_stats.counters(j-i) if solver_stats.enabled else None
+        for p, piece in enumerate(pieces):
+            need=needed[p][i:j]
+            if nodes[p] is None:
+                fail=i+int(np.argmax(need)) if need.any() else j
+                results.append((None,None,fail))
+                failed=min(failed,fail)
+                continue
+            terms, rho = log_growth_series_terms(nodes[p],a[first:last],R2[first:last],fa[first:last],
+                                                 model,long_rate,short_rate,n_terms)
+            sums=window_sums(terms,starts_w[i:j]-first,ends_w[i:j]-first)
+            # Largest rho from the start of each window to the end of the
+            # block, which covers the window
+            rho=np.fmax.accumulate(rho[::-1])[::-1][starts_w[i:j]-first]
+            x, g, trusted = log_growth_series_root(sums,rho,nodes[p],piece,tol,counts=counts)
+            bad=need & ~trusted
+            fail=i+int(np.argmax(bad)) if bad.any() else j
+            results.append((x,g,fail))
+            failed=min(failed,fail)
+
+        # Accept the windows before the first one that could not be solved
+        # from the nodes
+        k=failed-i
+        if k>0 and model==1:
+            lopt[windows[i:failed]]=results[0][0][:k]
+            fun[windows[i:failed]]=-results[0][1][:k]
+        elif k>0:
+            best_x=np.zeros(k)
+            best_g=np.full(k,-np.inf)
+            candidates=[(np.zeros(k),g_0[i:failed]),(np.ones(k),g_1[i:failed])]
+            for p in range(3):
+                if results[p][0] is not None:
+                    candidates.append((np.where(needed[p][i:failed],results[p][0][:k],np.nan),
+                                       results[p][1][:k]))
+            for x, g in candidates:
+                better=~np.isnan(x) & (g>best_g)
+                best_x[better]=x[better]
+                best_g[better]=g[better]
+            lopt[windows[i:failed]]=best_x
+            fun[windows[i:failed]]=-best_g
+        if solver_stats.enabled and k>0:
+            solver_stats.record(starts_w[i:failed],ends_w[i:failed],'series',counts['iterations'][:k],
+                                counts['iterations'][:k],seconds=(time.perf_counter()-clock)/k)
+        for p in range(len(pieces)):
+            if k>0 and results[p][0] is not None and needed[p][failed-1]:
+                guesses[p]=results[p][0][k-1]
+        if failed==windows.shape[0]:
+            break
+
+        # Move the nodes of the pieces that failed to the exact optimum of
+        # that piece for the failing window
+        for p, piece in enumerate(pieces):
+            if results[p][2]!=failed:
+                continue
+            if recentred==failed:
+                # The moved node did not help, so solve this window exactly
+                exact[windows[failed]]=True
+                nodes[p]=None
+                continue
+            lo=max(piece[0],lower[failed])
+            hi=min(piece[1],upper[failed])
+            clock=time.perf_counter()
+            counts=solver_stats.counters(1)
+            segments=window_segments(a,R2,fa,starts_w[failed:failed+1],
+                                     ends_w[failed:failed+1]-starts_w[failed:failed+1],
+                                     model,long_rate,short_rate)
+            l=batched_safeguarded_newton(np.array([lo]),np.array([hi]),np.array([guesses[p]]),segments,tol,
+                                         counts=counts)[0]
+            # The node has to be strictly inside the piece for the series to
+            # be that of the piece
+            nodes[p]=min(max(l,np.nextafter(piece[0],piece[1])),np.nextafter(piece[1],piece[0]))
+            guesses[p]=l
+            if solver_stats.enabled:
+                solver_stats.record(starts_w[failed],ends_w[failed],'node move',counts['iterations'],
+                                    counts['evaluations'],counts['bracket'],time.perf_counter()-clock)
+        if exact[windows[failed]]:
+            i=failed+1
+        else:
+            recentred=failed
+            i=failed
+        # Keep the blocks short while nodes are being moved often, since the
+        # rest of a block is thrown away when a window fails
+        size=min(block_size,2*size) if k==size else max(min_block_size,2*k)
+
+    # Windows without finite bounds, and any that could not be solved from
+    # the nodes, are solved directly
+    w=np.flatnonzero(exact)
+    if w.shape[0]>0:
+        lopt[w], fun[w] = calculate_optimal_leverage_windows(returns,starts[w],ends[w],model,
+                                                             model_parameters,tol=tol)
+    return lopt, fun
+
+
 def leveraged_return(l,rel_ret_1,rel_ret_2,friction, long_rate, short_rate, model):
 #Model 1 (simplest case)
     if model==1:
@@ -277,6 +1585,36 @@ def leveraged_return(l,rel_ret_1,rel_ret_2,friction, long_rate, short_rate, mode
         result = -np.log(final_wealth)
     return result
 
+def leveraged_return_grid(leverage_range,rel_ret_1,rel_ret_2,model,friction=0.0,short_rate=0.0,long_rate=0.0):
+    # Relative returns for every combination of time (rows) and leverage
+    # (columns). The returns are treated as a column vector and the leverages
+    # as a row vector so that the model functions broadcast to the full T x L
+    # float64 array in one go.
+    l=np.asarray(leverage_range,dtype=np.float64)[np.newaxis,:]
+    R1=np.asarray(rel_ret_1,dtype=np.float64)[:,np.newaxis]
+    R2=np.asarray(rel_ret_2,dtype=np.float64)[:,np.newaxis]
+
+#Model 1 (simplest case)
+    if model==1:
+        rel_ret_l=model_1(l,R1,R2)
+#Model 2 with friction
+    elif model==2:
+        rel_ret_l=model_2(l,friction,R1,R2)
+#Model 3 with friction and borrowing costs
+    elif model==3:
+        rel_ret_l=model_3(l,friction,short_rate,long_rate,R1,R2)
+    else:
+        raise ValueError('Unknown market model '+str(model))
+
+    # For models 2 and 3 a negative return means bankruptcy, after which all
+    # future returns are declared nan. A running logical OR down the time axis
+    # marks every entry at or after the first bankruptcy for that leverage.
+    if model!=1:
+        with np.errstate(invalid='ignore'):
+            bankrupt=np.logical_or.accumulate(~(rel_ret_l>=0.0),axis=0)
+        rel_ret_l[bankrupt]=np.nan
+    return rel_ret_l
+
 def model_1(leverage,rel_ret_1,rel_ret_2):
     result = 1.0+leverage*(rel_ret_1-1.0)+(1.0-leverage)*(rel_ret_2-1.0)
     return result
@@ -0,0 +1,131 @@
+import json
+import numpy as np
+
+# Statistics of the optimal leverage solvers, turned on with 'solver
+# statistics: True' in the analysis section of the config file. While a
+# stage collects them, each solver records every window it solves: the
+# window's sample positions [start, end), the branch taken, the number of
+# iterations and of evaluations of the log-growth (or of its series), the
+# width of the final bracket of the Newton iteration and the time spent.
+# Windows solved together in a batch share the time of the batch in
+# proportion to the samples they evaluated. The records of a stage are
+# summarised in histograms, totals by branch and a list of the slowest
+# windows, written next to the analysis results as PAIR-N_solver_STAGE.json.
+#
+# The branches are
+#   undefined, infinite, negative infinite : the returns of the two assets
+#       are always equal, or one always exceeds the other
+#   newton : safeguarded Newton iteration between the bankruptcy bounds
+#   scipy : minimize_scalar, where a bankruptcy bound is infinite
+#   series : solved from the Taylor series of the log-growth about a node
+#   node move : a node of the series moved to the optimum of a window
+# with ' at bound' added when the optimum ends up at a bankruptcy bound.
+
+BRANCHES = ['undefined', 'infinite', 'negative infinite', 'newton', 'newton at bound', 'scipy', 'scipy at bound',
+            'series', 'node move']
+# Relative distance from a bound, as a fraction of the bracket, within which
+# an optimum counts as at the bound
+AT_BOUND = 1e-4
+# Number of slowest windows listed
+SLOWEST = 20
+FIELDS = {'start':np.int64, 'end':np.int64, 'branch':object, 'iterations':np.int64, 'evaluations':np.int64,
+          'bracket':np.float64, 'seconds':np.float64}
+
+enabled = False
+collected = []
+
+def record(starts, ends, branch, iterations=0, evaluations=0, bracket=np.nan, seconds=0.0):
+    # Record a window or an array of windows solved the same way
+    starts = np.atleast_1d(np.asarray(starts, dtype=np.int64))
+    n = starts.shape[0]
+    if n == 0:
+        return
+    collected.append({'start':starts,
+                      'end':np.broadcast_to(np.asarray(ends, dtype=np.int64), (n,)),
+                      'branch':np.broadcast_to(np.asarray(branch, dtype=object), (n,)),
+                      'iterations':np.broadcast_to(np.asarray(iterations, dtype=np.int64), (n,)),
+                      'evaluations':np.broadcast_to(np.asarray(evaluations, dtype=np.int64), (n,)),
+                      'bracket':np.broadcast_to(np.asarray(bracket, dtype=np.float64), (n,)),
+                      'seconds':np.broadcast_to(np.asarray(seconds, dtype=np.float64), (n,))})
+
+def share(seconds, evaluations, lengths):
+    # Time of a batch of windows split in proportion to the samples each
+    # window evaluated
+    work = np.asarray(evaluations, dtype=np.float64)*np.asarray(lengths, dtype=np.float64)
+    if work.sum() > 0.0:
+        return seconds*work/work.sum()
+    return np.full(work.shape, seconds/max(work.shape[0], 1))
+
+def with_bound(name, x, lower, upper):
+    # name, or name+' at bound' for the optima at a finite bankruptcy bound
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        width = np.where(np.isfinite(upper-lower), upper-lower, np.maximum(1.0, np.abs(x)))
+        at_bound = (np.isfinite(lower) & (x-lower <= AT_BOUND*width)) | (np.isfinite(upper) & (upper-x <= AT_BOUND*width))
+    return np.where(at_bound, name+' at bound', name)
+
+def counters(n=None):
+    # Counters filled in by the Newton solvers, for one window or for n
+    if n is None:
+        return {'iterations':0, 'evaluations':0, 'bracket':np.nan}
+    return {'iterations':np.zeros(n, dtype=np.int64), 'evaluations':np.zeros(n, dtype=np.int64),
+            'bracket':np.full(n, np.nan)}
+
+def histogram(values, edges):
+    # Counts of the values in [edges[i], edges[i+1]), with the values that
+    # are nan counted separately
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    counts = np.histogram(values[~missing], bins=edges)[0]
+    return {'edges':[float(edge) for edge in edges], 'counts':counts.tolist(), 'missing':int(missing.sum())}
+
+def summary(records, dates):
+    # Histograms of the statistics of the records, totals by branch and the
+    # slowest windows
+    count_edges = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, np.inf]
+    result = {'windows':int(records['start'].shape[0]),
+              'seconds':float(records['seconds'].sum()),
+              'evaluations':int(records['evaluations'].sum()),
+              'branches':{},
+              'histograms':{'iterations':histogram(records['iterations'], count_edges),
+                            'evaluations':histogram(records['evaluations'], count_edges),
+                            'bracket width':histogram(records['bracket'], [0.0]+list(10.0**np.arange(-16, 3))+[np.inf]),
+                            'seconds':histogram(records['seconds'], [0.0]+list(10.0**np.arange(-9, 3))+[np.inf]),
+                            'samples':histogram(records['end']-records['start'],
+                                                [0]+list(2**np.arange(0, 25))+[np.inf])}}
+    for name in BRANCHES:
+        chosen = records['branch'] == name
+        if chosen.any():
+            result['branches'][name] = {'windows':int(chosen.sum()),
+                                        'seconds':float(records['seconds'][chosen].sum()),
+                                        'iterations':int(records['iterations'][chosen].sum()),
+                                        'evaluations':int(records['evaluations'][chosen].sum())}
+    slowest = np.argsort(records['seconds'])[::-1][:SLOWEST]
+    result['slowest windows'] = [{'start date':str(dates[records['start'][i]]) if records['start'][i] < len(dates) else None,
+                                  'end date':str(dates[records['end'][i]-1]) if records['end'][i] > 0 else None,
+                                  'samples':int(records['end'][i]-records['start'][i]),
+                                  'branch':records['branch'][i],
+                                  'iterations':int(records['iterations'][i]),
+                                  'evaluations':int(records['evaluations'][i]),
+                                  'bracket width':None if np.isnan(records['bracket'][i]) else float(records['bracket'][i]),
+                                  'seconds':float(records['seconds'][i])} for i in slowest]
+    return result
+
+def start():
+    # Start collecting the statistics of the solvers
+    global enabled
+    enabled = True
+    del collected[:]
+
+def write(filename, dates):
+    # Stop collecting and write the summary of the statistics collected to
+    # filename.json. dates are those of the ReturnsPair the windows are
+    # positions in.
+    global enabled
+    enabled = False
+    records = {field:np.concatenate([part[field] for part in collected]+[np.zeros(0, dtype=dtype)])
+               for field, dtype in FIELDS.items()}
+    del collected[:]
+    f = open(filename+'.json', 'w')
+    json.dump(summary(records, dates), f, indent=1)
+    f.close()
@@ -0,0 +1,90 @@
+import json
+import os
+import numpy as np
+from . import manifest
+from . import store
+
+# Cache of the parsed and standardised frames of the source files, kept in
+# the folder .cache of the intermediate data folder. Each extractor caches the
+# frames it reads under names of its own (the same source file can be read
+# differently by two extractors) as three files:
+#   NAME.npy, NAME.labels.npz  the frame, saved with store.save, so that it is
+#                              read back from a memory map
+#   NAME.json                  the key of the entry: the path, size,
+#                              modification time and content hash of the
+#                              source file and the hash of the code that
+#                              parsed it
+# An entry is only used while its key matches; otherwise the source is
+# parsed again and the entry replaced. Entries whose source has changed or
+# gone are evicted by evict(). Frames with columns that the store cannot
+# keep exactly (anything but floats) are not cached.
+
+CACHE_FOLDER = '.cache'
+
+def folder(target_folder):
+    return os.path.join(target_folder, CACHE_FOLDER)
+
+def code_hash():
+    # Hash of the code that parses the source files
+    return manifest.content_hash(manifest.package_files('data')[0])
+
+def source_key(path):
+    return {'path':os.path.abspath(path), 'stat':manifest.file_stat(path), 'hash':manifest.content_hash(path),
+            'code':code_hash()}
+
+def read_key(filename):
+    try:
+        f = open(filename+'.json', 'r')
+        key = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        return None
+    return key
+
+def remove(filename):
+    for suffix in ['.json', store.VALUES, store.LABELS]:
+        if os.path.isfile(filename+suffix):
+            os.remove(filename+suffix)
+
+def cached(target_folder, name, path, parse):
+    # The frame parse() makes from the source file path, from the cache if
+    # the file has not changed since it was cached
+    filename = os.path.join(folder(target_folder), name)
+    key = source_key(path)
+    if read_key(filename) == key and store.exists(filename):
+        try:
+            return store.load(filename)
+        except (OSError, ValueError, KeyError):
+            pass
+    df = parse()
+    remove(filename)
+    if all(np.issubdtype(dtype, np.floating) for dtype in df.dtypes):
+        os.makedirs(folder(target_folder), exist_ok=True)
+        store.save(df, filename)
+        # The key is written last, so an entry that was not saved completely
+        # is never used
+        f = open(filename+'.json', 'w')
+        json.dump(key, f)
+        f.close()
+    return df
+
+def evict(target_folder):
+    # Remove the entries whose source file or parsing code has changed or
+    # whose source file no longer exists, and any files left behind by
+    # entries that were not saved completely.
+    # Returns the names of the entries removed.
+    cache_folder = folder(target_folder)
+    if not os.path.isdir(cache_folder):
+        return []
+    code = code_hash()
+    evicted = []
+    names = set(name.split('.')[0] for name in os.listdir(cache_folder))
+    for name in sorted(names):
+        filename = os.path.join(cache_folder, name)
+        key = read_key(filename)
+        if key is not None and store.exists(filename) and key.get('code') == code \
+                and os.path.isfile(key['path']) and manifest.file_stat(key['path']) == key['stat']:
+            continue
+        remove(filename)
+        evicted.append(name)
+    return evicted
@@ -0,0 +1,257 @@
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# Binary store for the analysis results (leverage grids, their summaries and
+# the optimal leverage for windows). A result saved under the name
+# analysis_folder+'PAIR-1' is written as two files:
+#   PAIR-1.npy         the values as a float64 (or float32) block, in
+#                      column-major order so that each column is contiguous
+#                      on disk
+#   PAIR-1.labels.npz  the row labels (dates, leverages, window sizes), the
+#                      column labels and a small json header with the names
+#                      and dtypes of the columns
+# The values are opened as a np.memmap, so a reader only pages in the
+# columns (and rows) it touches rather than unpickling the whole grid.
+# Columns of dates are kept as int64 nanoseconds in the same 8 byte cells.
+
+VALUES = '.npy'
+LABELS = '.labels.npz'
+
+def exists(filename):
+    return os.access(filename+VALUES, os.R_OK) and os.access(filename+LABELS, os.R_OK)
+
+def save(data, filename, pickle_export=False, dtype=np.float64):
+    # Save a pandas Series or DataFrame with a numeric or date index. The
+    # values can be stored in single precision by giving dtype=np.float32.
+    # The pickle of the original object can be written alongside as an export.
+    if isinstance(data, pd.Series):
+        frame = data.to_frame()
+        header = {'kind':'series', 'name':data.name}
+    else:
+        frame = data
+        header = {'kind':'frame', 'columns name':frame.columns.name}
+    dtypes = [str(column_dtype) for column_dtype in frame.dtypes]
+
+    values = np.empty(frame.shape, dtype=dtype, order='F')
+    for column, column_dtype in enumerate(frame.dtypes):
+        if np.issubdtype(column_dtype, np.datetime64):
+            # Dates need all 8 bytes of a cell
+            if values.dtype != np.float64:
+                raise ValueError('Columns of dates can only be stored in float64: '+filename)
+            values[:,column] = frame.iloc[:,column].values.astype('datetime64[ns]').view(np.float64)
+        else:
+            values[:,column] = frame.iloc[:,column].values.astype(dtype)
+            dtypes[column] = str(values.dtype)
+    if header['kind'] == 'series':
+        values = values[:,0]
+    np.save(filename+VALUES, values)
+    write_labels(filename, header, dtypes, frame.index, frame.columns if header['kind'] == 'frame' else None)
+
+    if pickle_export:
+        data.to_pickle(filename+'.pkl')
+
+def write_labels(filename, header, dtypes, index, columns=None):
+    header = dict(header, dtypes=dtypes)
+    header['index name'] = index.name
+    header['freq'] = getattr(index, 'freqstr', None)
+    labels = {'index':label_array(index)}
+    header['index dtype'] = str(index.dtype)
+    if columns is not None:
+        labels['columns'] = label_array(columns)
+        header['columns dtype'] = str(columns.dtype)
+    labels['header'] = np.array(json.dumps(header, default=str))
+    f = open(filename+LABELS, 'wb')
+    np.savez(f, **labels)
+    f.close()
+
+def create(filename, index, columns, dtype=np.float64):
+    # Start saving a DataFrame of floats that is too large to hold in memory.
+    # The values are written block by block of rows with write_rows, to a
+    # temporary file that only replaces any saved result once finish is
+    # called, so a result can be extended from its own saved rows.
+    shape = (len(index), len(columns))
+    f = open(filename+VALUES+'.tmp', 'wb')
+    np.lib.format.write_array_header_1_0(f, {'descr':np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                            'fortran_order':True, 'shape':shape})
+    offset = f.tell()
+    f.truncate(offset+shape[0]*shape[1]*np.dtype(dtype).itemsize)
+    return {'file':f, 'offset':offset, 'shape':shape, 'dtype':np.dtype(dtype),
+            'filename':filename, 'index':index, 'columns':columns}
+
+def write_rows(writer, start, block):
+    # Write a block of rows starting at row start. Each column is contiguous
+    # on disk, so the block is written one column at a time.
+    f = writer['file']
+    rows, itemsize = writer['shape'][0], writer['dtype'].itemsize
+    block = np.asfortranarray(block, dtype=writer['dtype'])
+    for column in range(block.shape[1]):
+        f.seek(writer['offset']+(column*rows+start)*itemsize)
+        f.write(block[:,column].tobytes())
+
+def finish(writer):
+    writer['file'].close()
+    filename = writer['filename']
+    os.replace(filename+VALUES+'.tmp', filename+VALUES)
+    write_labels(filename, {'kind':'frame', 'columns name':writer['columns'].name},
+                 [str(writer['dtype'])]*writer['shape'][1], writer['index'], writer['columns'])
+
+def label_array(labels):
+    # Labels as an array that can be saved without pickling: dates and time
+    # spans as int64 nanoseconds, and anything else that is not numeric (such
+    # as the column names of a summary) as strings
+    if labels.dtype.kind in 'mM':
+        return labels.asi8
+    if labels.dtype == object:
+        return np.asarray(labels).astype(str)
+    return np.asarray(labels)
+
+def label_index(array, dtype, name):
+    if dtype == 'object':
+        return pd.Index(array.astype(object), name=name)
+    if dtype.startswith('datetime64') or dtype.startswith('timedelta64'):
+        array = array.view(dtype)
+    return pd.Index(array, name=name)
+
+def open_values(filename):
+    # The values of a saved result as a read-only memory map, together with
+    # its header and its row and column labels as pandas indexes
+    values = np.load(filename+VALUES, mmap_mode='r')
+    f = np.load(filename+LABELS, allow_pickle=False)
+    header = json.loads(str(f['header']))
+    index = label_index(f['index'], header['index dtype'], header['index name'])
+    if header['freq'] is not None and isinstance(index, pd.DatetimeIndex):
+        index = pd.DatetimeIndex(index, freq=header['freq'])
+    elif header['freq'] is not None and isinstance(index, pd.TimedeltaIndex):
+        index = pd.TimedeltaIndex(index, freq=header['freq'])
+    columns = None
+    if header['kind'] == 'frame':
+        columns = label_index(f['columns'], header['columns dtype'], header['columns name'])
+    f.close()
+    return values, header, index, columns
+
+def column_values(values, header, column):
+    # One column of a result as an in-memory array of its original dtype
+    if header['kind'] == 'series':
+        block = np.array(values)
+    else:
+        block = np.array(values[:,column])
+    if header['dtypes'][column].startswith('datetime64'):
+        block = block.view('datetime64[ns]')
+    return block
+
+def load(filename, columns=None, positions=None):
+    # Read a saved result back as a pandas object. For a DataFrame only the
+    # columns given, by label or by position, are read.
+    values, header, index, all_columns = open_values(filename)
+    if header['kind'] == 'series':
+        return pd.Series(column_values(values, header, 0), index=index, name=header['name'])
+    if columns is not None:
+        positions = [all_columns.get_loc(column) for column in columns]
+    elif positions is None:
+        positions = list(range(len(all_columns)))
+    if all(header['dtypes'][position] in ('float64', 'float32') for position in positions):
+        # Plain float columns are copied out of the map in one go, in the
+        # precision they were stored in
+        return pd.DataFrame(np.array(values[:,positions], order='F'), index=index,
+                            columns=all_columns[positions])
+    data = {all_columns[position]:column_values(values, header, position) for position in positions}
+    return pd.DataFrame(data, index=index, columns=all_columns[positions])
+
+
+# Data sets written by the extract and transform stages. Each data set is
+# written in the formats chosen with 'output formats:' in the config file, any
+# of pickle, csv and npy (the binary store above), and read back from the
+# fastest format available. CSV files are written in background threads, which
+# finish_writes() waits for.
+FORMAT_SUFFIXES = {'pickle':['.pkl'], 'npy':[VALUES, LABELS], 'csv':['.csv']}
+# Formats in the order they are read from, fastest first. Whole frames of the
+# size of the daily data sets unpickle about ten times faster than they load
+# from the store, and a hundred times faster than they parse from csv.
+READ_ORDER = ['pickle', 'npy', 'csv']
+DEFAULT_FORMATS = ['pickle', 'csv']
+
+writers = []
+
+def check_formats(formats):
+    # The known formats of a list of them (or of a single one), in the order
+    # of READ_ORDER
+    if isinstance(formats, str):
+        formats = [formats]
+    unknown = [name for name in formats if name not in FORMAT_SUFFIXES]
+    if unknown:
+        print("  Error: unknown output formats", ', '.join(str(name) for name in unknown), "are ignored.")
+    known = [name for name in READ_ORDER if name in formats]
+    if not known:
+        print("  Error: no known output formats given. Writing", ' and '.join(DEFAULT_FORMATS), "instead.")
+        return list(DEFAULT_FORMATS)
+    return known
+
+def frame_files(filename, formats=READ_ORDER):
+    # The files of a data set in the given formats
+    return [filename+suffix for name in formats for suffix in FORMAT_SUFFIXES[name]]
+
+def frame_format(filename):
+    # The fastest format a data set is available in, or None
+    for name in READ_ORDER:
+        if all(os.path.isfile(path) for path in frame_files(filename, [name])):
+            return name
+    return None
+
+def read_files(filename):
+    # The files a data set is read from, to hash as the input of a stage
+    name = frame_format(filename)
+    if name is None:
+        return frame_files(filename, ['pickle'])
+    return frame_files(filename, [name])
+
+def write_csv(df, filename):
+    # Write a csv file in a background thread
+    writer = {'error':None}
+    def run():
+        try:
+            df.to_csv(filename)
+        except BaseException as error:
+            writer['error'] = error
+    writer['thread'] = threading.Thread(target=run)
+    writer['thread'].start()
+    writers.append(writer)
+
+def finish_writes():
+    # Wait for the csv files being written in the background. Raises the
+    # first error any of them ran into.
+    errors = []
+    while writers:
+        writer = writers.pop(0)
+        writer['thread'].join()
+        if writer['error'] is not None:
+            errors.append(writer['error'])
+    if errors:
+        raise errors[0]
+
+def write_frame(df, filename, formats=DEFAULT_FORMATS):
+    # Write a data set in each of the formats. Files left from formats that
+    # are no longer written are removed, so that they are not read instead.
+    # The frame must not be changed until finish_writes() has been called.
+    for path in frame_files(filename, [name for name in READ_ORDER if name not in formats]):
+        if os.path.isfile(path):
+            os.remove(path)
+    if 'pickle' in formats:
+        df.to_pickle(filename+'.pkl')
+    if 'npy' in formats:
+        save(df, filename)
+    if 'csv' in formats:
+        write_csv(df, filename+'.csv')
+
+def read_frame(filename):
+    # Read a data set from the fastest format it is available in
+    name = frame_format(filename)
+    if name == 'pickle':
+        return pd.read_pickle(filename+'.pkl')
+    if name == 'npy':
+        return load(filename)
+    if name == 'csv':
+        return pd.read_csv(filename+'.csv', index_col=0, parse_dates=True, float_precision='round_trip')
+    raise FileNotFoundError('No data file for '+filename+' in any of the formats '+', '.join(READ_ORDER))
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+# Synthetic return pairs with a known optimal leverage, for testing the
+# analysis and for scaling studies on series longer than the source data.
+# The risky asset follows a geometric Brownian motion with drift mu and
+# volatility sigma, and the riskless asset pays a constant rate r (all
+# annual and continuously compounded), so that the optimal leverage is
+# (mu-r)/sigma^2. Returns are drawn in one go from a seeded generator: the
+# same parameters and seed always give the same series.
+
+def optimal_leverage(drift, riskless_rate, volatility):
+    # Optimal leverage of the risky asset against the riskless one
+    return (drift-riskless_rate)/volatility**2
+
+def sample_dates(samples, samples_per_annum=365.0, start='2000-01-01'):
+    # Evenly spaced dates, one day apart at 365 samples per annum and closer
+    # together for intraday series
+    spacing=pd.Timedelta(days=365.0/samples_per_annum)
+    start=pd.Timestamp(start)
+    try:
+        start+spacing*(samples-1)
+    except (OverflowError, ValueError):
+        raise ValueError(str(samples)+' samples at '+str(samples_per_annum)+' per annum from '+str(start.date())
+                         +' run past the last date pandas can represent. Use an earlier start or more samples per annum.')
+    return pd.date_range(start, periods=samples, freq=spacing, name='date')
+
+def gbm_returns(drift, volatility, samples, samples_per_annum=365.0, seed=0):
+    # Gross returns per sample of a geometric Brownian motion
+    dt=1.0/samples_per_annum
+    noise=np.random.default_rng(seed).standard_normal(samples)
+    return np.exp((drift-volatility**2/2)*dt+volatility*np.sqrt(dt)*noise)
+
+def gbm_pair(drift, riskless_rate, volatility, samples, samples_per_annum=365.0, start='2000-01-01', seed=0):
+    # Returns of the risky and the riskless asset as DataFrames in the format
+    # of the files in data/4-load/
+    dates=sample_dates(samples, samples_per_annum, start)
+    dt=1.0/samples_per_annum
+    risky=pd.DataFrame({'return':gbm_returns(drift, volatility, samples, samples_per_annum, seed)}, index=dates)
+    riskless=pd.DataFrame({'return':np.full(samples, np.exp(riskless_rate*dt))}, index=dates)
+    return risky, riskless
+
+def write_pair(data_folder, pair, drift, riskless_rate, volatility, years, samples_per_annum=365.0,
+               start='2000-01-01', seed=0):
+    # Write the returns of the assets of a pair (e.g. 'SYN-SYNRF') to
+    # data_folder as ASSET.pkl, ready for the analysis. The risky asset
+    # needs an entry in model_parameters.yaml with the same samples per
+    # annum. Returns the number of samples.
+    asset1 = pair.split('-')[0]
+    asset2 = pair.split('-')[1]
+    samples=int(round(years*samples_per_annum))
+    risky, riskless = gbm_pair(drift, riskless_rate, volatility, samples, samples_per_annum, start, seed)
+    risky.to_pickle(data_folder+asset1+'.pkl')
+    riskless.to_pickle(data_folder+asset2+'.pkl')
+    return samples
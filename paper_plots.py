@@ -3,7 +3,11 @@ import pandas as pd
 import numpy as np
 import yaml
 import sys
+import os
+import time
 import leverage_efficiency.base
+import leverage_efficiency.manifest as manifest
+import leverage_efficiency.render as render
 import leverage_efficiency.paper_figures as figs
 
 def main(config_file):
@@ -17,69 +21,83 @@ def main(config_file):
     plots_folder = config['plots_folder']
 
     figures = config['paper plots']['run']
+    # Number of processes to render the figures on (auto for one per core)
+    workers = config['paper plots'].get('workers', 1)
+    if workers == 'auto':
+        workers = os.cpu_count()
 
     if figures:
         print('\n\nGenerating figures from the manuscript in ', plots_folder )
+        # The figures are only made again when the analysis results, this
+        # section of the config or the plotting code have changed, if the stage
+        # cache is turned on
+        records = manifest.read_manifest(plots_folder)
+        key = manifest.input_hash(manifest.folder_files(analysis_folder)+[__file__]+manifest.package_files('paper_figures', 'sme_functions', 'store', 'render'),
+                                  config['paper plots'], manifest.recorded_state(records, 'plots'))
+        if config.get('stage cache', False) and manifest.is_current(plots_folder, records, 'paper plots', key, check_files=False):
+            print('  Figures unchanged since last made.')
+            return
+        start_time = time.time_ns()
+        # The figures are listed as tasks and rendered on the number of
+        # worker processes set in the config (1 renders them in turn here)
+        tasks = []
         pairs = ['SP500-FED', 'BTC-FED']
 
     #if figures['expanding windows']:
         for pair in pairs:
             outputfile = plots_folder+pair+'_lopt_exp_window.pdf'
-            fig, ax = figs.fig_exp_window(analysis_folder,   pair)
-            fig.savefig(outputfile, bbox_inches='tight')
-            plt.close()
+            tasks.append(render.task(figs, 'fig_exp_window', (analysis_folder,   pair), outputfile))
 
     #if figures['growth rate vs leverage']:
         for pair in pairs:
             outputfile = plots_folder+pair+'_growth_vs_leverage.pdf'
-            fig, ax = figs.fig_growth_vs_leverage(analysis_folder, plots_folder, pair)
+            tweaks = {}
             if pair=='SP500TR-FED':
-                plt.legend(loc='lower left', bbox_to_anchor=(.3,.3))
-            fig.savefig(outputfile, bbox_inches='tight')
-            plt.close()
+                tweaks['legend'] = {'loc':'lower left', 'bbox_to_anchor':(.3,.3)}
+            tasks.append(render.task(figs, 'fig_growth_vs_leverage', (analysis_folder, plots_folder, pair), outputfile,
+                                     **tweaks))
 
     #if figures['final equity vs leverage']:
         for pair in pairs:
             outputfile = plots_folder+pair+'_final_equity.pdf'
-            fig, ax = figs.fig_final_equity(analysis_folder, plots_folder, pair)
+            tweaks = {}
             if pair=='SP500TR-FED':
-                plt.legend(loc='lower left', bbox_to_anchor=(.0,.6))
-            fig.savefig(outputfile, bbox_inches='tight')
-            plt.close()
+                tweaks['legend'] = {'loc':'lower left', 'bbox_to_anchor':(.0,.6)}
+            tasks.append(render.task(figs, 'fig_final_equity', (analysis_folder, plots_folder, pair), outputfile,
+                                     **tweaks))
 
     #if figures['equity trajectories']:
         for pair in pairs:
             outputfile = plots_folder+pair+'_equity_trajectories.pdf'
-            fig, ax = figs.fig_equity_trajectories(analysis_folder, plots_folder, pair)
-            fig.savefig(outputfile, bbox_inches='tight')
-            plt.close()
+            tasks.append(render.task(figs, 'fig_equity_trajectories', (analysis_folder, plots_folder, pair), outputfile))
 
     #if figures['l_opt variance']:
         outputfile = plots_folder+'lopt_var.pdf'
-        fig, ax = figs.fig_lopt_var(analysis_folder, plots_folder, ['SP500-FED','BTC-FED'])
-        fig.savefig(outputfile, bbox_inches='tight')
-        plt.close()
+        tasks.append(render.task(figs, 'fig_lopt_var', (analysis_folder, plots_folder, ['SP500-FED','BTC-FED']), outputfile))
 
     #if figures['fixed windows']:
         for pair in pairs:
             outputfile = plots_folder+pair+'_leverage_vary_window.pdf'
-            fig, ax = figs.fig_leverage_vary_window(analysis_folder, plots_folder, pair, 1)
+            tweaks = {}
             if pair=='SP500-FED':
                 ymax = 11
                 ymin = -9
-                plt.ylim([ymin, ymax])
+                tweaks['ylim'] = [ymin, ymax]
             if pair=='BTC-FED':
                 ymax = 11
                 ymin = -9
-                plt.ylim([ymin, ymax])
-            fig.savefig(outputfile, bbox_inches='tight')
-            plt.close()
+                tweaks['ylim'] = [ymin, ymax]
+            tasks.append(render.task(figs, 'fig_leverage_vary_window', (analysis_folder, plots_folder, pair, 1), outputfile,
+                                     **tweaks))
 
     #if figures['compare assets']:
             outputfile = plots_folder+'compare_assets.pdf'
-            fig, ax = figs.fig_compare_assets(analysis_folder, plots_folder)
-            fig.savefig(outputfile, bbox_inches='tight')
-            plt.close()
+            tasks.append(render.task(figs, 'fig_compare_assets', (analysis_folder, plots_folder), outputfile))
+
+        render.render_figures(tasks, workers)
+
+        manifest.record(plots_folder, records, 'paper plots', key, manifest.outputs_since(plots_folder, start_time))
+        manifest.write_manifest(plots_folder, records)
 
 # Execute the main() function
 
@@ -0,0 +1,47 @@
+import leverage_efficiency.base
+import leverage_efficiency.manifest as manifest
+import leverage_efficiency.synthetic as synthetic
+import yaml
+import sys
+
+def main(config_file):
+    # Read the config information to control what gets executed
+    f = open(config_file,'r')
+    config = yaml.load(f, Loader=yaml.SafeLoader)
+    f.close()
+    target_folder = config['data_folder']
+    settings = config.get('synthetic data', {})
+    runstage = settings.get('run', False)
+
+    if runstage:
+        print("\n###")
+        print("Running synthesize.py. Synthetic data will be written to ", target_folder)
+        print("###")
+        # Each pair is only generated again when its settings or the
+        # generating code have changed, if the stage cache is turned on
+        records = manifest.read_manifest(target_folder)
+        for pair, pair_settings in settings['pairs'].items():
+            drift = pair_settings['drift']
+            riskless_rate = pair_settings['riskless rate']
+            volatility = pair_settings['volatility']
+            print("  ", pair, ": optimal leverage (drift - riskless rate)/volatility^2 = ",
+                  synthetic.optimal_leverage(drift, riskless_rate, volatility))
+            key = manifest.input_hash(manifest.package_files('synthetic'), pair_settings)
+            if config.get('stage cache', False) and manifest.is_current(target_folder, records, pair, key):
+                print("  Unchanged since last generated: ", pair)
+                continue
+            samples = synthetic.write_pair(target_folder, pair, drift, riskless_rate, volatility,
+                                           pair_settings['years'],
+                                           pair_settings.get('samples per annum', 365.0),
+                                           str(pair_settings.get('start', '2000-01-01')),
+                                           pair_settings.get('seed', 0))
+            print("  ", pair, ": ", samples, " samples written")
+            manifest.record(target_folder, records, pair, key, [asset+'.pkl' for asset in pair.split('-')])
+        manifest.write_manifest(target_folder, records)
+
+# Execute the main() function
+
+if __name__ == "__main__":
+    # Get the name of the config file
+    config_file = leverage_efficiency.base.get_config_filename(sys.argv)
+    main(config_file)
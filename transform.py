@@ -2,8 +2,12 @@ import pandas as pd
 import numpy as np
 import leverage_efficiency.base
 import leverage_efficiency.data as data
+import leverage_efficiency.manifest as manifest
+import leverage_efficiency.instrument as instrument
+import leverage_efficiency.store as store
 import yaml
 import sys
+import os
 
 def main(config_file):
     # Read the config information to control what gets executed
@@ -16,20 +20,42 @@ def main(config_file):
     runstage = config['data processing stages']['run']
     daily_interest_rates = config['data processing stages']['daily interest rates']
     monthly_interest_rates = config['data processing stages']['monthly interest rates']
+    formats = store.check_formats(config['data processing stages'].get('output formats', store.DEFAULT_FORMATS))
 
     if runstage:
         print("\n###")
         print("Running transform.py. Results will be written to ", target_folder)
         print("###")
-        # Transform intermediate data files into input for analysis
-        for key in assets:
-             data.prepare_input_asset_data(source_folder, target_folder, key)
+        # Each data set is transformed according to its kind. Those whose
+        # intermediate file is unchanged since they were last transformed are
+        # skipped if the stage cache is turned on
+        kinds = [(key, 'asset') for key in assets]
+        kinds += [(key, 'daily') for key in daily_interest_rates]
+        kinds += [(key, 'monthly') for key in monthly_interest_rates]
+        records = manifest.read_manifest(target_folder)
+        keys = {key:manifest.input_hash(store.read_files(source_folder+key)+manifest.package_files('data'), kind, formats)
+                for key, kind in kinds}
+        if config.get('stage cache', False):
+            current = [key for key, kind in kinds if manifest.is_current(target_folder, records, key, keys[key])]
+            if current:
+                print("  Unchanged since last transformed: ", ', '.join(current))
+            kinds = [(key, kind) for key, kind in kinds if key not in current]
 
-        for key in daily_interest_rates:
-             data.prepare_input_interest_rate_data(source_folder, target_folder, key)
-
-        for key in monthly_interest_rates:
-             data.prepare_input_interest_rate_data(source_folder, target_folder, key, freq='monthly')
+        # Transform intermediate data files into input for analysis. The csv
+        # files are written in the background while the next data set is
+        # transformed, and are complete before the data sets are recorded.
+        for key, kind in kinds:
+            with instrument.measure(item=key):
+                if kind == 'asset':
+                    data.prepare_input_asset_data(source_folder, target_folder, key, formats)
+                else:
+                    data.prepare_input_interest_rate_data(source_folder, target_folder, key, freq=kind, formats=formats)
+        store.finish_writes()
+        for key, kind in kinds:
+            manifest.record(target_folder, records, key, keys[key],
+                            [os.path.basename(path) for path in store.frame_files(target_folder+key, formats)
+                             if os.path.isfile(path)])
+        manifest.write_manifest(target_folder, records)
 
 # Execute the main() function
 
@@ -4,15 +4,26 @@
 # the config.yaml file
 
 import sys
+import yaml
 import leverage_efficiency.base
+import leverage_efficiency.instrument as instrument
 
 def main():
     # Get the name of the config file
     config_file = leverage_efficiency.base.get_config_filename(sys.argv)
 
+    # Measure the time, memory and file traffic of each stage, pair and
+    # figure if a run report is asked for in the config file
+    f = open(config_file,'r')
+    config = yaml.load(f, Loader=yaml.SafeLoader)
+    f.close()
+    if config.get('run report', False):
+        instrument.enable()
+
     # Extract the data from source data folder into common format
     import extract
-    extract.main(config_file)
+    with instrument.measure('extract'):
+        extract.main(config_file)
 
     # Update data with most recent values (optional)
     #import update       # This doesn't connect to the rest of the pipeline yet
@@ -20,23 +31,38 @@ def main():
 
     # Calculate derived quantities like returns for input into calculations
     import transform
-    transform.main(config_file)
+    with instrument.measure('transform'):
+        transform.main(config_file)
+
+    # Generate synthetic return pairs with a known optimal leverage (optional)
+    import synthesize
+    with instrument.measure('synthesize'):
+        synthesize.main(config_file)
 
     # Perform leverage efficiency calculations
     import analysis
-    analysis.main(config_file)
+    with instrument.measure('analysis'):
+        analysis.main(config_file)
 
     # Create figures
     import plots
-    plots.main(config_file)
+    with instrument.measure('plots'):
+        plots.main(config_file)
 
     # Create exact figures used in the paper
     import paper_plots
-    paper_plots.main(config_file)
+    with instrument.measure('paper plots'):
+        paper_plots.main(config_file)
 
     # Create figures used in the EE lecture notes
     import lecture_plots
-    lecture_plots.main(config_file)
+    with instrument.measure('lecture plots'):
+        lecture_plots.main(config_file)
+
+    if instrument.enabled:
+        instrument.write_report(config['analysis_folder'], config_file)
+        print("\nRun report written to ", config['analysis_folder']+instrument.REPORT_FILE+'.json/.csv')
+        instrument.print_summary()
 # Execute the main() function
 
 if __name__ == "__main__":